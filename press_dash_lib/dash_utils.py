@@ -2,11 +2,13 @@
 Most functions should be useful for most datasets.
 '''
 import copy
+import json
 import numpy as np
 import os
 import pandas as pd
 import re
 import streamlit as st
+import sys
 import yaml
 
 import matplotlib
@@ -182,7 +184,7 @@ def setup_data_axes(
 def setup_data_settings(
         st_loc,
         defaults={},
-        include=[ 'show_total', 'cumulative', 'recategorize', 'combine_single_categories' ],
+        include=[ 'show_total', 'transform', 'recategorize', 'combine_single_categories', 'approximate' ],
 ):
     ''''''
 
@@ -197,6 +199,18 @@ def setup_data_settings(
             'use cumulative values',
             value=defaults.get( 'cumulative', False ),
         )
+    if 'transform' in include:
+        transforms = [ 'None', 'Cumulative', 'Rolling mean', 'Year-over-year change', 'Year-over-year percent change' ]
+        data_kw['transform'] = st_loc.selectbox(
+            'transform the values',
+            transforms,
+            index=transforms.index( defaults.get( 'transform', 'None' ) ),
+        )
+        data_kw['window'] = st_loc.number_input(
+            'rolling mean window (number of time bins)',
+            min_value=1,
+            value=defaults.get( 'window', 3 ),
+        )
     if 'recategorize' in include:
         data_kw['recategorize'] = st_loc.checkbox(
             'use combined categories (avoids double counting; definitions can be edited in the config)',
@@ -207,15 +221,159 @@ def setup_data_settings(
                 'group all undefined categories as "Other"',
                 value=defaults.get( 'combine_single_categories', False ),
             )
+    if 'approximate' in include:
+        data_kw['approximate'] = st_loc.checkbox(
+            'approximate unique counts (faster for large datasets)',
+            value=defaults.get( 'approximate', False ),
+        )
+        data_kw['relative_error'] = st_loc.number_input(
+            'typical relative error of approximate counts',
+            min_value=0.005,
+            max_value=0.25,
+            value=defaults.get( 'relative_error', 0.02 ),
+            step=0.005,
+            format='%.3f',
+        )
 
     return data_kw
 
 ################################################################################
 
+def get_font_directories():
+    '''The system font directories that matplotlib searches.
+
+    Returns:
+        font_dirs (list of strs): The directories that exist.
+    '''
+
+    if sys.platform == 'win32':
+        font_dirs = [ font_manager.win32FontDirectory(), ]
+    elif sys.platform == 'darwin':
+        font_dirs = font_manager.X11FontDirectories + font_manager.OSXFontDirectories
+    else:
+        font_dirs = font_manager.X11FontDirectories
+    font_dirs = [ _ for _ in font_dirs if os.path.isdir( _ ) ]
+
+    return font_dirs
+
+################################################################################
+
+def get_font_signature( font_dirs ):
+    '''Modification times of the font directories and their subdirectories,
+    which change when fonts are installed or removed.
+    Walking the directories is much cheaper than reading the fonts.
+
+    Args:
+        font_dirs (list of strs): The font directories.
+
+    Returns:
+        signature (list): [ directory, mtime ] pairs.
+    '''
+
+    signature = []
+    for font_dir in font_dirs:
+        for dirpath, dirnames, filenames in os.walk( font_dir ):
+            signature.append( [ dirpath, os.path.getmtime( dirpath ) ] )
+
+    return signature
+
+################################################################################
+
+def build_font_catalog():
+    '''Find the installed fonts and their names. Slow, so use get_font_catalog.
+
+    Returns:
+        font_catalog (dict): Contains
+            'signature': The font directory signature (see get_font_signature).
+            'font_fps': Font filepaths.
+            'fonts': Font filenames, for display.
+            'font_names': Font family names, for matplotlib.
+            'default_index': Index of the default sans-serif font.
+    '''
+
+    font_catalog = {
+        'signature': get_font_signature( get_font_directories() ),
+        'font_fps': [],
+        'fonts': [],
+        'font_names': [],
+    }
+
+    def add_font( font_fp ):
+        font_catalog['font_fps'].append( font_fp )
+        font_catalog['fonts'].append( os.path.splitext( os.path.basename( font_fp ) )[0] )
+        font_catalog['font_names'].append( font_manager.FontProperties( fname=font_fp ).get_name() )
+
+    ## Get all installed fonts
+    for font_fp in sorted( font_manager.findSystemFonts( fontpaths=None, fontext='ttf' ) ):
+        # Fonts that can't be read are left out
+        try:
+            add_font( font_fp )
+        except ( OSError, RuntimeError ):
+            continue
+
+    ## Get the default font
+    default_font_fp = font_manager.findfont( font_manager.FontProperties( family='Sans Serif' ) )
+    default_font = os.path.splitext( os.path.basename( default_font_fp ) )[0]
+    default_font_name = font_manager.FontProperties( fname=default_font_fp ).get_name()
+    if default_font_fp in font_catalog['font_fps']:
+        font_catalog['default_index'] = font_catalog['font_fps'].index( default_font_fp )
+    # Installed copies of the default font are also fine
+    elif default_font in font_catalog['fonts']:
+        font_catalog['default_index'] = font_catalog['fonts'].index( default_font )
+    elif default_font_name in font_catalog['font_names']:
+        font_catalog['default_index'] = font_catalog['font_names'].index( default_font_name )
+    else:
+        # E.g. the default font is bundled with matplotlib
+        add_font( default_font_fp )
+        font_catalog['default_index'] = len( font_catalog['font_fps'] ) - 1
+
+    return font_catalog
+
+################################################################################
+
+@st.cache_resource
+def get_font_catalog( catalog_fp=None ):
+    '''Get the catalog of installed fonts. Built once per process,
+    and if catalog_fp is given it's also saved there and reused by new processes
+    until the font directories change.
+
+    Args:
+        catalog_fp (str): Optional filepath for saving the catalog, as JSON.
+
+    Returns:
+        font_catalog (dict): See build_font_catalog.
+    '''
+
+    if catalog_fp is not None:
+        try:
+            with open( catalog_fp, 'r' ) as f:
+                font_catalog = json.load( f )
+            if font_catalog['signature'] == get_font_signature( get_font_directories() ):
+                return font_catalog
+        except ( OSError, ValueError, KeyError ):
+            pass
+
+    font_catalog = build_font_catalog()
+
+    if catalog_fp is not None:
+        # Written to a temporary file first so other processes never read a partial catalog
+        temp_fp = '{}.{}.tmp'.format( catalog_fp, os.getpid() )
+        try:
+            with open( temp_fp, 'w' ) as f:
+                json.dump( font_catalog, f )
+            os.replace( temp_fp, catalog_fp )
+        except OSError:
+            pass
+
+    return font_catalog
+
+################################################################################
+
 def setup_figure_settings(
         st_loc,
         defaults={},
         include=[
+            'renderer',
             'seaborn_style',
             'fig_width',
             'fig_height',
@@ -231,7 +389,8 @@ def setup_figure_settings(
             'font',
             'color_palette'
         ],
-        color_palette='deep'
+        color_palette='deep',
+        font_catalog_fp=None,
     ):
     '''Generic and common figure settings.
 
@@ -239,6 +398,7 @@ def setup_figure_settings(
         st_loc (streamlit object): Where to place the figure settings.
         tags (list): The categories that will be colored.
         config (dict): The config dictionary.
+        font_catalog_fp (str): Optional filepath for saving the font catalog (see get_font_catalog).
 
     Returns:
         plot_kw (dict): Generic figure settings.
@@ -249,6 +409,14 @@ def setup_figure_settings(
     # The figure size is doubled because this is a primarily horizontal plot
     fig_width *= 2.
     plot_kw = {}
+    if 'renderer' in include:
+        # Vega-Lite charts are drawn by the browser. Downloads always use matplotlib.
+        renderers = [ 'Vega-Lite', 'matplotlib' ]
+        plot_kw['renderer'] = st_loc.selectbox(
+            'draw figures with',
+            renderers,
+            index=renderers.index( defaults.get( 'renderer', 'Vega-Lite' ) ),
+        )
     if 'seaborn_style' in include:
         plot_kw['seaborn_style'] = st_loc.selectbox(
             'choose seaborn plot style',
@@ -334,22 +502,14 @@ def setup_figure_settings(
         original_font = copy.copy( plt.rcParams['font.family'] )[0]
         # This can be finicky, so we'll wrap it in a try/except
         try:
-            ## Get all installed fonts
-            font_fps = font_manager.findSystemFonts(fontpaths=None, fontext='ttf')
-            fonts = [ os.path.splitext( os.path.basename( _ ) )[0] for _ in font_fps ]
-            ## Get the default font
-            default_font = font_manager.FontProperties(family='Sans Serif')
-            default_font_fp = font_manager.findfont( default_font )
-            default_index = int( np.where( np.array( font_fps ) == default_font_fp )[0][0] )
-            ## Make the selection
+            font_catalog = get_font_catalog( font_catalog_fp )
             font_ind = st_loc.selectbox(
                 'Select font',
-                np.arange( len( fonts ) ),
-                index=default_index,
-                format_func=lambda x: fonts[x]
+                np.arange( len( font_catalog['fonts'] ) ),
+                index=font_catalog['default_index'],
+                format_func=lambda x: font_catalog['fonts'][x]
             )
-            font = font_manager.FontProperties( fname=font_fps[font_ind] )
-            plot_kw['font'] = font.get_name()
+            plot_kw['font'] = font_catalog['font_names'][font_ind]
         except:
             plot_kw['font'] = original_font
 
@@ -357,7 +517,7 @@ def setup_figure_settings(
 
 ################################################################################
 
-def get_tick_range_and_spacing( total, cumulative, ax_frac=0.1 ):
+def get_tick_range_and_spacing( total, cumulative=False, ax_frac=0.1 ):
     '''Solid defaults for ymax and the tick_spacing.
 
     Args:
@@ -366,7 +526,8 @@ def get_tick_range_and_spacing( total, cumulative, ax_frac=0.1 ):
         ax_frac (float): Fraction of axis between ticks.
 
     Returns:
-        ymax (float): The maximum y value.
+        ymax (float): The maximum y value. For values that can be negative,
+            e.g. changes, the maximum absolute y value.
         tick_spacing (float): The spacing between ticks.
     '''
 
@@ -374,7 +535,9 @@ def get_tick_range_and_spacing( total, cumulative, ax_frac=0.1 ):
     if cumulative:
         ymax = total.sum().max() * 1.05
     else:
-        ymax = total.values.max() * 1.05
+        ymax = np.nanmax( np.abs( total.values ), initial=0. ) * 1.05
+    if not ( ymax > 0 ):
+        ymax = 1.
 
     # Round the tick spacing to a nice number 
     unrounded_tick_spacing = ax_frac * ymax
@@ -394,6 +557,7 @@ def setup_filters(
         categorical_filter_defaults={},
         numerical_filter_defaults={},
         tag = '',
+        bridges = None,
     ):
     '''Request user input for the filters.
 
@@ -406,6 +570,8 @@ def setup_filters(
         include_numerical_filters (bool): If True, include the numerical filters.
         categorical_filter_defaults (dict): Default values for the categorical filters.
         numerical_filter_defaults (dict): Default values for the numerical filters.
+        bridges (dict of pd.DataFrames): Bridge tables for categorical columns
+            that are not columns of df (see data_utils.normalize_data).
 
     Returns:
         search_str (str): What to search the data for.
@@ -447,7 +613,10 @@ def setup_filters(
         )
         categorical_filter_instructions = {}
         for cat_filter_col in categorical_filter_columns:
-            possible_columns = pd.unique( df[cat_filter_col] )
+            if ( bridges is not None ) and ( cat_filter_col not in df.columns ):
+                possible_columns = list( pd.unique( bridges[cat_filter_col][cat_filter_col] ) )
+            else:
+                possible_columns = list( pd.unique( df[cat_filter_col] ) )
             categorical_filter_instructions[cat_filter_col] = {
                 'widget': 'multiselect',
                 'label': '"{}" Filter'.format( cat_filter_col ),
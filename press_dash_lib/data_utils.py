@@ -1,12 +1,17 @@
 '''General-purpose functions for relational data-analysis.
 Most functions should be useful for most relational datasets.
 '''
+import ast
+import collections
 import copy
+import hashlib
+import json
 import numpy as np
 import os
 import pandas as pd
 import re
 import streamlit as st
+import threading
 import yaml
 
 import matplotlib
@@ -15,6 +20,8 @@ import matplotlib.pyplot as plt
 import matplotlib.font_manager as font_manager
 import seaborn as sns
 
+from press_dash_lib import index_utils
+
 ################################################################################
 
 def get_year( date, start_of_year='January 1', years_min=None, years_max=None ):
@@ -50,11 +57,45 @@ def get_year( date, start_of_year='January 1', years_min=None, years_max=None ):
 
 ################################################################################
 
+def normalize_data( df, groupings, id_column='id', sep='|' ):
+    '''Split data with multiple categories per entry into one table of entries
+    plus one bridge table per grouping. Unlike exploding the data, the number of
+    rows scales with the number of tags, not with their product.
+
+    Args:
+        df (pd.DataFrame): One row per entry. Categories are joined by sep.
+        groupings (list of str): The columns containing categories.
+        id_column (str): The column containing the unique ID of each entry.
+        sep (str): The separator between categories.
+
+    Returns:
+        entries_df (pd.DataFrame): One row per entry, without the grouping columns.
+        bridges (dict of pd.DataFrames): For each grouping, one row per
+            (id, category) pair. Categories are dictionary-encoded.
+    '''
+
+    entries_df = df.drop( columns=groupings )
+
+    bridges = {}
+    for groupby_column in groupings:
+        bridge = df[[id_column, groupby_column]].copy()
+        bridge[groupby_column] = bridge[groupby_column].astype( str ).str.split( sep )
+        bridge = bridge.explode( groupby_column )
+        bridge = bridge.drop_duplicates().reset_index( drop=True )
+        bridge[groupby_column] = bridge[groupby_column].astype( 'category' )
+        bridges[groupby_column] = bridge
+
+    return entries_df, bridges
+
+################################################################################
+
 def recategorize_data(
         df,
         new_categories,
         recategorize=True,
-        combine_single_categories=False
+        combine_single_categories=False,
+        bridges=None,
+        data_versions=None,
     ):
     '''Recategorize the data, i.e. combine existing categories into new ones.
     The end result is one category per article, so no articles are double-counted.
@@ -65,6 +106,10 @@ def recategorize_data(
         df (pd.DataFrame): The dataframe containing the original data.
         new_categories (dict): The new categories to use.
         recategorize (bool): Whether to recategorize the data. Included for caching.
+        bridges (dict of pd.DataFrames): If given, df is one row per article and
+            the categories are read from these bridge tables (see normalize_data).
+        data_versions (dict of strs): Identifies the data per grouping (see get_data_versions).
+            Groupings without a version are hashed when recategorized.
 
     Returns:
         recategorized (pd.DataFrame): The dataframe containing the recategorized data.
@@ -80,23 +125,20 @@ def recategorize_data(
     recategorized = df.drop_duplicates( subset='id', keep='first' )
     recategorized.set_index( 'id', inplace=True )
 
-    for groupby_column, new_categories_per_grouping in new_categories.items():
+    for new_categories_key, new_categories_per_grouping in new_categories.items():
 
-        # Look for columns that are re-definitions of existing columns
-        # This regex looks for anything in front of anything else in brackets
-        search = re.findall( r'(.*?)\s\[(.+)\]', groupby_column )
-        if len( search ) == 0:
-            new_column = groupby_column
-        elif len( search ) == 1:
-            new_column, groupby_column = search[0]
-        else:
-            raise KeyError( 'New categories cannot have multiple sets of brackets.' )
+        new_column, groupby_column = parse_new_categories_key( new_categories_key )
 
-        recategorized_groupby = recategorize_data_per_grouping(
-            df,
+        if bridges is not None:
+            categories_df = bridges[groupby_column]
+        else:
+            categories_df = df
+        recategorized_groupby = cached_recategorize_data_per_grouping(
+            categories_df,
             groupby_column,
-            copy.deepcopy( new_categories_per_grouping ),
-            combine_single_categories
+            new_categories_per_grouping,
+            combine_single_categories,
+            data_version=None if data_versions is None else data_versions.get( groupby_column ),
         )
         recategorized[new_column] = recategorized_groupby
 
@@ -105,6 +147,137 @@ def recategorize_data(
 
 ################################################################################
 
+def parse_new_categories_key( new_categories_key ):
+    '''Parse a key of config['new_categories'], which is either an existing
+    column, e.g. 'Research Topics', or a new column followed by the existing
+    column in brackets, e.g. 'Also Research Topics [Research Topics]'.
+
+    Args:
+        new_categories_key (str): The key.
+
+    Returns:
+        new_column (str): The column the new categories are stored in.
+        groupby_column (str): The column containing the existing categories.
+    '''
+
+    # Look for columns that are re-definitions of existing columns
+    # This regex looks for anything in front of anything else in brackets
+    search = re.findall( r'(.*?)\s\[(.+)\]', new_categories_key )
+    if len( search ) == 0:
+        return new_categories_key, new_categories_key
+    elif len( search ) == 1:
+        return search[0]
+    else:
+        raise KeyError( 'New categories cannot have multiple sets of brackets.' )
+
+################################################################################
+
+def hash_new_categories( new_categories ):
+    '''Hash category definitions, e.g. to check if precomputed categories are stale.
+
+    Args:
+        new_categories (dict): The new categories, e.g. config['new_categories'],
+            or the definitions for a single grouping.
+
+    Returns:
+        new_categories_hash (str): Hex digest. Depends on the order of the keys,
+            because later definitions take precedence over earlier ones.
+    '''
+
+    return hashlib.sha1( json.dumps( new_categories ).encode() ).hexdigest()
+
+################################################################################
+
+def get_data_version( df, columns ):
+    '''Hash the contents of some columns, e.g. to key cached results on the data.
+
+    Args:
+        df (pd.DataFrame): The data.
+        columns (list of str): The columns to hash.
+
+    Returns:
+        data_version (str): Hex digest of the values, in order.
+    '''
+
+    row_hashes = pd.util.hash_pandas_object( df[columns], index=False ).values
+
+    return hashlib.sha1( row_hashes.tobytes() ).hexdigest()
+
+################################################################################
+
+def get_data_versions( df, groupby_columns, bridges=None ):
+    '''Version the categories of each grouping. Hashing is slow for large datasets,
+    so this is done once when the data is loaded and passed to recategorize_data.
+
+    Args:
+        df (pd.DataFrame): The data.
+        groupby_columns (list of str): The groupings, e.g. config['categorical_columns'].
+        bridges (dict of pd.DataFrames): If given, the categories are read from
+            these bridge tables (see normalize_data).
+
+    Returns:
+        data_versions (dict of strs): The version of the id and category columns, per grouping.
+    '''
+
+    data_versions = {}
+    for groupby_column in groupby_columns:
+        categories_df = df if bridges is None else bridges[groupby_column]
+        data_versions[groupby_column] = get_data_version( categories_df, [ 'id', groupby_column ] )
+
+    return data_versions
+
+################################################################################
+
+def hash_articles( df, bridges=None ):
+    '''Hash each article, including its categories in the bridge tables,
+    e.g. to find which articles changed between snapshots of the data.
+
+    Args:
+        df (pd.DataFrame): One row per article.
+        bridges (dict of pd.DataFrames): For each grouping, one row per (id, category) pair.
+
+    Returns:
+        hashes (pd.Series of uint64s): The hash of each article, indexed by id.
+    '''
+
+    hashes = pd.util.hash_pandas_object( df, index=False ).values.copy()
+    ids = pd.Index( df['id'] )
+
+    # Categories are combined without regard to order
+    if bridges is not None:
+        for i, ( groupby_column, bridge ) in enumerate( bridges.items() ):
+            bridge_hashes = pd.util.hash_pandas_object( bridge[['id', groupby_column]], index=False ).values
+            positions = ids.get_indexer( bridge['id'] )
+            is_article = positions >= 0
+            np.add.at( hashes, positions[is_article], bridge_hashes[is_article] * np.uint64( 2 * i + 3 ) )
+
+    return pd.Series( hashes, index=ids )
+
+################################################################################
+
+def get_article_delta( previous_hashes, hashes ):
+    '''Find which articles were added, changed, or removed between two snapshots.
+
+    Args:
+        previous_hashes (pd.Series): The output of hash_articles for the old snapshot.
+        hashes (pd.Series): The output of hash_articles for the new snapshot.
+
+    Returns:
+        changed_ids (pd.Index): The ids of articles that are new or changed.
+        removed_ids (pd.Index): The ids of articles that are no longer in the data.
+    '''
+
+    positions = previous_hashes.index.get_indexer( hashes.index )
+    is_changed = positions < 0
+    is_changed[~is_changed] = previous_hashes.values[positions[~is_changed]] != hashes.values[~is_changed]
+
+    changed_ids = hashes.index[is_changed]
+    removed_ids = previous_hashes.index[~previous_hashes.index.isin( hashes.index )]
+
+    return changed_ids, removed_ids
+
+################################################################################
+
 def recategorize_data_per_grouping(
         df,
         groupby_column,
@@ -122,61 +295,281 @@ def recategorize_data_per_grouping(
         recategorized (pd.Series): The new categories.
     '''
 
-    # Get the formatted data used for the categories
-    dummies = pd.get_dummies( df[groupby_column] )
-    dummies['id'] = df['id']
-    dummies_grouped = dummies.groupby( 'id' )
-    bools = dummies_grouped.sum() >= 1
-    n_cats = bools.sum( axis='columns' )
-    if bools.values.max() > 1:
-        raise ValueError(
-            'Categorization cannot proceed---' +
-            'At least one category shows up multiple times for a single ID.'
-        )
+    # Encode each ID's set of categories as a bitmask, and then only evaluate
+    # the definitions once per distinct combination of categories
+    bitmasks, ids, base_categories = encode_category_bitmasks( df['id'], df[groupby_column] )
+    combinations, combination_inds = unique_bitmasks( bitmasks )
+    bools_arr = decode_category_bitmasks( combinations, len( base_categories ) )
+    n_cats = bools_arr.sum( axis=1 )
 
     # Setup return arr
-    base_categories = bools.columns
     recategorized_dtype = np.array( new_categories_per_grouping.keys() ).dtype
-    recategorized = np.full( len(bools), fill_value='Other', dtype=recategorized_dtype )
-    recategorized = pd.Series( recategorized, index=bools.index, name=groupby_column )
+    recategorized = np.full( len( combinations ), fill_value='Other', dtype=recategorized_dtype )
 
     if not combine_single_categories:
         # Do all the single-category entries
         # These will be overridden if any are a subset of a new category
-        bools_singles = bools.loc[n_cats == 1]
-        for base_category in base_categories:
-            is_base_cat = bools_singles[base_category].values
-            recategorized.loc[bools_singles.index[is_base_cat]] = base_category
+        is_single = n_cats == 1
+        recategorized[is_single] = np.asarray( base_categories )[bools_arr[is_single].argmax( axis=1 )]
 
     # Loop through and do the recategorization
     for category_key, category_definition in new_categories_per_grouping.items():
-        # Replace the definition with something that can be evaluated
-        not_included_cats = []
-        for base_category in base_categories:
-            if base_category not in category_definition:
-                not_included_cats.append( base_category )
-                continue
-            category_definition = category_definition.replace(
-                "'{}'".format( base_category ),
-                "row['{}']".format( base_category )
-            )
-        # Handle the not-included categories
-        if 'only' in category_definition:
-            category_definition = (
-                '(' + category_definition + ') & ( not ( ' +
-                ' | '.join(
-                    [ "row['{}']".format( cat ) for cat in not_included_cats ]
-                ) + ' ) )'
-            )
-            category_definition = category_definition.replace( 'only', '' )
-        is_new_cat = bools.apply( lambda row: eval( category_definition ), axis='columns' )
+        is_new_cat = compile_category_definition( category_definition, base_categories )( bools_arr )
         recategorized[is_new_cat] = category_key
-        
-    return recategorized
+
+    # Scatter back to the IDs
+    recategorized = recategorized[combination_inds]
+
+    return pd.Series( recategorized, index=pd.Index( ids, name='id' ), name=groupby_column )
+
+################################################################################
+
+@st.cache_resource
+def get_recategorization_cache():
+    '''The cache used by cached_recategorize_data_per_grouping, shared between sessions.
+
+    Returns:
+        cache (dict): Contains
+            'entries': Recategorized series, least recently used first.
+            'lock': Guards the entries.
+    '''
+
+    cache = {
+        'entries': collections.OrderedDict(),
+        'lock': threading.Lock(),
+    }
+    return cache
+
+################################################################################
+
+def cached_recategorize_data_per_grouping(
+        df,
+        groupby_column,
+        new_categories_per_grouping,
+        combine_single_categories=False,
+        data_version=None,
+        max_entries=64,
+    ):
+    '''Cached recategorize_data_per_grouping. Entries are keyed by
+    (data version, grouping column, definition hash, combine_single_categories),
+    so editing the definitions for one grouping only recomputes that grouping.
+
+    Args:
+        df (pd.DataFrame): The dataframe containing the original data.
+        groupby_column (str): The category to group the data by, e.g. 'Research Topics'. 
+        new_categories_per_grouping (dict): The new categories to use for this specific grouping.
+        combine_single_categories (bool): Whether to put undefined categories in 'Other'.
+        data_version (str): Identifies the data. Defaults to a hash of the id and
+            groupby_column columns.
+        max_entries (int): Least-recently-used entries beyond this are evicted.
+
+    Returns:
+        recategorized (pd.Series): The new categories.
+    '''
+
+    if data_version is None:
+        data_version = get_data_version( df, [ 'id', groupby_column ] )
+    key = (
+        data_version,
+        groupby_column,
+        hash_new_categories( new_categories_per_grouping ),
+        combine_single_categories,
+    )
+
+    cache = get_recategorization_cache()
+    with cache['lock']:
+        result = cache['entries'].get( key )
+    if result is None:
+        result = recategorize_data_per_grouping(
+            df,
+            groupby_column,
+            copy.deepcopy( new_categories_per_grouping ),
+            combine_single_categories
+        )
+    with cache['lock']:
+        cache['entries'][key] = result
+        cache['entries'].move_to_end( key )
+        while len( cache['entries'] ) > max_entries:
+            cache['entries'].popitem( last=False )
+
+    return result.copy()
 
 ################################################################################
 
-def filter_data( df, search_str, search_col, categorical_filters, numerical_filters ):
+def encode_category_bitmasks( ids, categories ):
+    '''Encode the set of categories each ID has as a packed bitmask.
+
+    Args:
+        ids (pd.Series): The ID for each row, e.g. the 'id' column of a bridge table.
+        categories (pd.Series): The category for each row.
+
+    Returns:
+        bitmasks (np.ndarray of np.uint64, (n_ids, n_words)): Bit j of the bitmask
+            is set if the ID has category j. Words are 64 bits, so n_words is
+            1 unless there are more than 64 categories.
+        unique_ids (np.ndarray): The ID for each bitmask, sorted.
+        base_categories (pd.Index): The category for each bit.
+    '''
+
+    id_codes, unique_ids = pd.factorize( ids, sort=True )
+    if isinstance( categories.dtype, pd.CategoricalDtype ):
+        category_codes = categories.cat.codes.values
+        base_categories = categories.cat.categories
+    else:
+        category_codes, base_categories = pd.factorize( categories, sort=True )
+
+    # Missing categories are left unset
+    is_valid = category_codes >= 0
+    id_codes = id_codes[is_valid]
+    category_codes = category_codes[is_valid].astype( np.int64 )
+
+    n_words = max( 1, int( np.ceil( len( base_categories ) / 64 ) ) )
+    bitmasks = np.zeros( ( len( unique_ids ), n_words ), dtype=np.uint64 )
+    np.bitwise_or.at(
+        bitmasks,
+        ( id_codes, category_codes // 64 ),
+        np.left_shift( np.uint64( 1 ), ( category_codes % 64 ).astype( np.uint64 ) ),
+    )
+
+    return bitmasks, np.asarray( unique_ids ), base_categories
+
+################################################################################
+
+def unique_bitmasks( bitmasks ):
+    '''Find the distinct bitmasks.
+
+    Args:
+        bitmasks (np.ndarray of np.uint64, (n_ids, n_words)): The bitmasks.
+
+    Returns:
+        unique (np.ndarray of np.uint64, (n_unique, n_words)): The distinct bitmasks.
+        inverse (np.ndarray of int): For each ID, the index of its bitmask in unique.
+    '''
+
+    if bitmasks.shape[1] == 1:
+        unique, inverse = np.unique( bitmasks[:,0], return_inverse=True )
+        return unique[:,np.newaxis], inverse.reshape( -1 )
+
+    unique, inverse = np.unique( bitmasks, axis=0, return_inverse=True )
+    return unique, inverse.reshape( -1 )
+
+################################################################################
+
+def decode_category_bitmasks( bitmasks, n_categories ):
+    '''Unpack bitmasks into a dense boolean matrix.
+
+    Args:
+        bitmasks (np.ndarray of np.uint64, (n, n_words)): The bitmasks.
+        n_categories (int): Number of categories, i.e. bits used.
+
+    Returns:
+        bools (np.ndarray of bool, (n, n_categories)): True where the category is present.
+    '''
+
+    bits = np.arange( n_categories )
+    shifted = np.right_shift( bitmasks[:,bits // 64], ( bits % 64 ).astype( np.uint64 ) )
+
+    return ( shifted & np.uint64( 1 ) ).astype( bool )
+
+################################################################################
+
+# How the operators allowed in category definitions act on boolean arrays
+CATEGORY_DEFINITION_OPERATORS = {
+    ast.BitAnd: np.logical_and,
+    ast.BitOr: np.logical_or,
+    ast.BitXor: np.logical_xor,
+    ast.And: np.logical_and,
+    ast.Or: np.logical_or,
+    ast.Not: np.logical_not,
+    ast.Invert: np.logical_not,
+}
+
+def compile_category_definition( category_definition, base_categories ):
+    '''Compile a definition from config['new_categories'] once into a function
+    that evaluates it for every entry at the same time.
+
+    Args:
+        category_definition (str): The definition, e.g.
+            "only ('Galaxies & Cosmology' | 'Stellar Dynamics & Stellar Populations')".
+            Preceding the definition with 'only' excludes entries that have any
+            category not named in the definition.
+        base_categories (list of str): The existing categories, in the order of
+            the columns of the boolean matrix the compiled function acts on.
+
+    Returns:
+        kernel (function): Takes a boolean array of shape (n_entries, n_categories)
+            and returns a boolean array of shape (n_entries,).
+    '''
+
+    column_inds = { category: j for j, category in enumerate( base_categories ) }
+
+    search = re.match( r'\s*only\b(.*)', category_definition, flags=re.DOTALL )
+    if search is not None:
+        category_definition = search.group( 1 )
+    try:
+        tree = ast.parse( category_definition.strip(), mode='eval' )
+    except SyntaxError as e:
+        raise ValueError( 'Could not parse category definition: {}'.format( category_definition ) ) from e
+
+    named_categories = set()
+    def compile_node( node ):
+
+        # A category name is the corresponding column.
+        # Categories that don't show up in the data are never present.
+        if isinstance( node, ast.Constant ) and isinstance( node.value, str ):
+            named_categories.add( node.value )
+            if node.value not in column_inds:
+                return lambda bools: np.zeros( len( bools ), dtype=bool )
+            j = column_inds[node.value]
+            return lambda bools: bools[:,j]
+
+        elif isinstance( node, ast.UnaryOp ) and type( node.op ) in CATEGORY_DEFINITION_OPERATORS:
+            op = CATEGORY_DEFINITION_OPERATORS[type( node.op )]
+            operand = compile_node( node.operand )
+            return lambda bools: op( operand( bools ) )
+
+        elif isinstance( node, ast.BinOp ) and type( node.op ) in CATEGORY_DEFINITION_OPERATORS:
+            op = CATEGORY_DEFINITION_OPERATORS[type( node.op )]
+            left, right = compile_node( node.left ), compile_node( node.right )
+            return lambda bools: op( left( bools ), right( bools ) )
+
+        elif isinstance( node, ast.BoolOp ):
+            op = CATEGORY_DEFINITION_OPERATORS[type( node.op )]
+            operands = [ compile_node( _ ) for _ in node.values ]
+            return lambda bools: op.reduce( [ operand( bools ) for operand in operands ] )
+
+        raise ValueError(
+            'Unsupported expression in category definition "{}": {}'.format(
+                category_definition,
+                ast.unparse( node ),
+            )
+        )
+    kernel = compile_node( tree.body )
+
+    # Handle the not-included categories
+    if search is not None:
+        not_included_inds = [
+            j for category, j in column_inds.items()
+            if category not in named_categories
+        ]
+        definition_kernel = kernel
+        kernel = lambda bools: (
+            definition_kernel( bools ) &
+            np.invert( bools[:,not_included_inds].any( axis=1 ) )
+        )
+
+    return kernel
+
+################################################################################
+
+def filter_data(
+        df,
+        search_str,
+        search_col,
+        categorical_filters,
+        numerical_filters,
+        indexes=None,
+    ):
     '''Filter what data shows up in the dashboard.
 
     Args:
@@ -185,11 +578,24 @@ def filter_data( df, search_str, search_col, categorical_filters, numerical_filt
         search_col (str): What column to search
         categorical_filters (dict): How categories are filtered.
         numerical_filters (dict): Ranges for numerical data filters
+        indexes (dict): Indexes for the rows of df (see index_utils.build_indexes).
+            Used in place of scanning the corresponding columns.
 
     Returns:
         selected_df (pd.DataFrame): The dataframe containing the selected data.
     '''
 
+    if indexes is not None:
+        selected_rows = index_utils.select_rows(
+            df,
+            search_str,
+            search_col,
+            categorical_filters,
+            numerical_filters,
+            indexes,
+        )
+        return df.iloc[selected_rows]
+
     # # Search filter
     if search_str != '':
         is_included = df[search_col].str.extract( '(' + search_str + ')', flags=re.IGNORECASE ).notna().values[:,0]
@@ -208,4 +614,72 @@ def filter_data( df, search_str, search_col, categorical_filters, numerical_filt
         )
 
     selected_df = df.loc[is_included]
-    return selected_df
\ No newline at end of file
+    return selected_df
+
+################################################################################
+
+def filter_normalized_data(
+        df,
+        bridges,
+        search_str,
+        search_col,
+        categorical_filters,
+        numerical_filters,
+        indexes=None,
+    ):
+    '''Filter normalized data, i.e. one row per article plus bridge tables.
+    An article passes a categorical filter on a bridged grouping if any of its
+    categories are selected, matching what filter_data does for exploded data.
+
+    Args:
+        df (pd.DataFrame): The dataframe containing one row per article.
+        bridges (dict of pd.DataFrames): For each grouping, one row per (id, category) pair.
+        search_str (str): What to search the data for.
+        search_col (str): What column to search
+        categorical_filters (dict): How categories are filtered.
+        numerical_filters (dict): Ranges for numerical data filters
+        indexes (dict): Indexes for the rows of df (see index_utils.build_indexes).
+
+    Returns:
+        selected_df (pd.DataFrame): The selected articles.
+        selected_bridges (dict of pd.DataFrames): The selected (id, category) pairs.
+    '''
+
+    categorical_indexes = {} if indexes is None else indexes.get( 'categorical', {} )
+
+    # Filters on the columns of the article table.
+    # Bridged groupings with a bitmap index are filtered here too.
+    is_bridged = lambda column: ( column in bridges ) and ( column not in df.columns )
+    article_filters = {
+        column: selected_cats
+        for column, selected_cats in categorical_filters.items()
+        if not is_bridged( column ) or ( column in categorical_indexes )
+    }
+    selected_df = filter_data( df, search_str, search_col, article_filters, numerical_filters, indexes=indexes )
+
+    # Filters on the bridge tables
+    is_selected_cat = {}
+    for cat_filter_col, selected_cats in categorical_filters.items():
+        if not is_bridged( cat_filter_col ):
+            continue
+        if cat_filter_col in categorical_indexes:
+            bitmap_index = categorical_indexes[cat_filter_col]
+            is_selected_cat[cat_filter_col] = np.isin(
+                bitmap_index['codes'],
+                index_utils.get_category_codes( bitmap_index, selected_cats ),
+            )
+            continue
+        bridge = bridges[cat_filter_col]
+        is_selected_cat[cat_filter_col] = bridge[cat_filter_col].isin( selected_cats ).values
+        ids_with_cats = bridge.loc[is_selected_cat[cat_filter_col],'id']
+        selected_df = selected_df.loc[selected_df['id'].isin( ids_with_cats )]
+
+    # Restrict the bridge tables to the selection
+    selected_bridges = {}
+    for groupby_column, bridge in bridges.items():
+        is_included = bridge['id'].isin( selected_df['id'] ).values
+        if groupby_column in is_selected_cat:
+            is_included &= is_selected_cat[groupby_column]
+        selected_bridges[groupby_column] = bridge.loc[is_included]
+
+    return selected_df, selected_bridges
\ No newline at end of file
@@ -0,0 +1,646 @@
+'''Indexes for filtering relational data without scanning every row.
+Indexes are built once when the data is loaded, and refer to rows by position,
+so they apply to any dataframe with the same rows in the same order.
+'''
+import collections
+import numpy as np
+import pandas as pd
+import re
+import threading
+
+# Narrowing regex searches down with the trigram index relies on the internals
+# of the re module, i.e. its parser and case folding, which can change between
+# Python versions. Without them every unique value is checked against the regex.
+try:
+    import _sre
+    from re import _casefix, _parser as sre_parse
+    HAS_REGEX_INTERNALS = all( [
+        hasattr( _sre, 'unicode_tolower' ),
+        isinstance( getattr( _casefix, '_EXTRA_CASES', None ), dict ),
+        all( hasattr( sre_parse, _ ) for _ in [ 'parse', 'LITERAL', 'SUBPATTERN', 'MAX_REPEAT', 'MIN_REPEAT' ] ),
+    ] )
+except ImportError:
+    HAS_REGEX_INTERNALS = False
+
+################################################################################
+
+def build_indexes( df, config, bridges=None ):
+    '''Build the indexes used by data_utils.filter_data.
+
+    Args:
+        df (pd.DataFrame): The data, one row per article.
+        config (dict): The config dictionary.
+        bridges (dict of pd.DataFrames): Bridge tables for groupings that are
+            not columns of df (see data_utils.normalize_data).
+
+    Returns:
+        indexes (dict): For each kind of index, a dictionary of indexes per column.
+    '''
+
+    indexes = {
+        'text': {
+            text_column: build_trigram_index( df[text_column] )
+            for text_column in config['text_columns']
+            if text_column in df.columns
+        },
+        'categorical': build_categorical_indexes( df, config, bridges ),
+        'numerical': {
+            numerical_column: build_sorted_index( df[numerical_column] )
+            for numerical_column in config['weight_columns'] + config['year_columns']
+            if numerical_column in df.columns
+        },
+    }
+
+    return indexes
+
+################################################################################
+
+def build_categorical_indexes( df, config, bridges=None ):
+    '''Build a bitmap index for each categorical column.
+    These depend on the recategorization, so they can be rebuilt separately.
+
+    Args:
+        df (pd.DataFrame): The data, one row per article.
+        config (dict): The config dictionary.
+        bridges (dict of pd.DataFrames): Bridge tables for groupings that are
+            not columns of df (see data_utils.normalize_data).
+
+    Returns:
+        categorical_indexes (dict): The bitmap index for each column.
+    '''
+
+    categorical_indexes = {}
+    for categorical_column in config['categorical_columns']:
+        if categorical_column in df.columns:
+            categorical_indexes[categorical_column] = build_bitmap_index( df[categorical_column] )
+        elif ( bridges is not None ) and ( categorical_column in bridges ):
+            bridge = bridges[categorical_column]
+
+            # Bridge rows for articles not in df have no position
+            rows = pd.Index( df['id'] ).get_indexer( bridge['id'] )
+            in_df = rows >= 0
+            categorical_indexes[categorical_column] = build_bitmap_index(
+                bridge[categorical_column][in_df],
+                n_rows=len( df ),
+                rows=rows[in_df],
+            )
+
+    return categorical_indexes
+
+################################################################################
+
+def select_rows(
+        df,
+        search_str,
+        search_col,
+        categorical_filters,
+        numerical_filters,
+        indexes,
+    ):
+    '''Find the rows that pass the filters, as for data_utils.filter_data.
+    The selection is kept as a bitmap, and columns without an index are scanned.
+    The bitmaps for indexed search and categorical filters are cached with
+    their index, so changing one filter only recomputes that filter's bitmap.
+    Indexed range filters give the rows in the range directly, so only those
+    rows are checked against the other filters.
+
+    Args:
+        df (pd.DataFrame): The dataframe containing the data.
+        search_str (str): What to search the data for.
+        search_col (str): What column to search
+        categorical_filters (dict): How categories are filtered.
+        numerical_filters (dict): Ranges for numerical data filters
+        indexes (dict): Indexes for the rows of df (see build_indexes).
+
+    Returns:
+        selected_rows (np.ndarray of ints): Sorted positions of the selected rows.
+    '''
+
+    n_rows = len( df )
+    selected = get_full_bitmap( n_rows )
+
+    # Search filter
+    if search_str != '':
+        if search_col in indexes.get( 'text', {} ):
+            trigram_index = indexes['text'][search_col]
+            selected &= get_cached_bitmap(
+                trigram_index,
+                search_str,
+                lambda: rows_to_bitmap( search_trigram_index( trigram_index, search_str ), n_rows ),
+            )
+        else:
+            is_included = df[search_col].str.extract( '(' + search_str + ')', flags=re.IGNORECASE ).notna().values[:,0]
+            selected &= pack_mask( is_included )
+
+    # Categories filter
+    for cat_filter_col, selected_cats in categorical_filters.items():
+        if cat_filter_col in indexes.get( 'categorical', {} ):
+            bitmap_index = indexes['categorical'][cat_filter_col]
+            selected &= get_cached_bitmap(
+                bitmap_index,
+                tuple( get_category_codes( bitmap_index, selected_cats ) ),
+                lambda: query_bitmap_index( bitmap_index, selected_cats ),
+            )
+        else:
+            selected &= pack_mask( df[cat_filter_col].isin( selected_cats ).values )
+
+    # Range filters
+    numerical_indexes = indexes.get( 'numerical', {} )
+    ranges = {}
+    for num_filter_col, column_range in numerical_filters.items():
+        if num_filter_col in numerical_indexes:
+            ranges[num_filter_col] = query_sorted_index( numerical_indexes[num_filter_col], column_range )
+            continue
+        is_included = (
+            ( column_range[0] <= df[num_filter_col] ) &
+            ( df[num_filter_col] <= column_range[1] )
+        )
+        selected &= pack_mask( is_included.to_numpy( dtype=bool, na_value=False ) )
+
+    if len( ranges ) == 0:
+        return bitmap_to_rows( selected, n_rows )
+
+    # Start from the rows in the narrowest range, and check them against the rest
+    narrowest_col = min( ranges, key=lambda column: ranges[column][1] - ranges[column][0] )
+    start, end = ranges[narrowest_col]
+    rows = numerical_indexes[narrowest_col]['order'][start:end]
+    for num_filter_col, column_range in numerical_filters.items():
+        if ( num_filter_col == narrowest_col ) or ( num_filter_col not in ranges ):
+            continue
+        values = numerical_indexes[num_filter_col]['values'][rows]
+        rows = rows[( column_range[0] <= values ) & ( values <= column_range[1] )]
+    rows = rows[check_bits( selected, rows )]
+
+    return np.sort( rows )
+
+################################################################################
+
+def get_cached_bitmap( index, key, compute_bitmap, max_entries=16 ):
+    '''Get a bitmap from the cache kept with an index, computing it if needed.
+    The least recently used bitmaps are evicted.
+
+    Args:
+        index (dict): The index, containing a 'cache' and its 'lock'.
+        key (hashable): Identifies the bitmap, e.g. the search string.
+        compute_bitmap (function): Computes the bitmap if it isn't cached.
+        max_entries (int): Maximum number of bitmaps to keep.
+
+    Returns:
+        bitmap (np.ndarray of uint64): The bitmap. Should not be modified.
+    '''
+
+    cache = index['cache']
+    with index['lock']:
+        bitmap = cache.get( key )
+    if bitmap is None:
+        bitmap = compute_bitmap()
+    with index['lock']:
+        cache[key] = bitmap
+        cache.move_to_end( key )
+        while len( cache ) > max_entries:
+            cache.popitem( last=False )
+
+    return bitmap
+
+################################################################################
+# Text
+################################################################################
+
+def get_case_folding_table( chars ):
+    '''Map characters to a single representative of the characters they match
+    in a case-insensitive regex, for use with str.translate.
+
+    Args:
+        chars (iterable of str): The characters to map.
+
+    Returns:
+        table (dict): Code point of each character to the code point of its representative.
+    '''
+
+    table = {}
+    for char in chars:
+        lower = _sre.unicode_tolower( ord( char ) )
+        table[ord( char )] = min( ( lower, ) + tuple( _casefix._EXTRA_CASES.get( lower, () ) ) )
+
+    return table
+
+################################################################################
+
+def encode_trigrams( values ):
+    '''Encode the distinct trigrams of each string as integers,
+    using 21 bits per character (enough for any unicode code point).
+
+    Args:
+        values (list of str): The strings. Should already be case folded.
+
+    Returns:
+        keys (np.ndarray of int64): The encoded trigrams, sorted.
+        value_codes (np.ndarray of int64): Which string each trigram is in.
+            Sorted within each key.
+    '''
+
+    lengths = np.array( [ len( value ) for value in values ], dtype=np.int64 )
+    chars = np.frombuffer( ''.join( values ).encode( 'utf-32-le' ), dtype=np.uint32 ).astype( np.int64 )
+    value_of_char = np.repeat( np.arange( len( values ) ), lengths )
+
+    # Trigrams that don't cross from one string into the next
+    keys = ( chars[:-2] << 42 ) | ( chars[1:-1] << 21 ) | chars[2:]
+    is_valid = value_of_char[:-2] == value_of_char[2:]
+    keys = keys[is_valid]
+    value_codes = value_of_char[:-2][is_valid]
+
+    # Sort and drop duplicates. Replacing the keys with their rank lets each
+    # (key, value code) pair fit in one integer, which is much faster to sort.
+    dense_keys, unique_keys = pd.factorize( keys, sort=True )
+    n_values = max( len( values ), 1 )
+    pairs = np.unique( dense_keys.astype( np.int64 ) * n_values + value_codes )
+
+    return unique_keys[pairs // n_values], pairs % n_values
+
+################################################################################
+
+def build_trigram_index( values ):
+    '''Build a trigram index over a text column.
+    Trigrams are collected per unique value, so repeated text is only indexed once.
+    Without the internals of the re module (see HAS_REGEX_INTERNALS) no trigrams are collected.
+
+    Args:
+        values (pd.Series): The text column.
+
+    Returns:
+        trigram_index (dict): Contains
+            'values': The unique string values.
+            'trigrams', 'postings', and 'posting_offsets': The codes of the unique
+                values containing trigrams[i] are postings[posting_offsets[i]:posting_offsets[i+1]].
+            'row_order' and 'row_offsets': The rows for unique value i are
+                row_order[row_offsets[i]:row_offsets[i+1]].
+            'cache': Bitmaps of previous searches (see get_cached_bitmap).
+            'lock': Guards the cache, which is shared between sessions.
+    '''
+
+    # Only strings can be searched. Everything else gets the code -1.
+    is_str = values.map( lambda value: isinstance( value, str ) ).values.astype( bool )
+    codes = np.full( len( values ), -1, dtype=np.int64 )
+    codes[is_str], unique_values = pd.factorize( values[is_str] )
+    unique_values = np.asarray( unique_values, dtype=object )
+
+    # Posting lists, concatenated
+    if HAS_REGEX_INTERNALS:
+        table = get_case_folding_table( set( ''.join( unique_values ) ) )
+        keys, postings = encode_trigrams( [ value.translate( table ) for value in unique_values ] )
+    else:
+        keys, postings = encode_trigrams( [] )
+    trigrams, posting_starts = np.unique( keys, return_index=True )
+    posting_offsets = np.append( posting_starts, len( keys ) )
+
+    # Group the rows by unique value
+    row_order = np.argsort( codes, kind='stable' )[( codes == -1 ).sum():]
+    row_offsets = np.zeros( len( unique_values ) + 1, dtype=np.int64 )
+    row_offsets[1:] = np.cumsum( np.bincount( codes[is_str], minlength=len( unique_values ) ) )
+
+    trigram_index = {
+        'values': unique_values,
+        'trigrams': trigrams,
+        'postings': postings,
+        'posting_offsets': posting_offsets,
+        'row_order': row_order,
+        'row_offsets': row_offsets,
+        'cache': collections.OrderedDict(),
+        'lock': threading.Lock(),
+    }
+    return trigram_index
+
+################################################################################
+
+def get_required_literals( parsed ):
+    '''Find runs of literal characters that every match of a regex must contain.
+
+    Args:
+        parsed (sre_parse.SubPattern or list): The parsed regex.
+
+    Returns:
+        literals (list of str): The literal runs.
+    '''
+
+    literals = []
+    run = ''
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            run += chr( av )
+            continue
+
+        literals.append( run )
+        run = ''
+        if op is sre_parse.SUBPATTERN:
+            literals += get_required_literals( av[-1] )
+        elif op in ( sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT ) and av[0] >= 1:
+            literals += get_required_literals( av[-1] )
+    literals.append( run )
+
+    return [ literal for literal in literals if literal != '' ]
+
+################################################################################
+
+def get_required_trigrams( search_str ):
+    '''Encode the trigrams that every match of a case-insensitive regex must contain.
+
+    Args:
+        search_str (str): The regex.
+
+    Returns:
+        keys (np.ndarray of int64): The encoded, case-folded trigrams (see encode_trigrams).
+            None if the regex can't be analyzed, in which case any value can match.
+    '''
+
+    if not HAS_REGEX_INTERNALS:
+        return None
+
+    # The parser's output is internal, so anything unexpected falls back to checking every value
+    try:
+        literals = get_required_literals( sre_parse.parse( search_str ) )
+        table = get_case_folding_table( set( ''.join( literals ) ) )
+        keys, _ = encode_trigrams( [ literal.translate( table ) for literal in literals ] )
+    except Exception:
+        return None
+
+    return np.unique( keys )
+
+################################################################################
+
+def search_trigram_index( trigram_index, search_str ):
+    '''Find the rows matching a case-insensitive regex search,
+    with the same results as Series.str.extract( '(' + search_str + ')', flags=re.IGNORECASE ).
+    Only the unique values containing every trigram of the literal parts of the
+    regex are checked against the regex (see get_required_trigrams).
+
+    Args:
+        trigram_index (dict): The output of build_trigram_index.
+        search_str (str): The regex to search for.
+
+    Returns:
+        rows (np.ndarray of ints): Sorted positions of the matching rows.
+    '''
+
+    pattern = re.compile( '(' + search_str + ')', flags=re.IGNORECASE )
+    keys = get_required_trigrams( search_str )
+
+    # Narrow down to the values containing all the trigrams
+    candidates = np.arange( len( trigram_index['values'] ) )
+    if keys is None:
+        keys = []
+    trigrams = trigram_index['trigrams']
+    for key in keys:
+        i = np.searchsorted( trigrams, key )
+        if ( i == len( trigrams ) ) or ( trigrams[i] != key ):
+            candidates = candidates[:0]
+            break
+        start, end = trigram_index['posting_offsets'][i:i+2]
+        candidates = np.intersect1d( candidates, trigram_index['postings'][start:end], assume_unique=True )
+
+    # Verify the candidates
+    values = trigram_index['values']
+    matched = np.array(
+        [ i for i in candidates if pattern.search( values[i] ) is not None ],
+        dtype=np.int64,
+    )
+
+    # Expand to rows
+    starts = trigram_index['row_offsets'][matched]
+    lengths = trigram_index['row_offsets'][matched + 1] - starts
+    positions = np.repeat( starts - np.cumsum( lengths ) + lengths, lengths ) + np.arange( lengths.sum() )
+    rows = np.sort( trigram_index['row_order'][positions] )
+
+    return rows
+
+################################################################################
+# Bitmaps
+################################################################################
+
+def get_empty_bitmap( n_rows ):
+    '''A bitmap with no rows set. Row i is bit i % 64 of word i // 64.
+
+    Args:
+        n_rows (int): Number of rows.
+
+    Returns:
+        bitmap (np.ndarray of uint64): The bitmap.
+    '''
+
+    return np.zeros( ( n_rows + 63 ) // 64, dtype=np.uint64 )
+
+################################################################################
+
+def get_full_bitmap( n_rows ):
+    '''A bitmap with every row set.
+
+    Args:
+        n_rows (int): Number of rows.
+
+    Returns:
+        bitmap (np.ndarray of uint64): The bitmap.
+    '''
+
+    return pack_mask( np.ones( n_rows, dtype=bool ) )
+
+################################################################################
+
+def pack_mask( mask ):
+    '''Convert a boolean mask to a bitmap.
+
+    Args:
+        mask (np.ndarray of bools): The mask.
+
+    Returns:
+        bitmap (np.ndarray of uint64): The bitmap.
+    '''
+
+    packed = np.zeros( len( get_empty_bitmap( len( mask ) ) ) * 8, dtype=np.uint8 )
+    packed[:( len( mask ) + 7 ) // 8] = np.packbits( mask, bitorder='little' )
+
+    return packed.view( '<u8' ).astype( np.uint64 )
+
+################################################################################
+
+def rows_to_bitmap( rows, n_rows ):
+    '''Convert row positions to a bitmap.
+
+    Args:
+        rows (np.ndarray of ints): The row positions.
+        n_rows (int): Number of rows.
+
+    Returns:
+        bitmap (np.ndarray of uint64): The bitmap.
+    '''
+
+    bitmap = get_empty_bitmap( n_rows )
+    np.bitwise_or.at( bitmap, rows >> 6, np.left_shift( np.uint64( 1 ), ( rows & 63 ).astype( np.uint64 ) ) )
+
+    return bitmap
+
+################################################################################
+
+def bitmap_to_rows( bitmap, n_rows ):
+    '''Convert a bitmap to row positions. Only the nonzero words are expanded.
+
+    Args:
+        bitmap (np.ndarray of uint64): The bitmap.
+        n_rows (int): Number of rows.
+
+    Returns:
+        rows (np.ndarray of ints): Sorted positions of the rows that are set.
+    '''
+
+    words = np.flatnonzero( bitmap )
+    bits = np.unpackbits(
+        bitmap[words].astype( '<u8' ).view( np.uint8 ),
+        bitorder='little',
+    ).reshape( len( words ), 64 )
+    word_positions, bit_positions = np.nonzero( bits )
+
+    return words[word_positions] * 64 + bit_positions
+
+################################################################################
+
+def check_bits( bitmap, rows ):
+    '''Check which rows are set in a bitmap, without expanding the bitmap.
+
+    Args:
+        bitmap (np.ndarray of uint64): The bitmap.
+        rows (np.ndarray of ints): The row positions to check.
+
+    Returns:
+        is_set (np.ndarray of bools): Whether each row is set.
+    '''
+
+    bits = bitmap[rows >> 6] >> ( rows & 63 ).astype( np.uint64 )
+
+    return ( bits & np.uint64( 1 ) ).astype( bool )
+
+################################################################################
+
+def build_bitmap_index( values, n_rows=None, rows=None ):
+    '''Build a bitmap index, i.e. one bitmap per category.
+    The bitmaps are uncompressed, which is compact for the few categories per
+    column typical of the categorical columns.
+
+    Args:
+        values (pd.Series): The category of each row, or of each (row, category) pair.
+        n_rows (int): Number of rows. Defaults to len( values ).
+        rows (np.ndarray of ints): The row of each value, if there can be multiple
+            values per row, e.g. for a bridge table.
+
+    Returns:
+        bitmap_index (dict): Contains
+            'categories': The categories.
+            'bitmaps': The bitmap for each category, shape (n_categories, n_words).
+            'codes' and 'rows': The category code and row of each value.
+            'cache': Bitmaps of previous selections (see get_cached_bitmap).
+            'lock': Guards the cache, which is shared between sessions.
+    '''
+
+    if n_rows is None:
+        n_rows = len( values )
+    if rows is None:
+        rows = np.arange( len( values ) )
+    rows = np.asarray( rows, dtype=np.int64 )
+
+    codes, categories = pd.factorize( values, use_na_sentinel=False )
+    categories = pd.Index( np.asarray( categories, dtype=object ) )
+
+    bitmaps = np.zeros( ( len( categories ), len( get_empty_bitmap( n_rows ) ) ), dtype=np.uint64 )
+    np.bitwise_or.at(
+        bitmaps,
+        ( codes, rows >> 6 ),
+        np.left_shift( np.uint64( 1 ), ( rows & 63 ).astype( np.uint64 ) ),
+    )
+
+    bitmap_index = {
+        'categories': categories,
+        'bitmaps': bitmaps,
+        'codes': codes,
+        'rows': rows,
+        'cache': collections.OrderedDict(),
+        'lock': threading.Lock(),
+    }
+    return bitmap_index
+
+################################################################################
+
+def get_category_codes( bitmap_index, selected_cats ):
+    '''Get the codes of the selected categories. Categories not in the index are ignored.
+
+    Args:
+        bitmap_index (dict): The output of build_bitmap_index.
+        selected_cats (list): The selected categories.
+
+    Returns:
+        codes (np.ndarray of ints): The codes.
+    '''
+
+    codes = bitmap_index['categories'].get_indexer( pd.Index( list( selected_cats ), dtype=object ) )
+
+    return np.unique( codes[codes >= 0] )
+
+################################################################################
+
+def query_bitmap_index( bitmap_index, selected_cats ):
+    '''Find the rows with any of the selected categories, as a bitmap.
+
+    Args:
+        bitmap_index (dict): The output of build_bitmap_index.
+        selected_cats (list): The selected categories.
+
+    Returns:
+        bitmap (np.ndarray of uint64): The union of the bitmaps of the selected categories.
+    '''
+
+    codes = get_category_codes( bitmap_index, selected_cats )
+    if len( codes ) == 0:
+        return np.zeros( bitmap_index['bitmaps'].shape[1], dtype=np.uint64 )
+
+    return np.bitwise_or.reduce( bitmap_index['bitmaps'][codes], axis=0 )
+
+################################################################################
+# Numbers
+################################################################################
+
+def build_sorted_index( values ):
+    '''Build a sorted index, i.e. the rows in order of their values.
+
+    Args:
+        values (pd.Series): The numerical column.
+
+    Returns:
+        sorted_index (dict): Contains
+            'values': The values as floats, with missing values as NaN.
+            'order': The rows sorted by value. Missing values are last.
+            'sorted_values': values[order].
+    '''
+
+    values = values.to_numpy( dtype=float, na_value=np.nan )
+    order = np.argsort( values, kind='stable' )
+
+    sorted_index = {
+        'values': values,
+        'order': order,
+        'sorted_values': values[order],
+    }
+    return sorted_index
+
+################################################################################
+
+def query_sorted_index( sorted_index, column_range ):
+    '''Find the rows with values in a range, inclusive.
+
+    Args:
+        sorted_index (dict): The output of build_sorted_index.
+        column_range (list): The lower and upper bounds.
+
+    Returns:
+        start, end (int): The rows in the range are sorted_index['order'][start:end].
+    '''
+
+    start = np.searchsorted( sorted_index['sorted_values'], column_range[0], side='left' )
+    end = np.searchsorted( sorted_index['sorted_values'], column_range[1], side='right' )
+
+    return start, max( start, end )
@@ -18,11 +18,11 @@ import matplotlib.font_manager as font_manager
 import seaborn as sns
 
 # Import the custom library.
-from press_dash_lib import user_utils, dash_utils, data_utils, time_series_utils
+from press_dash_lib import user_utils, dash_utils, data_utils, index_utils, time_series_utils
 
 # Streamlit works by repeatedly rerunning the code,
 # so if we want to propogate changes to the library we need to reload it.
-for module_to_reload in [ user_utils, dash_utils, data_utils, time_series_utils ]:
+for module_to_reload in [ user_utils, dash_utils, index_utils, data_utils, time_series_utils ]:
     importlib.reload( module_to_reload )
 
 def main( config_fp ):
@@ -44,10 +44,22 @@ def main( config_fp ):
     # Load data
     ################################################################################
 
-    df = st.cache_data( user_utils.load_data )( config )
+    # The data is kept as one row per article plus one bridge table per grouping.
+    # Use the typed columnar store when the pipeline has produced an up-to-date one
+    if user_utils.processed_data_is_current( config, tag='articles' ):
+        preprocessed_df, bridges = st.cache_data( user_utils.load_normalized_processed_data )( config )
+    else:
+        df = st.cache_data( user_utils.load_data )( config )
 
-    # Do general preprocessing
-    preprocessed_df, config = st.cache_data( user_utils.preprocess_data )( df, config )
+        # Do general preprocessing
+        preprocessed_df, bridges, config = st.cache_data( user_utils.preprocess_normalized_data )( df, config )
+
+    # Identifies the categories of each grouping, so cached recategorizations don't rehash the data
+    data_versions = st.cache_data( data_utils.get_data_versions )( preprocessed_df, config['categorical_columns'], bridges )
+
+    # Indexes used for filtering, so the filters don't need to scan every row.
+    # These are held as a resource, i.e. built once per dataset and not copied on each rerun.
+    indexes = st.cache_resource( index_utils.build_indexes )( preprocessed_df, config, bridges )
 
     ################################################################################
     # Set up global settings
@@ -65,7 +77,11 @@ def main( config_fp ):
 
     # Global figure settings
     st.sidebar.markdown( '# Figure Settings' )
-    global_plot_kw = dash_utils.setup_figure_settings( st.sidebar, color_palette=config['color_palette'] )
+    global_plot_kw = dash_utils.setup_figure_settings(
+        st.sidebar,
+        color_palette=config['color_palette'],
+        font_catalog_fp=config.get( 'font_catalog_fp' ),
+    )
 
     ################################################################################
     # Actual analysis
@@ -105,21 +121,48 @@ def main( config_fp ):
         index=0, # CUSTOMIZE
         key='{}:year_column'.format( tag ),
     )
+    data_kw['granularity'] = st.selectbox(
+        'What time bins do you want to use?',
+        [ 'Year', 'Quarter', 'Month', 'Week' ], # CUSTOMIZE
+        index=0, # CUSTOMIZE
+        key='{}:granularity'.format( tag ),
+    )
     data_kw['groupby_column'] = st.selectbox(
         'What do you want to group the data by?',
         config['categorical_columns'], # CUSTOMIZE
         index=0, # CUSTOMIZE
         key='{}:groupby_column'.format( tag ),
     )
+    data_kw['cross_tab_column'] = st.selectbox(
+        'Do you want to break the groups down by another grouping?',
+        [ 'None', ] + [ _ for _ in config['categorical_columns'] if _ != data_kw['groupby_column'] ], # CUSTOMIZE
+        index=0, # CUSTOMIZE
+        key='{}:cross_tab_column'.format( tag ),
+    )
+    data_kw['show_cooccurrence'] = st.checkbox(
+        'Do you want to see which categories are tagged together?',
+        value=False, # CUSTOMIZE
+        key='{}:show_cooccurrence'.format( tag ),
+    )
 
     # Change categories if requested.
     # This needs to be done before the figure settings,
     # but should have no user-facing effect, so it can be outside general_st_col
-    recategorized_df = st.cache_data( data_utils.recategorize_data )(
+    recategorized_df = st.cache_data( user_utils.get_recategorized_data )(
         preprocessed_df,
-        config['new_categories'],
+        config,
         data_kw['recategorize'],
         data_kw['combine_single_categories'],
+        bridges=bridges,
+        data_versions=data_versions,
+    )
+
+    # The categorical indexes depend on the recategorization
+    indexes = dict( indexes )
+    indexes['categorical'] = st.cache_resource( index_utils.build_categorical_indexes )(
+        recategorized_df,
+        config,
+        bridges,
     )
 
     # Import categorical filter defaults from the global settings, but only if both use the same recategorization settings
@@ -139,24 +182,108 @@ def main( config_fp ):
         categorical_filter_defaults=categorical_filter_defaults,
         numerical_filter_defaults=numerical_filter_defaults,
         tag=tag,
+        bridges=bridges,
     )
 
-    # Fiter the data
-    selected_df = st.cache_data( data_utils.filter_data )(
+    # Fiter the data. Not cached, since the indexes make this fast.
+    selected_df, selected_bridges = data_utils.filter_normalized_data(
         recategorized_df,
+        bridges,
         search_str,
         search_col,
         categorical_filters,
-        numerical_filters
+        numerical_filters,
+        indexes=indexes,
     )
 
-    # Retrieve counts or sums
-    aggregated_df, total = st.cache_data( time_series_utils.count_or_sum )(
-        selected_df,
-        data_kw['year_column'],
-        data_kw['y_column'],
-        data_kw['groupby_column'],
-        data_kw['count_or_sum'],
+    # Retrieve counts and sums.
+    # Views the pipeline has already aggregated are read straight from the aggregate cube.
+    aggregated = {}
+    cube = st.cache_data( user_utils.load_aggregate_cube )( config )
+    if data_kw['granularity'] != 'Year':
+        # Sub-year bins are rolled up from daily aggregates,
+        # so switching between them doesn't aggregate again.
+        rollup = st.cache_data( time_series_utils.aggregate_by_day )(
+            selected_df,
+            config['date_columns'][0],
+            data_kw['groupby_column'],
+            config['id_columns'],
+            config['weight_columns'],
+            bridges=selected_bridges,
+        )
+        aggregated = time_series_utils.roll_up( rollup, data_kw['granularity'], config['start_of_year'] )
+    elif cube is not None:
+        aggregated = time_series_utils.query_aggregate_cube(
+            cube,
+            user_utils.get_recategorization_tag( data_kw['recategorize'], data_kw['combine_single_categories'] ),
+            data_kw['year_column'],
+            data_kw['groupby_column'],
+            search_str,
+            categorical_filters,
+            numerical_filters,
+        )
+    # Otherwise every metric is aggregated at once,
+    # so switching between counting and summing doesn't aggregate again.
+    # Only then can unique counts be approximated, if requested.
+    is_approximate = False
+    sketches = None
+    if ( data_kw['count_or_sum'], data_kw['y_column'] ) not in aggregated:
+        aggregated = st.cache_data( time_series_utils.count_and_sum_all )(
+            selected_df,
+            data_kw['year_column'],
+            data_kw['groupby_column'],
+            config['id_columns'],
+            config['weight_columns'],
+            bridges=selected_bridges,
+            approximate=data_kw['approximate'],
+            relative_error=data_kw['relative_error'],
+        )
+        is_approximate = data_kw['approximate'] and ( data_kw['count_or_sum'] == 'Count' )
+        sketches = aggregated.get( ( 'Sketch', data_kw['y_column'] ) )
+    aggregated_df, total = aggregated[( data_kw['count_or_sum'], data_kw['y_column'] )]
+
+    # Cross-tab the two groupings, shown as a heatmap.
+    # Only the combinations of categories that occur are aggregated.
+    if data_kw['cross_tab_column'] != 'None':
+        is_count = data_kw['count_or_sum'] == 'Count'
+        cross_tab = st.cache_data( time_series_utils.count_and_sum_all )(
+            selected_df,
+            data_kw['year_column'],
+            [ data_kw['groupby_column'], data_kw['cross_tab_column'] ],
+            [ data_kw['y_column'], ] if is_count else [],
+            [] if is_count else [ data_kw['y_column'], ],
+            bridges=selected_bridges,
+            approximate=data_kw['approximate'],
+            relative_error=data_kw['relative_error'],
+        )
+        if ( 'Sketch', data_kw['y_column'] ) in cross_tab:
+            # Approximate counts over the whole time range merge the sketches of every year
+            cross_tab_df, _ = time_series_utils.estimate_sketches( cross_tab[( 'Sketch', data_kw['y_column'] )], cumulative=True )
+            cross_tab_df = cross_tab_df.iloc[-1:]
+        else:
+            cross_tab_df, _ = cross_tab[( data_kw['count_or_sum'], data_kw['y_column'] )]
+        heatmap_df = time_series_utils.get_cross_tab_matrix( cross_tab_df )
+
+    # Which categories the selected articles are tagged with together,
+    # from the tags prior to recategorization
+    if data_kw['show_cooccurrence']:
+        cooccurrence_df = st.cache_data( time_series_utils.get_cooccurrence )(
+            selected_df,
+            data_kw['groupby_column'],
+            bridges=selected_bridges,
+        )
+
+    # Transform the values, e.g. into cumulative values.
+    # Every transform is computed from the same cached prefix sums.
+    prefix_sums = st.cache_data( time_series_utils.get_prefix_sums )( aggregated_df, total, data_kw['granularity'] )
+    untransformed = ( aggregated_df, total )
+    aggregated_df, total = time_series_utils.transform_aggregated(
+        aggregated_df,
+        total,
+        data_kw['transform'],
+        data_kw['window'],
+        prefix_sums=prefix_sums,
+        sketches=sketches,
     )
 
     st.sidebar.markdown( '## Lineplot Settings' )
@@ -166,15 +293,16 @@ def main( config_fp ):
         for i, category in enumerate( aggregated_df.columns )
     }
 
+    x_label = data_kw['year_column'] if data_kw['granularity'] == 'Year' else data_kw['granularity']
+
     lineplot_kw = copy.deepcopy( plot_kw )
-    default_ymax, default_tick_spacing = dash_utils.get_tick_range_and_spacing(
-        total,
-        data_kw['cumulative']
-    )
+    default_ymax, default_tick_spacing = dash_utils.get_tick_range_and_spacing( total )
+    # Changes can be negative
+    default_ymin = -default_ymax if ( total.values < 0 ).any() else 0.
     lineplot_kw.update({
         'x_label': st.sidebar.text_input(
             'lineplot x label',
-            value=data_kw['year_column'], # CUSTOMIZE
+            value=x_label, # CUSTOMIZE
             key='{}:lineplot_x_label'.format( tag ),
         ),
         'y_label': st.sidebar.text_input(
@@ -203,9 +331,9 @@ def main( config_fp ):
         ),
         'y_lim': st.sidebar.slider(
             'y limits',
-            0.,
+            default_ymin*2.,
             default_ymax*2.,
-            value=[0., default_ymax ],
+            value=[default_ymin, default_ymax ],
             key='{}:lineplot_y_lim'.format( tag ),
         ),
         'tick_spacing': st.sidebar.number_input(
@@ -223,7 +351,7 @@ def main( config_fp ):
     stackplot_kw.update({
         'x_label': st.sidebar.text_input(
             'stackplot x label',
-            value=data_kw['year_column'], # CUSTOMIZE
+            value=x_label, # CUSTOMIZE
             key='{}:stackplot_x_label'.format( tag ),
         ),
         'y_label': st.sidebar.text_input(
@@ -236,7 +364,57 @@ def main( config_fp ):
     # Pull in the data dictionary (needed for caching )
     stackplot_kw.update( data_kw )
 
-    for view in [ 'lineplot', 'stackplot', 'data' ]:
+    views = [ 'lineplot', 'stackplot', 'data' ]
+    heatmap_kw = None
+    if data_kw['cross_tab_column'] != 'None':
+        st.sidebar.markdown( '## Heatmap Settings' )
+
+        heatmap_kw = copy.deepcopy( plot_kw )
+        heatmap_kw.update({
+            'x_label': st.sidebar.text_input(
+                'heatmap x label',
+                value=data_kw['cross_tab_column'], # CUSTOMIZE
+                key='{}:heatmap_x_label'.format( tag ),
+            ),
+            'y_label': st.sidebar.text_input(
+                'heatmap y label',
+                value=data_kw['groupby_column'], # CUSTOMIZE
+                key='{}:heatmap_y_label'.format( tag ),
+            ),
+            'colorbar_label': st.sidebar.text_input(
+                'heatmap colorbar label',
+                value='{} of "{}"'.format( data_kw['count_or_sum'], data_kw['y_column'] ), # CUSTOMIZE
+                key='{}:heatmap_colorbar_label'.format( tag ),
+            ),
+        })
+        heatmap_kw.update( data_kw )
+        views.insert( -1, 'heatmap' )
+    cooccurrence_kw = None
+    if data_kw['show_cooccurrence']:
+        st.sidebar.markdown( '## Co-occurrence Settings' )
+
+        cooccurrence_kw = copy.deepcopy( plot_kw )
+        cooccurrence_kw.update({
+            'x_label': st.sidebar.text_input(
+                'co-occurrence x label',
+                value=data_kw['groupby_column'], # CUSTOMIZE
+                key='{}:cooccurrence_x_label'.format( tag ),
+            ),
+            'y_label': st.sidebar.text_input(
+                'co-occurrence y label',
+                value=data_kw['groupby_column'], # CUSTOMIZE
+                key='{}:cooccurrence_y_label'.format( tag ),
+            ),
+            'colorbar_label': st.sidebar.text_input(
+                'co-occurrence colorbar label',
+                value='Number of articles tagged with both', # CUSTOMIZE
+                key='{}:cooccurrence_colorbar_label'.format( tag ),
+            ),
+        })
+        cooccurrence_kw.update( data_kw )
+        views.insert( -1, 'cooccurrence' )
+
+    for view in views:
 
         # For datawe include additional options.
         if view == 'data':
@@ -249,17 +427,37 @@ def main( config_fp ):
             )
         else:
             df_tag = 'selected'
+
+        # Changes aren't fractions of a whole, so the stackplot shows the values instead
+        view_aggregated_df, view_total = aggregated_df, total
+        if ( view == 'stackplot' ) and data_kw['transform'].startswith( 'Year-over-year' ):
+            view_aggregated_df, view_total = untransformed
+        elif view == 'heatmap':
+            view_aggregated_df = heatmap_df
+        elif view == 'cooccurrence':
+            view_aggregated_df = cooccurrence_df
+
+        # Flag views showing estimated counts
+        is_view_approximate = {
+            'heatmap': data_kw['approximate'] and ( data_kw['count_or_sum'] == 'Count' ),
+            'cooccurrence': False,
+            'data': is_approximate and ( df_tag == 'aggregated' ),
+        }.get( view, is_approximate )
+        if is_view_approximate:
+            st.caption( 'Unique counts are approximate, typically within {:.1%}.'.format( data_kw['relative_error'] ) )
+
         download_kw = st.cache_data( time_series_utils.view_time_series )(
             view,
             preprocessed_df,
             selected_df,
-            aggregated_df,
-            total,
+            view_aggregated_df,
+            view_total,
             data_kw,
             lineplot_kw,
             stackplot_kw,
             tag=tag,
             df_tag=df_tag,
+            heatmap_kw=cooccurrence_kw if view == 'cooccurrence' else heatmap_kw,
         )
         if view == 'data':
             download_kw, show_df = download_kw
@@ -7,6 +7,7 @@ import streamlit as st
 import yaml
 
 import matplotlib
+import matplotlib.figure
 import matplotlib.pyplot as plt
 import matplotlib.patheffects as path_effects
 import seaborn as sns
@@ -49,6 +50,13 @@ def load_original_data( config ):
     '''
 
     output_dir = os.path.join( config['data_dir'], config['output_dirname'] )
+
+    # The columnar store is already typed and filled
+    base, ext = os.path.splitext( config['combined_filename'] )
+    parquet_fp = os.path.join( output_dir, base + '.parquet' )
+    if config.get( 'processed_data_format', 'csv' ) == 'parquet' and os.path.isfile( parquet_fp ):
+        return pd.read_parquet( parquet_fp )
+
     press_fp = os.path.join( output_dir, config['combined_filename'] )
     df = pd.read_csv( press_fp, index_col=0 )
 
@@ -285,8 +293,9 @@ def plot_counts( counts, total, plot_kw ):
     sns.set( font=plot_kw['font'], style=plot_kw['seaborn_style'] )
     plot_context = sns.plotting_context("notebook")
 
-    fig = plt.figure( figsize=( plot_kw['fig_width'], plot_kw['fig_height'] ) )
-    ax = plt.gca()
+    # Not made through pyplot, so the figure isn't kept open after it's used
+    fig = matplotlib.figure.Figure( figsize=( plot_kw['fig_width'], plot_kw['fig_height'] ) )
+    ax = fig.add_subplot()
     for j, category_j in enumerate( categories ):
 
         ys = counts[category_j]
@@ -377,8 +386,8 @@ def plot_fractions( counts, stackplot_kw ):
     total = counts.sum( axis='columns' )
     fractions = counts.mul( 1./total, axis='rows' ).fillna( value=0. )
     
-    fig = plt.figure( figsize=( stackplot_kw['fig_width'], stackplot_kw['fig_height'] ) )
-    ax = plt.gca()
+    fig = matplotlib.figure.Figure( figsize=( stackplot_kw['fig_width'], stackplot_kw['fig_height'] ) )
+    ax = fig.add_subplot()
     
     stack = ax.stackplot(
         years,
@@ -1,34 +1,79 @@
 '''Time-series functions.
 Most functions should be useful for most time-series datasets.
 '''
+import collections
+import contextlib
+import functools
+import hashlib
 import io
 import numpy as np
 import pandas as pd
+import scipy.sparse
 import streamlit as st
+import threading
 
 import matplotlib
+import matplotlib.figure
 import matplotlib.pyplot as plt
 import matplotlib.patheffects as path_effects
 import seaborn as sns
 
+from press_dash_lib import data_utils
+
 ################################################################################
 
-def count_or_sum( selected_df, year_column, y_column, groupby_column, count_or_sum ):
+def count_or_sum(
+        selected_df,
+        year_column,
+        y_column,
+        groupby_column,
+        count_or_sum,
+        bridges=None,
+        granularity=None,
+        date_column='Date',
+        start_of_year='January 1',
+        approximate=False,
+        relative_error=0.02,
+    ):
     '''Aggregate. Wrapper function for other functions for the sake of caching.
 
     Args:
         selected_df (pd.DataFrame): The dataframe containing the selected data.
         year_column (str): The column containing the year.
         y_column (str): The column containing the data to count or sum.
-        groupby_column (str): The category to group the data by, e.g. 'Research Topics'.
+        groupby_column (str or list of str): The category to group the data by,
+            e.g. 'Research Topics', or several to cross-tabulate,
+            e.g. [ 'Research Topics', 'Press Types' ] (see factorize_groups).
         count_or_sum (str): Whether to count or sum.
+        bridges (dict of pd.DataFrames): If given and groupby_column is not a
+            column of selected_df, the categories are joined in from the bridge
+            table for groupby_column (see data_utils.normalize_data).
+        granularity (str): If given, the time bins to use instead of year_column,
+            i.e. 'Year', 'Quarter', 'Month', or 'Week' (see get_time_bins).
+        date_column (str): The column containing the date, used with granularity.
+        start_of_year (str): The start of the year, e.g. 'September 1', used with granularity.
+        approximate (bool): If True, estimate the counts with HyperLogLog sketches
+            instead of counting exactly (see count_approximately_from_codes).
+            Not used with granularity.
+        relative_error (float): The typical relative error of approximate counts.
 
     Returns:
         agged (pd.DataFrame): The dataframe containing the aggregated_df data per year.
         total (pd.Series): The series containing the aggregated_df data per year, overall.
     '''
 
-    if count_or_sum == 'Count':
+    if granularity is not None:
+        count_columns, weight_columns = ( [ y_column, ], [] ) if count_or_sum == 'Count' else ( [], [ y_column, ] )
+        rollup = aggregate_by_day( selected_df, date_column, groupby_column, count_columns, weight_columns, bridges )
+        return roll_up( rollup, granularity, start_of_year )[( count_or_sum, y_column )]
+
+    # Join on demand, keeping only the columns we need
+    selected_df = join_groupby_column( selected_df, [ year_column, y_column ], groupby_column, bridges )
+
+    if ( count_or_sum == 'Count' ) and approximate:
+        codes = factorize_year_and_group( selected_df, year_column, groupby_column )
+        return count_approximately_from_codes( selected_df, codes, y_column, relative_error )
+    elif count_or_sum == 'Count':
         return count( selected_df, year_column, y_column, groupby_column )
     elif count_or_sum == 'Sum':
         return sum( selected_df, year_column, y_column, groupby_column )
@@ -37,6 +82,109 @@ def count_or_sum( selected_df, year_column, y_column, groupby_column, count_or_s
 
 ################################################################################
 
+def count_and_sum_all(
+        selected_df,
+        year_column,
+        groupby_column,
+        count_columns,
+        weight_columns,
+        bridges=None,
+        approximate=False,
+        relative_error=0.02,
+    ):
+    '''Aggregate every metric in one pass, sharing the grouping between them.
+    Cache this, and switching between metrics is just a lookup.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        year_column (str): The column containing the year.
+        groupby_column (str or list of str): As for count_or_sum.
+        count_columns (list of str): Columns to count the unique values of, e.g. config['id_columns'].
+        weight_columns (list of str): Columns to sum, e.g. config['weight_columns'].
+        bridges (dict of pd.DataFrames): As for count_or_sum.
+        approximate (bool): As for count_or_sum.
+        relative_error (float): As for count_or_sum.
+
+    Returns:
+        aggregated (dict): For each ( 'Count', count_column ) and ( 'Sum', weight_column ),
+            the aggregated data and total, as returned by count_or_sum. If approximate,
+            also the sketches for each ( 'Sketch', count_column ) (see build_sketches_from_codes),
+            which are merged for distinct counts over several years (see estimate_sketches).
+    '''
+
+    selected_df = join_groupby_column(
+        selected_df,
+        [ year_column, ] + list( count_columns ) + list( weight_columns ),
+        groupby_column,
+        bridges,
+    )
+    codes = factorize_year_and_group( selected_df, year_column, groupby_column )
+
+    aggregated = {}
+    for count_column in count_columns:
+        if approximate:
+            sketches = build_sketches_from_codes( selected_df, codes, count_column, relative_error )
+            aggregated[( 'Count', count_column )] = estimate_sketches( sketches )
+            aggregated[( 'Sketch', count_column )] = sketches
+        else:
+            aggregated[( 'Count', count_column )] = count_from_codes( selected_df, codes, count_column )
+    first_rows = get_first_rows( selected_df, codes )
+    for weight_column in weight_columns:
+        aggregated[( 'Sum', weight_column )] = sum_from_codes( selected_df, codes, weight_column, first_rows )
+
+    return aggregated
+
+################################################################################
+
+def join_groupby_column( selected_df, columns, groupby_column, bridges=None ):
+    '''If groupby_column is only in a bridge table, join it in, keeping only the
+    id and the given columns. Otherwise return selected_df as is.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        columns (list of str): Columns to keep.
+        groupby_column (str or list of str): The category to group the data by,
+            e.g. 'Research Topics', or several.
+        bridges (dict of pd.DataFrames): Bridge tables (see data_utils.normalize_data).
+
+    Returns:
+        selected_df (pd.DataFrame): Data with a row per (id, category) pair if joined,
+            or per (id, category, category, ...) combination for several groupings.
+    '''
+
+    groupby_columns = get_groupby_columns( groupby_column )
+    to_join = [ _ for _ in groupby_columns if _ not in selected_df.columns ]
+    if ( bridges is None ) or ( len( to_join ) == 0 ):
+        return selected_df
+
+    columns = list( dict.fromkeys(
+        [ 'id', ] + list( columns ) + [ _ for _ in groupby_columns if _ in selected_df.columns ]
+    ) )
+    selected_df = selected_df[columns]
+    for column in to_join:
+        selected_df = bridges[column].merge( selected_df, on='id' )
+
+    return selected_df
+
+################################################################################
+
+def get_groupby_columns( groupby_column ):
+    '''The groupings as a list, whether given one or several.
+
+    Args:
+        groupby_column (str or list of str): The category to group the data by.
+
+    Returns:
+        groupby_columns (list of str): The groupings.
+    '''
+
+    if isinstance( groupby_column, str ):
+        return [ groupby_column, ]
+
+    return list( groupby_column )
+
+################################################################################
+
 def count( selected_df, year_column, count_column, groupby_column ):
     '''Count up stats, e.g. number of articles per year per category or
     the number of people reached per year per category.
@@ -51,23 +199,9 @@ def count( selected_df, year_column, count_column, groupby_column ):
         total (pd.Series): The series containing the counts per year, overall.
     '''
 
-    counts = selected_df.pivot_table(
-        index=year_column,
-        columns=groupby_column,
-        values=count_column,
-        aggfunc='nunique',
-    )
-    total = selected_df.pivot_table(
-        index=year_column,
-        values=count_column,
-        aggfunc='nunique',
-    )
-
-    # Fill empty counts
-    counts.fillna( value=0, inplace=True )
-    total.fillna( value=0, inplace=True )
+    codes = factorize_year_and_group( selected_df, year_column, groupby_column )
 
-    return counts, total
+    return count_from_codes( selected_df, codes, count_column )
 
 ################################################################################
 
@@ -84,185 +218,2036 @@ def sum( selected_df, year_column, weight_column, groupby_column ):
         total (pd.Series): The series containing the counts per year, overall.
     '''
 
+    codes = factorize_year_and_group( selected_df, year_column, groupby_column )
+
+    return sum_from_codes( selected_df, codes, weight_column, get_first_rows( selected_df, codes ) )
+
+################################################################################
+
+def count_from_codes( selected_df, codes, count_column ):
+    '''Count the unique values per year per category, given the output of
+    factorize_year_and_group.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        codes (dict): The output of factorize_year_and_group for selected_df.
+        count_column (str): What to count up.
+
+    Returns:
+        counts (pd.DataFrame): The dataframe containing the counts per year per category.
+        total (pd.DataFrame): The counts per year, overall.
+    '''
+
+    value_codes, _ = pd.factorize( selected_df[count_column] )
+
+    counts = count_unique_per_code( codes['cell_codes'], value_codes, codes['n_cells'] )
+    total = count_unique_per_code( codes['year_codes'], value_codes, len( codes['years'] ) )
+
+    return format_aggregated( counts, total, codes, count_column )
+
+################################################################################
+
+def get_first_rows( selected_df, codes ):
+    '''Find the first row of each (id, group) pair and of each id, which are
+    the rows summed over to avoid double-counting.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        codes (dict): The output of factorize_year_and_group for selected_df.
+
+    Returns:
+        first_rows (dict): Contains
+            'id_and_group': Positions of the first row for each (id, group) pair.
+                Missing groups get their own code, so they count as a group here.
+            'id': Positions of the first row for each id.
+    '''
+
+    id_codes, _ = pd.factorize( selected_df['id'] )
+    id_and_group_codes = id_codes.astype( np.int64 ) * ( len( codes['groups'] ) + 1 ) + ( codes['group_codes'] + 1 )
+
+    first_rows = {
+        'id_and_group': np.unique( id_and_group_codes, return_index=True )[1],
+        'id': np.unique( id_codes, return_index=True )[1],
+    }
+    return first_rows
+
+################################################################################
+
+def sum_from_codes( selected_df, codes, weight_column, first_rows ):
+    '''Sum per year per category, without double-counting, given the output of
+    factorize_year_and_group.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        codes (dict): The output of factorize_year_and_group for selected_df.
+        weight_column (str): What to sum.
+        first_rows (dict): The output of get_first_rows.
+
+    Returns:
+        summed (pd.DataFrame): The sums per year per category.
+        total (pd.DataFrame): The sums per year, overall.
+    '''
+
+    weights = selected_df[weight_column]
+
     # We keep one entry per ID and group. This is to avoid double-counting.
-    selected_for_sum_df = selected_df.copy()
-    selected_for_sum_df['id_and_group'] = selected_df['id'].astype( str ) + selected_df[groupby_column]
-    selected_for_sum_df.drop_duplicates( subset='id_and_group', keep='first', inplace=True )
-    summed = selected_for_sum_df.pivot_table(
-        values=weight_column,
-        index=year_column,
-        columns=groupby_column,
-        aggfunc='sum'
-    )
+    rows = first_rows['id_and_group']
+    summed = sum_per_code( codes['cell_codes'][rows], weights.iloc[rows], codes['n_cells'] )
+
     # For total we only need one entry per ID.
-    selected_for_sum_df.drop_duplicates( subset='id', keep='first', inplace=True )
-    total = selected_for_sum_df.pivot_table(
-        values=weight_column,
-        index=year_column,
-        aggfunc='sum'
+    rows = first_rows['id']
+    total = sum_per_code( codes['year_codes'][rows], weights.iloc[rows], len( codes['years'] ) )
+
+    return format_aggregated( summed, total, codes, weight_column )
+
+################################################################################
+
+def factorize_year_and_group( selected_df, year_column, groupby_column ):
+    '''Integer-code the years and groups, so aggregation can use np.bincount.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        year_column (str): The column containing the year.
+        groupby_column (str or list of str): The category to group the data by,
+            e.g. 'Research Topics', or several (see factorize_groups).
+
+    Returns:
+        codes (dict): Contains
+            'years' and 'groups': The sorted unique years and groups.
+            'year_codes' and 'group_codes': The code of each row, -1 if missing.
+            'cell_codes': year_code * n_groups + group_code, -1 if either is missing.
+            'n_cells': The number of (year, group) cells.
+            'n_rows_per_cell': How many rows are in each cell.
+    '''
+
+    year_codes, years = pd.factorize( selected_df[year_column], sort=True )
+    group_codes, groups = factorize_groups( selected_df, groupby_column )
+
+    n_cells = len( years ) * len( groups )
+    cell_codes = year_codes * len( groups ) + group_codes
+    cell_codes[( year_codes < 0 ) | ( group_codes < 0 )] = -1
+
+    codes = {
+        'years': pd.Index( years, name=year_column ),
+        'groups': groups,
+        'year_codes': year_codes,
+        'group_codes': group_codes,
+        'cell_codes': cell_codes,
+        'n_cells': n_cells,
+        'n_rows_per_cell': np.bincount( cell_codes[cell_codes >= 0], minlength=n_cells ),
+    }
+    return codes
+
+################################################################################
+
+def factorize_groups( selected_df, groupby_column ):
+    '''Integer-code the groups. For several groupings, e.g. for a cross-tab,
+    each combination of categories is a group. Combinations are keyed sparsely,
+    so only those that occur get a code, however large the product of the
+    groupings is.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        groupby_column (str or list of str): The category to group the data by,
+            e.g. 'Research Topics', or several, e.g. [ 'Research Topics', 'Press Types' ].
+
+    Returns:
+        group_codes (np.ndarray of ints): The code of each row, -1 if any category is missing.
+        groups (pd.Index): The sorted unique groups, a pd.MultiIndex for several groupings.
+    '''
+
+    groupby_columns = get_groupby_columns( groupby_column )
+    if len( groupby_columns ) == 1:
+        group_codes, groups = pd.factorize( selected_df[groupby_columns[0]], sort=True )
+        return group_codes, pd.Index( groups, name=groupby_columns[0] )
+
+    # One integer key per row, with a digit per grouping
+    keys = np.zeros( len( selected_df ), dtype=np.int64 )
+    is_missing = np.zeros( len( selected_df ), dtype=bool )
+    levels = []
+    for column in groupby_columns:
+        codes, uniques = pd.factorize( selected_df[column], sort=True )
+        keys = keys * max( len( uniques ), 1 ) + codes
+        is_missing |= codes < 0
+        levels.append( uniques )
+
+    # Only the keys that occur are coded
+    unique_keys, inverse = np.unique( keys[~is_missing], return_inverse=True )
+    group_codes = np.full( len( selected_df ), -1, dtype=np.int64 )
+    group_codes[~is_missing] = inverse
+
+    # Decode the keys back into the category of each grouping
+    level_codes = []
+    for uniques in levels[::-1]:
+        level_codes.append( unique_keys % max( len( uniques ), 1 ) )
+        unique_keys = unique_keys // max( len( uniques ), 1 )
+    groups = pd.MultiIndex(
+        levels=levels,
+        codes=level_codes[::-1],
+        names=groupby_columns,
     )
 
-    # Replace the Nones with zeroes
-    summed = summed.fillna( 0 )
-    total = total.fillna( 0 )
+    return group_codes, groups
+
+################################################################################
+
+def count_unique_per_code( codes, value_codes, n_codes ):
+    '''Count the unique values for each code, using a sort-based deduplication.
+    Missing codes and values (-1) are skipped.
 
-    return summed, total
+    Args:
+        codes (np.ndarray of ints): The code of each row, e.g. its cell.
+        value_codes (np.ndarray of ints): The code of the value in each row.
+        n_codes (int): The number of codes.
+
+    Returns:
+        counts (np.ndarray of ints): The number of unique values for each code.
+    '''
+
+    is_valid = ( codes >= 0 ) & ( value_codes >= 0 )
+    n_values = value_codes.max( initial=-1 ) + 1
+    pairs = np.unique( codes[is_valid].astype( np.int64 ) * n_values + value_codes[is_valid] )
+
+    return np.bincount( pairs // max( n_values, 1 ), minlength=n_codes )
 
 ################################################################################
 
-def setup_lineplot_settings(
-        st_loc,
-        default_ymax,
-        default_x_label,
-        default_y_label,
+def sum_per_code( codes, weights, n_codes ):
+    '''Sum the weights for each code. Missing codes (-1) and weights are skipped.
+
+    Args:
+        codes (np.ndarray of ints): The code of each row, e.g. its cell.
+        weights (pd.Series): The weight of each row.
+        n_codes (int): The number of codes.
+
+    Returns:
+        sums (np.ndarray): The sum for each code, with the dtype of weights.
+    '''
+
+    is_valid = codes >= 0
+    sums = np.bincount(
+        codes[is_valid],
+        weights=weights.to_numpy( dtype=float, na_value=0. )[is_valid],
+        minlength=n_codes,
+    )
+
+    return cast_sums( sums, weights.dtype )
+
+################################################################################
+
+def cast_sums( sums, dtype ):
+    '''Give sums the dtype of the weights they are sums of.
+
+    Args:
+        sums (np.ndarray of floats): The sums.
+        dtype: The dtype of the weights.
+
+    Returns:
+        sums (np.ndarray or pd.api.extensions.ExtensionArray): The sums, with dtype.
+    '''
+
+    if pd.api.types.is_integer_dtype( dtype ):
+        sums = np.round( sums ).astype( np.int64 )
+        if pd.api.types.is_extension_array_dtype( dtype ):
+            sums = pd.array( sums, dtype=dtype )
+
+    return sums
+
+################################################################################
+
+def format_aggregated( per_cell, per_year, codes, y_column ):
+    '''Format aggregated values the way pivot_table would, i.e. as a dataframe with
+    a row per year and a column per group, and a total with one column.
+    Years and groups that don't have any rows are left out.
+
+    Args:
+        per_cell (array-like): The value for each (year, group) cell.
+        per_year (array-like): The total for each year.
+        codes (dict): The output of factorize_year_and_group.
+        y_column (str): The name of the total's column.
+
+    Returns:
+        aggregated_df (pd.DataFrame): The values per year per category.
+        total (pd.DataFrame): The values per year, overall.
+    '''
+
+    n_years = len( codes['years'] )
+    n_groups = len( codes['groups'] )
+    n_rows_per_cell = codes['n_rows_per_cell'].reshape( n_years, n_groups )
+    has_year = n_rows_per_cell.sum( axis=1 ) > 0
+    has_group = n_rows_per_cell.sum( axis=0 ) > 0
+
+    per_cell = pd.DataFrame(
+        np.asarray( per_cell ).reshape( n_years, n_groups ),
+        index=codes['years'],
+        columns=codes['groups'],
+    )
+    if pd.api.types.is_extension_array_dtype( per_year ):
+        per_cell = per_cell.astype( per_year.dtype )
+    aggregated_df = per_cell.loc[has_year,has_group]
+
+    total = pd.DataFrame( { y_column: per_year }, index=codes['years'] )
+
+    return aggregated_df, total
+
+################################################################################
+
+def get_cross_tab_matrix( aggregated_df ):
+    '''Sum a cross-tab of two groupings over the time bins, into a matrix with a
+    row per category of the first grouping and a column per category of the second.
+    For counts of ids this is the count over the whole time range, since each
+    article has one date.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin, with a column per
+            combination of categories (see factorize_groups).
+
+    Returns:
+        matrix_df (pd.DataFrame): The values per combination of categories,
+            zero where a combination does not occur.
+    '''
+
+    summed = aggregated_df.sum( axis='index' )
+    summed.index = summed.index.remove_unused_levels()
+
+    return summed.unstack( fill_value=0 )
+
+################################################################################
+
+def get_cooccurrence(
+        selected_df,
+        groupby_column,
+        bridges=None,
+        year_column=None,
+        year_range=None,
     ):
-    '''Get user input for the lineplot.
+    '''Count how many articles each pair of categories is tagged together in.
+    The articles' tags are a sparse article x category incidence matrix A,
+    and the counts are A.T @ A, so the cost scales with the number of tags,
+    not with the number of articles times the number of categories.
 
     Args:
-        st_loc (streamlit): The streamlit object to use.
-        default_ymax (float): The default maximum y value.
-        default_x_label (str): The default x label.
-        default_y_label (str): The default y label.
+        selected_df (pd.DataFrame): The articles to include, e.g. the output of
+            filter_data to restrict to the current selection.
+        groupby_column (str): The grouping, e.g. 'Research Topics'.
+        bridges (dict of pd.DataFrames): If given, the tags are read from the
+            bridge table for groupby_column (see data_utils.normalize_data).
+            Otherwise selected_df has a row per (id, category) pair.
+        year_column (str): The column containing the year, used with year_range.
+        year_range (list of ints): If given, only articles from these years, inclusive.
 
     Returns:
-        plot_kw (dict): The plotting keywords.
+        cooccurrence_df (pd.DataFrame): The number of articles tagged with both the
+            row and the column category. The diagonal is the number of articles per category.
     '''
 
-    # Settings specific to the counts
-    unrounded_tick_spacing = default_ymax/11.
-    default_tick_spacing = np.round( unrounded_tick_spacing, -np.floor(np.log10(unrounded_tick_spacing)).astype(int) )
-    max_tick_spacing = int( default_ymax )
-    plot_kw = {
-        'x_label': st_loc.text_input( 'lineplot x label', value=default_x_label ),
-        'y_label': st_loc.text_input( 'lineplot y label', value=default_y_label, ),
-        'log_yscale': st_loc.checkbox( 'use log yscale', value=False ),
-        'linewidth': st_loc.slider( 'linewidth', 0., 10., value=2. ),
-        'marker_size': st_loc.slider( 'marker size', 0., 100., value=30. ),
-        'y_lim': st_loc.slider( 'y limits', 0., default_ymax*2., value=[0., default_ymax ] ),
-        'tick_spacing': st_loc.number_input( 'y tick spacing', value=default_tick_spacing ),
+    ids = selected_df['id']
+    if year_range is not None:
+        years = selected_df[year_column]
+        ids = ids.loc[( years >= year_range[0] ) & ( years <= year_range[1] )]
+
+    if ( bridges is not None ) and ( groupby_column in bridges ):
+        tags = bridges[groupby_column]
+    else:
+        tags = selected_df[[ 'id', groupby_column ]]
+    tags = tags.loc[tags['id'].isin( ids ).values & tags[groupby_column].notna().values]
+
+    # Binary incidence matrix, one row per article and one column per category
+    id_codes, _ = pd.factorize( tags['id'] )
+    category_codes, categories = pd.factorize( tags[groupby_column], sort=True )
+    incidence = scipy.sparse.csr_matrix(
+        ( np.ones( len( tags ), dtype=np.int64 ), ( id_codes, category_codes ) ),
+        shape=( id_codes.max( initial=-1 ) + 1, len( categories ) ),
+    )
+    # Repeated tags are summed when converting, so clip them back to one
+    incidence.data = np.minimum( incidence.data, 1 )
+
+    cooccurrence = ( incidence.T @ incidence ).toarray()
+    categories = pd.Index( categories, name=groupby_column )
+
+    return pd.DataFrame( cooccurrence, index=categories, columns=categories.rename( None ) )
+
+################################################################################
+# Approximate distinct counts
+################################################################################
+
+def count_approximately_from_codes( selected_df, codes, count_column, relative_error=0.02 ):
+    '''Estimate the unique values per year per category with HyperLogLog
+    sketches, given the output of factorize_year_and_group. Each value is
+    hashed once and each sketch has a fixed size, however many values it holds.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        codes (dict): The output of factorize_year_and_group for selected_df.
+        count_column (str): What to count up.
+        relative_error (float): The typical relative error of the estimates.
+
+    Returns:
+        counts (pd.DataFrame): The estimated counts per year per category.
+        total (pd.DataFrame): The estimated counts per year, overall.
+    '''
+
+    return estimate_sketches( build_sketches_from_codes( selected_df, codes, count_column, relative_error ) )
+
+################################################################################
+
+def build_sketches_from_codes( selected_df, codes, count_column, relative_error=0.02 ):
+    '''Build a HyperLogLog sketch of the values per year per category and per year,
+    given the output of factorize_year_and_group. Keep these, and distinct counts over
+    several years are estimated by merging the sketches instead of going back to the rows.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        codes (dict): The output of factorize_year_and_group for selected_df.
+        count_column (str): What to count up.
+        relative_error (float): The typical relative error of the estimates.
+
+    Returns:
+        sketches (dict): Contains
+            'per_cell': The registers per (year, group), shape (n_years, n_groups, n_registers).
+            'per_year': The registers per year, shape (n_years, n_registers).
+            'years', 'groups', and 'n_rows_per_cell': As for factorize_year_and_group.
+            'count_column': What was counted.
+    '''
+
+    precision = get_hyperloglog_precision( relative_error )
+    hashes = hash_values( selected_df[count_column] )
+
+    n_years = len( codes['years'] )
+    per_cell = build_hyperloglogs( codes['cell_codes'], hashes, codes['n_cells'], precision )
+    per_year = build_hyperloglogs( codes['year_codes'], hashes, n_years, precision )
+
+    sketches = {
+        'per_cell': per_cell.reshape( n_years, len( codes['groups'] ), -1 ),
+        'per_year': per_year,
+        'years': codes['years'],
+        'groups': codes['groups'],
+        'n_rows_per_cell': codes['n_rows_per_cell'],
+        'count_column': count_column,
     }
+    return sketches
+
+################################################################################
+
+def estimate_sketches( sketches, cumulative=False ):
+    '''Estimate the unique values per year per category from the sketches.
+
+    Args:
+        sketches (dict): The output of build_sketches_from_codes.
+        cumulative (bool): If True, estimate the unique values up to and including
+            each year, merging the sketches of the years. Values can repeat across
+            years, so these can't be summed from the counts per year.
+
+    Returns:
+        counts (pd.DataFrame): The estimated counts per year per category.
+        total (pd.DataFrame): The estimated counts per year, overall.
+    '''
+
+    per_cell = merge_hyperloglogs( sketches['per_cell'], cumulative=True ) if cumulative else sketches['per_cell']
+    per_year = merge_hyperloglogs( sketches['per_year'], cumulative=True ) if cumulative else sketches['per_year']
+
+    counts = np.round( estimate_hyperloglogs( per_cell ) ).astype( np.int64 )
+    total = np.round( estimate_hyperloglogs( per_year ) ).astype( np.int64 )
+
+    return format_aggregated( counts, total, sketches, sketches['count_column'] )
+
+################################################################################
+
+def get_hyperloglog_precision( relative_error ):
+    '''The number of index bits needed for a given error. A sketch with
+    m = 2**precision registers has a typical relative error of 1.04/sqrt(m).
+
+    Args:
+        relative_error (float): The typical relative error.
+
+    Returns:
+        precision (int): Between 4 and 16.
+    '''
+
+    n_registers = ( 1.04 / relative_error )**2
+
+    return int( np.clip( np.ceil( np.log2( n_registers ) ), 4, 16 ) )
+
+################################################################################
+
+def hash_values( values ):
+    '''Hash values to 64 bits, for the sketches. Missing values are left out.
+
+    Args:
+        values (pd.Series): The values.
+
+    Returns:
+        hashes (pd.Series of uint64): The hash of each non-missing value, on the same index.
+    '''
+
+    values = values.reset_index( drop=True )
+    values = values.loc[values.notna()]
+
+    return pd.Series( pd.util.hash_pandas_object( values, index=False ).values, index=values.index )
+
+################################################################################
+
+def build_hyperloglogs( codes, hashes, n_codes, precision ):
+    '''Build a HyperLogLog sketch of the values of each code. The first
+    precision bits of a hash pick a register, which keeps the most leading
+    zeros (plus one) seen in the rest of the bits.
+
+    Args:
+        codes (np.ndarray of ints): The code of each row, e.g. its cell. Missing codes (-1) are skipped.
+        hashes (pd.Series of uint64): The output of hash_values, indexed by row position.
+        n_codes (int): The number of codes.
+        precision (int): The number of index bits (see get_hyperloglog_precision).
+
+    Returns:
+        registers (np.ndarray of uint8): Shape (n_codes, 2**precision).
+    '''
+
+    n_registers = 2**precision
+    codes = codes[hashes.index.values]
+    hashes = hashes.values[codes >= 0]
+    codes = codes[codes >= 0]
+
+    n_bits = 64 - precision
+    register_codes = ( hashes >> np.uint64( n_bits ) ).astype( np.int64 )
+    rest = hashes & np.uint64( 2**n_bits - 1 )
+    ranks = ( n_bits - get_bit_length( rest ) + 1 ).astype( np.uint8 )
+
+    registers = np.zeros( n_codes * n_registers, dtype=np.uint8 )
+    np.maximum.at( registers, codes.astype( np.int64 ) * n_registers + register_codes, ranks )
+
+    return registers.reshape( n_codes, n_registers )
+
+################################################################################
+
+def get_bit_length( values ):
+    '''The number of bits needed for each value, i.e. the position of the highest set bit.
+
+    Args:
+        values (np.ndarray of uint64): The values.
+
+    Returns:
+        bit_lengths (np.ndarray of ints): Zero for zero.
+    '''
+
+    # frexp gives the bit length of floats, which are exact for 32-bit halves
+    high = ( values >> np.uint64( 32 ) ).astype( float )
+    low = ( values & np.uint64( 2**32 - 1 ) ).astype( float )
+
+    return np.where( high > 0, 32 + np.frexp( high )[1], np.frexp( low )[1] )
+
+################################################################################
+
+def merge_hyperloglogs( registers, axis=0, cumulative=False ):
+    '''Merge sketches, e.g. over a range of years, giving the sketch of all
+    their values together. This is just the maximum of each register.
+
+    Args:
+        registers (np.ndarray of uint8): Sketches, e.g. the output of build_hyperloglogs.
+        axis (int): The axis to merge over.
+        cumulative (bool): If True, merge each sketch with all those before it along axis,
+            e.g. for cumulative counts.
+
+    Returns:
+        registers (np.ndarray of uint8): The merged sketches.
+    '''
+
+    if cumulative:
+        return np.maximum.accumulate( registers, axis=axis )
+
+    return registers.max( axis=axis )
+
+################################################################################
+
+def estimate_hyperloglogs( registers ):
+    '''Estimate the number of unique values in each sketch, using linear
+    counting for small numbers, where it is more accurate.
+
+    Args:
+        registers (np.ndarray of uint8): Sketches, with the registers along the last axis.
+
+    Returns:
+        estimates (np.ndarray of floats): The estimated number of unique values.
+    '''
+
+    n_registers = registers.shape[-1]
+    alpha = { 16: 0.673, 32: 0.697, 64: 0.709 }.get( n_registers, 0.7213 / ( 1. + 1.079 / n_registers ) )
+
+    raw = alpha * n_registers**2 / np.sum( np.exp2( -registers.astype( float ) ), axis=-1 )
+    n_empty = np.sum( registers == 0, axis=-1 )
+    with np.errstate( divide='ignore' ):
+        linear = n_registers * np.log( n_registers / n_empty )
+
+    return np.where( ( raw <= 2.5 * n_registers ) & ( n_empty > 0 ), linear, raw )
+
+################################################################################
+# Time bins
+################################################################################
+
+def aggregate_by_day(
+        selected_df,
+        date_column,
+        groupby_column,
+        count_columns,
+        weight_columns,
+        bridges=None,
+    ):
+    '''Aggregate every metric per day, the finest time bin, so that coarser bins
+    can be rolled up from it (see roll_up) without going back to the articles.
+
+    Args:
+        selected_df (pd.DataFrame): The dataframe containing the selected data.
+        date_column (str): The column containing the date.
+        groupby_column (str or list of str): As for count_or_sum.
+        count_columns (list of str): Columns to count the unique values of.
+        weight_columns (list of str): Columns to sum.
+        bridges (dict of pd.DataFrames): As for count_or_sum.
+
+    Returns:
+        rollup (dict): Contains
+            'days' and 'groups': The sorted unique days and groups.
+            'n_rows_per_cell': How many rows are in each (day, group) cell.
+            'metrics': For each ( 'Count', count_column ) and ( 'Sum', weight_column ),
+                either 'per_cell' and 'per_day' values that can be summed, or,
+                for counts of values that can repeat across articles,
+                'cell_pairs' and 'day_pairs', the unique ( code, value_code ) pairs.
+            'dtypes': The dtype of each weight column.
+    '''
+
+    columns = [ date_column, ] + list( count_columns ) + list( weight_columns )
+    selected_df = join_groupby_column( selected_df, columns, groupby_column, bridges )
+    selected_df = selected_df[list( dict.fromkeys( [ 'id', ] + get_groupby_columns( groupby_column ) + columns ) )].copy()
+    selected_df[date_column] = pd.to_datetime( selected_df[date_column] ).dt.normalize()
+
+    codes = factorize_year_and_group( selected_df, date_column, groupby_column )
+    rollup = {
+        'days': codes['years'],
+        'groups': codes['groups'],
+        'n_rows_per_cell': codes['n_rows_per_cell'],
+        'metrics': {},
+        'dtypes': {},
+    }
+
+    for count_column in count_columns:
+        value_codes, _ = pd.factorize( selected_df[count_column] )
+        if count_column == 'id':
+            # Each article has one date, so the unique ids per bin are the sum over its days
+            rollup['metrics'][( 'Count', count_column )] = {
+                'per_cell': count_unique_per_code( codes['cell_codes'], value_codes, codes['n_cells'] ),
+                'per_day': count_unique_per_code( codes['year_codes'], value_codes, len( codes['years'] ) ),
+            }
+        else:
+            rollup['metrics'][( 'Count', count_column )] = {
+                'cell_pairs': get_unique_pairs( codes['cell_codes'], value_codes ),
+                'day_pairs': get_unique_pairs( codes['year_codes'], value_codes ),
+            }
+
+    first_rows = get_first_rows( selected_df, codes )
+    for weight_column in weight_columns:
+        weights = selected_df[weight_column]
+        rows = first_rows['id_and_group']
+        per_cell = sum_per_code( codes['cell_codes'][rows], weights.iloc[rows].astype( float ), codes['n_cells'] )
+        rows = first_rows['id']
+        per_day = sum_per_code( codes['year_codes'][rows], weights.iloc[rows].astype( float ), len( codes['years'] ) )
+        rollup['metrics'][( 'Sum', weight_column )] = { 'per_cell': per_cell, 'per_day': per_day }
+        rollup['dtypes'][weight_column] = weights.dtype
+
+    return rollup
+
+################################################################################
+
+def get_unique_pairs( codes, value_codes ):
+    '''The unique ( code, value_code ) pairs, skipping missing codes and values (-1).
+
+    Returns:
+        pairs (np.ndarray of ints): Shape (n_pairs, 2).
+    '''
+
+    is_valid = ( codes >= 0 ) & ( value_codes >= 0 )
+
+    return np.unique( np.stack( [ codes[is_valid], value_codes[is_valid] ], axis=1 ), axis=0 )
+
+################################################################################
+
+def get_time_bins( days, granularity, start_of_year='January 1' ):
+    '''Get the time bin of each day.
+
+    Args:
+        days (pd.DatetimeIndex): The days.
+        granularity (str): 'Year' or 'Quarter', which start at start_of_year,
+            'Month', or 'Week', which start on Mondays.
+        start_of_year (str): The start of the year, e.g. 'September 1'.
+
+    Returns:
+        time_bins (pd.Index): The fiscal year of each day for 'Year',
+            otherwise the first day of each day's bin.
+    '''
+
+    if granularity == 'Year':
+        return pd.Index( data_utils.get_year( pd.Series( days ), start_of_year ) )
+    elif granularity == 'Quarter':
+        # Shift the dates so the year starts on January 1, bin, and shift back
+        start = pd.Timestamp( '{} 2000'.format( start_of_year ) )
+        offset = pd.DateOffset( months=start.month - 1, days=start.day - 1 )
+        return ( days - offset ).to_period( 'Q' ).start_time + offset
+    elif granularity == 'Month':
+        return days.to_period( 'M' ).start_time
+    elif granularity == 'Week':
+        return days.to_period( 'W' ).start_time
+    else:
+        raise KeyError( 'Unrecognized granularity, {}'.format( granularity ) )
+
+################################################################################
+
+def roll_up( rollup, granularity, start_of_year='January 1' ):
+    '''Sum the daily aggregates into coarser time bins.
+    This costs time proportional to the number of days, not articles.
+
+    Args:
+        rollup (dict): The output of aggregate_by_day.
+        granularity (str): The time bins, as for get_time_bins.
+        start_of_year (str): The start of the year, e.g. 'September 1'.
+
+    Returns:
+        aggregated (dict): As returned by count_and_sum_all, but per time bin.
+    '''
+
+    # Codes of the bins. Days without a bin go in an extra bin that is dropped.
+    bin_codes, bins = pd.factorize( get_time_bins( rollup['days'], granularity, start_of_year ), sort=True )
+    n_bins = len( bins )
+    n_groups = len( rollup['groups'] )
+    bin_codes[bin_codes < 0] = n_bins
+    cell_bin_codes = ( bin_codes[:,np.newaxis] * n_groups + np.arange( n_groups ) ).flatten()
+
+    def sum_into_bins( values, codes, n_codes ):
+        return np.bincount( codes, weights=values, minlength=n_codes + n_groups )[:n_codes]
+
+    codes = {
+        'years': pd.Index( bins, name=granularity ),
+        'groups': rollup['groups'],
+        'n_rows_per_cell': sum_into_bins( rollup['n_rows_per_cell'], cell_bin_codes, n_bins * n_groups ).astype( np.int64 ),
+    }
+
+    aggregated = {}
+    for ( count_or_sum, y_column ), metric in rollup['metrics'].items():
+        if 'per_cell' in metric:
+            per_cell = sum_into_bins( metric['per_cell'], cell_bin_codes, n_bins * n_groups )
+            per_bin = sum_into_bins( metric['per_day'], bin_codes, n_bins )
+        else:
+            per_cell = count_unique_per_code(
+                cell_bin_codes[metric['cell_pairs'][:,0]], metric['cell_pairs'][:,1], n_bins * n_groups + n_groups )
+            per_bin = count_unique_per_code( bin_codes[metric['day_pairs'][:,0]], metric['day_pairs'][:,1], n_bins + 1 )
+            per_cell, per_bin = per_cell[:n_bins * n_groups], per_bin[:n_bins]
+
+        if count_or_sum == 'Count':
+            per_cell, per_bin = per_cell.astype( np.int64 ), per_bin.astype( np.int64 )
+        else:
+            per_cell = cast_sums( per_cell, rollup['dtypes'][y_column] )
+            per_bin = cast_sums( per_bin, rollup['dtypes'][y_column] )
+        aggregated[( count_or_sum, y_column )] = format_aggregated( per_cell, per_bin, codes, y_column )
+
+    return aggregated
+
+################################################################################
+# Transforms
+################################################################################
+
+def get_prefix_sums( aggregated_df, total, granularity='Year' ):
+    '''Sum the aggregated values over time, from which every transform is
+    computed (see transform_aggregated). Cache this, and each transform is
+    proportional to the number of time bins. Time bins without any data are
+    filled in with zeros, so windows and lags count time bins, not rows.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+        total (pd.DataFrame): The values per time bin, overall.
+        granularity (str): The time bins, as for get_time_bins.
+
+    Returns:
+        prefix_sums (dict): Contains
+            'values': The sums up to each time bin, with a leading row of zeros.
+                One column per category, plus the total last.
+            'rows' and 'total_rows': Where the rows of aggregated_df and total are.
+            'bins_per_year': The number of time bins per year.
+            'is_integer': Whether all the values are integers.
+    '''
+
+    index = aggregated_df.index.union( total.index )
+    if granularity == 'Year':
+        bins_per_year = 1
+        bins = pd.RangeIndex( int( index.min() ), int( index.max() ) + 1 ) if len( index ) > 0 else index
+    else:
+        offset, bins_per_year = {
+            'Quarter': ( pd.DateOffset( months=3 ), 4 ),
+            'Month': ( pd.DateOffset( months=1 ), 12 ),
+            'Week': ( pd.DateOffset( weeks=1 ), 52 ),
+        }[granularity]
+        bins = pd.date_range( index.min(), index.max(), freq=offset ) if len( index ) > 0 else index
+
+    rows = bins.get_indexer( aggregated_df.index )
+    total_rows = bins.get_indexer( total.index )
+    filled = np.zeros( ( len( bins ), aggregated_df.shape[1] + 1 ) )
+    filled[rows,:-1] = aggregated_df.to_numpy( dtype=float )
+    filled[total_rows,-1] = total.iloc[:,0].to_numpy( dtype=float )
+
+    prefix_sums = {
+        'values': np.concatenate( [ np.zeros( ( 1, filled.shape[1] ) ), np.cumsum( filled, axis=0 ) ] ),
+        'rows': rows,
+        'total_rows': total_rows,
+        'bins_per_year': bins_per_year,
+        'is_integer': all( pd.api.types.is_integer_dtype( _ ) for _ in list( aggregated_df.dtypes ) + list( total.dtypes ) ),
+    }
+    return prefix_sums
+
+################################################################################
+
+def transform_aggregated(
+        aggregated_df,
+        total,
+        transform='None',
+        window=3,
+        prefix_sums=None,
+        granularity='Year',
+        sketches=None,
+    ):
+    '''Transform the aggregated values, e.g. into cumulative values.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+        total (pd.DataFrame): The values per time bin, overall.
+        transform (str): One of
+            'None': The values as is.
+            'Cumulative': The sum of the values up to each time bin.
+            'Rolling mean': The mean over the last window time bins.
+            'Year-over-year change': The change from the same time bin a year earlier.
+            'Year-over-year percent change': The same, as a percentage.
+        window (int): The number of time bins in the rolling mean.
+        prefix_sums (dict): The output of get_prefix_sums. Computed if not given.
+        granularity (str): The time bins, used if prefix_sums is not given.
+        sketches (dict): For approximate counts, the sketches the counts were estimated
+            from (see build_sketches_from_codes). Cumulative counts are then estimated by
+            merging the sketches, since values can repeat across time bins.
+
+    Returns:
+        aggregated_df (pd.DataFrame): The transformed values per time bin per category.
+        total (pd.DataFrame): The transformed values per time bin, overall.
+    '''
+
+    if ( transform == 'None' ) or ( len( total ) == 0 ):
+        return aggregated_df, total
+    if ( transform == 'Cumulative' ) and ( sketches is not None ):
+        return estimate_sketches( sketches, cumulative=True )
+    if prefix_sums is None:
+        prefix_sums = get_prefix_sums( aggregated_df, total, granularity )
+
+    sums = prefix_sums['values']
+    n_bins = len( sums ) - 1
+    values = sums[1:] - sums[:-1]
+
+    if transform == 'Cumulative':
+        transformed = sums[1:]
+    elif transform == 'Rolling mean':
+        ends = np.arange( 1, n_bins + 1 )
+        starts = np.maximum( ends - window, 0 )
+        transformed = ( sums[ends] - sums[starts] ) / ( ends - starts )[:,np.newaxis]
+    elif transform in [ 'Year-over-year change', 'Year-over-year percent change' ]:
+        lag = prefix_sums['bins_per_year']
+        previous = np.full( values.shape, np.nan )
+        previous[lag:] = values[:-lag]
+        transformed = values - previous
+        if transform == 'Year-over-year percent change':
+            with np.errstate( divide='ignore', invalid='ignore' ):
+                transformed = 100. * transformed / previous
+            transformed[~np.isfinite( transformed )] = np.nan
+    else:
+        raise KeyError( 'Unrecognized transform, {}'.format( transform ) )
+
+    transformed_df = pd.DataFrame(
+        transformed[prefix_sums['rows'],:-1],
+        index=aggregated_df.index,
+        columns=aggregated_df.columns,
+    )
+    transformed_total = pd.DataFrame(
+        transformed[prefix_sums['total_rows'],-1:],
+        index=total.index,
+        columns=total.columns,
+    )
+    if ( transform == 'Cumulative' ) and prefix_sums['is_integer']:
+        transformed_df = transformed_df.astype( np.int64 )
+        transformed_total = transformed_total.astype( np.int64 )
+
+    return transformed_df, transformed_total
+
+################################################################################
+# Aggregate cube
+################################################################################
+
+def build_aggregate_cube(
+        dfs,
+        year_columns,
+        groupby_columns,
+        count_columns,
+        weight_columns,
+        bridges=None,
+    ):
+    '''Aggregate every metric for every recategorization, year column, and grouping,
+    so that views that don't filter the articles can skip aggregating.
+
+    Args:
+        dfs (dict of pd.DataFrames): The data for each recategorization,
+            e.g. { 'original': ..., 'recategorized': ... }. One row per article.
+        year_columns (list of str): The columns that can be used as the year.
+        groupby_columns (list of str): The categories to group the data by.
+        count_columns (list of str): Columns to count the unique values of. Should include 'id'.
+        weight_columns (list of str): Columns to sum.
+        bridges (dict of pd.DataFrames): Bridge tables for groupings that are not columns of the data.
+
+    Returns:
+        cube (pd.DataFrame): Long format, with one row per
+            (recategorization, year_column, groupby_column, count_or_sum, y_column, year, category).
+            Totals per year have is_total set. exclusive_categories is set when each
+            article has exactly one category, in which case metrics can be added across categories.
+    '''
+
+    pieces = []
+    for recategorization, df in dfs.items():
+        for year_column in year_columns:
+            for groupby_column in groupby_columns:
+                aggregated = count_and_sum_all( df, year_column, groupby_column, count_columns, weight_columns, bridges )
+                pieces.append( stack_aggregated(
+                    aggregated,
+                    recategorization,
+                    year_column,
+                    groupby_column,
+                    groupby_column in df.columns,
+                ) )
+
+    return pd.concat( pieces, ignore_index=True )
+
+################################################################################
+
+def stack_aggregated( aggregated, recategorization, year_column, groupby_column, exclusive_categories ):
+    '''Stack the metrics for one view into the long format of the aggregate cube.
+
+    Args:
+        aggregated (dict): As returned by count_and_sum_all.
+        recategorization (str): Which recategorization, e.g. 'original'.
+        year_column (str): The column containing the year.
+        groupby_column (str): The category the data is grouped by.
+        exclusive_categories (bool): Whether each article has only one category.
+
+    Returns:
+        cube (pd.DataFrame): The rows of the aggregate cube for this view.
+    '''
+
+    pieces = []
+    for ( count_or_sum, y_column ), ( aggregated_df, total ) in aggregated.items():
+        n_years, n_groups = aggregated_df.shape
+        piece = pd.DataFrame({
+            'year': np.concatenate([
+                np.repeat( aggregated_df.index.to_numpy( dtype=float ), n_groups ),
+                total.index.to_numpy( dtype=float ),
+            ]),
+            'category': np.concatenate([
+                np.tile( aggregated_df.columns.astype( str ).to_numpy( dtype=object ), n_years ),
+                np.full( len( total ), None, dtype=object ),
+            ]),
+            'is_total': np.repeat( [ False, True ], [ n_years * n_groups, len( total ) ] ),
+            'value': np.concatenate([
+                aggregated_df.to_numpy( dtype=float ).flatten(),
+                total.iloc[:,0].to_numpy( dtype=float ),
+            ]),
+        })
+        piece['recategorization'] = recategorization
+        piece['year_column'] = year_column
+        piece['groupby_column'] = groupby_column
+        piece['count_or_sum'] = count_or_sum
+        piece['y_column'] = y_column
+        piece['exclusive_categories'] = exclusive_categories
+        pieces.append( piece )
+
+    cube = pd.concat( pieces, ignore_index=True )
+    cube['year'] = cube['year'].astype( 'Int64' )
+
+    return cube
+
+################################################################################
+
+def query_aggregate_cube(
+        cube,
+        recategorization,
+        year_column,
+        groupby_column,
+        search_str='',
+        categorical_filters={},
+        numerical_filters={},
+    ):
+    '''Get what count_and_sum_all would return for the filtered data, straight from the cube.
+    This is possible for a range of years, and for a selection of categories when
+    each article has only one category, for metrics that can be added across categories.
+
+    Args:
+        cube (pd.DataFrame): The output of build_aggregate_cube.
+        recategorization (str): Which recategorization, e.g. 'original'.
+        year_column (str): The column containing the year.
+        groupby_column (str): The category to group the data by, e.g. 'Research Topics'.
+        search_str (str): The search filter, as for data_utils.filter_data.
+        categorical_filters (dict): How categories are filtered.
+        numerical_filters (dict): Ranges for numerical data filters
+
+    Returns:
+        aggregated (dict): As for count_and_sum_all, for the metrics that can be answered.
+            Empty if the filters can't be answered from the cube.
+    '''
+
+    # Which filters can be answered
+    if ( search_str != '' ) or ( set( numerical_filters ) - { year_column } ) or ( set( categorical_filters ) - { groupby_column } ):
+        return {}
+    cube = cube.loc[
+        ( cube['recategorization'] == recategorization ) &
+        ( cube['year_column'] == year_column ) &
+        ( cube['groupby_column'] == groupby_column )
+    ]
+    if len( cube ) == 0:
+        return {}
+    is_category_filtered = groupby_column in categorical_filters
+    if is_category_filtered and not cube['exclusive_categories'].iloc[0]:
+        return {}
+
+    # Restrict to the selected years and categories
+    is_selected = np.ones( len( cube ), dtype=bool )
+    if year_column in numerical_filters:
+        year_range = numerical_filters[year_column]
+        years = cube['year'].to_numpy( dtype=float, na_value=np.nan )
+        is_selected &= ( year_range[0] <= years ) & ( years <= year_range[1] )
+    if is_category_filtered:
+        is_selected &= cube['is_total'].values | cube['category'].isin( categorical_filters[groupby_column] ).values
+    cube = cube.loc[is_selected]
+
+    # Which cells have any articles, using the article counts
+    id_counts = cube.loc[( cube['count_or_sum'] == 'Count' ) & ( cube['y_column'] == 'id' ) & ~cube['is_total']]
+    id_counts = id_counts.pivot( index='year', columns='category', values='value' )
+    years = id_counts.index[id_counts.sum( axis='columns' ) > 0].astype( np.int64 )
+    categories = id_counts.columns[id_counts.sum( axis='rows' ) > 0]
+    categories = pd.Index( [ _ for _ in pd.unique( cube['category'] ) if _ in categories ] )
+
+    aggregated = {}
+    for ( count_or_sum, y_column ), metric_cube in cube.groupby( [ 'count_or_sum', 'y_column' ], sort=False ):
+
+        # Only unique ids and sums can be added across categories
+        if is_category_filtered and ( count_or_sum == 'Count' ) and ( y_column != 'id' ):
+            continue
+
+        aggregated_df = metric_cube.loc[~metric_cube['is_total']].pivot( index='year', columns='category', values='value' )
+        aggregated_df = aggregated_df.reindex( index=years, columns=categories )
+        if is_category_filtered:
+            total = aggregated_df.sum( axis='columns' ).to_frame( y_column )
+        else:
+            total = metric_cube.loc[metric_cube['is_total']].set_index( 'year' )[['value']]
+            total.index = total.index.astype( np.int64 )
+            total.columns = [ y_column ]
+        if count_or_sum == 'Count':
+            aggregated_df = aggregated_df.astype( np.int64 )
+            total = total.astype( np.int64 )
+
+        aggregated_df.index.name = year_column
+        aggregated_df.columns.name = groupby_column
+        total.index.name = year_column
+        aggregated[( count_or_sum, y_column )] = ( aggregated_df, total )
+
+    return aggregated
+
+################################################################################
+# Incrementally-updated aggregates
+################################################################################
+
+def build_aggregate_state( year_column, groupby_column, count_columns, weight_columns ):
+    '''Start the aggregates for one view, to which articles can then be added,
+    removed, or changed with update_aggregate_state. Only the rows of the articles
+    that change are aggregated, so updates are cheap when few articles change.
+
+    Args:
+        year_column (str): The column containing the year.
+        groupby_column (str): The category to group the data by, e.g. 'Research Topics'.
+        count_columns (list of str): Columns to count the unique values of.
+        weight_columns (list of str): Columns to sum.
+
+    Returns:
+        state (dict): Contains the settings above, plus
+            'rows': The rows of the articles that were added, as returned by get_state_rows,
+                so that what they contributed can be taken out again.
+            'n_rows': The number of rows per (year, group). Missing groups are None.
+            'n_unique': For each count column, the number of unique values per key,
+                where key is (year, group) or (year,) for the total.
+            'sums': For each weight column, the sum per key.
+            'value_counts': For each count column, how many articles have each
+                ( key, value ), as sorted 'hashes' of ( key, value ) and their 'counts'.
+            'dtypes': The dtypes of the year, group, and weight columns.
+            'exclusive_categories': Whether each article has only one category.
+    '''
+
+    state = {
+        'year_column': year_column,
+        'groupby_column': groupby_column,
+        'count_columns': list( count_columns ),
+        'weight_columns': list( weight_columns ),
+        'rows': None,
+        'n_rows': {},
+        'n_unique': { _: {} for _ in count_columns },
+        'sums': { _: {} for _ in weight_columns },
+        'value_counts': {
+            _: { 'hashes': np.zeros( 0, dtype=np.uint64 ), 'counts': np.zeros( 0, dtype=np.int64 ) }
+            for _ in count_columns
+        },
+        'dtypes': None,
+        'exclusive_categories': None,
+    }
+    return state
+
+################################################################################
+
+def update_aggregate_state( state, df, bridges=None, removed_ids=[] ):
+    '''Add, change, or remove articles. Articles in df that were already added
+    are changed, i.e. what they contributed before is taken out first.
+
+    Args:
+        state (dict): As returned by build_aggregate_state. Updated in place.
+        df (pd.DataFrame): The articles to add or change.
+        bridges (dict of pd.DataFrames): Bridge tables for the articles in df, if
+            state['groupby_column'] is not a column of df.
+        removed_ids (list-like): The ids of articles to remove.
+
+    Returns:
+        state (dict): The updated state.
+    '''
+
+    # Take out the old version of changed and removed articles
+    if state['rows'] is not None:
+        is_outdated = state['rows']['id'].isin( removed_ids ) | state['rows']['id'].isin( df['id'] )
+        apply_state_rows( state, state['rows'].loc[is_outdated], -1 )
+        state['rows'] = state['rows'].loc[~is_outdated]
+    if len( df ) == 0:
+        return state
+
+    joined = join_groupby_column(
+        df,
+        [ state['year_column'], ] + state['count_columns'] + state['weight_columns'],
+        state['groupby_column'],
+        bridges,
+    )
+    if state['dtypes'] is None:
+        group_dtype = joined[state['groupby_column']].dtype
+        if isinstance( group_dtype, pd.CategoricalDtype ):
+            group_dtype = group_dtype.categories.dtype
+        state['dtypes'] = {
+            state['year_column']: joined[state['year_column']].dtype,
+            state['groupby_column']: group_dtype,
+        }
+        state['dtypes'].update( joined[state['weight_columns']].dtypes.to_dict() )
+        state['exclusive_categories'] = state['groupby_column'] in df.columns
+
+    rows = get_state_rows( joined, state )
+    apply_state_rows( state, rows, 1 )
+    if state['rows'] is not None:
+        rows = pd.concat( [ state['rows'], rows ], ignore_index=True )
+        rows['group'] = rows['group'].astype( 'category' )
+    state['rows'] = rows
+
+    return state
+
+################################################################################
+
+def get_state_rows( joined, state ):
+    '''Put rows in the compact form kept by the aggregate state.
+
+    Args:
+        joined (pd.DataFrame): The rows, with the groupby column joined in.
+        state (dict): As returned by build_aggregate_state.
+
+    Returns:
+        rows (pd.DataFrame): Contains the id, the year as a float, the group as a
+            category, then for each count column its hash (0 if missing),
+            and for each weight column its value as a float (0 if missing).
+            These are named by position, e.g. 'value_0' and 'weight_0'.
+    '''
+
+    rows = pd.DataFrame({
+        'id': joined['id'].values,
+        'year': joined[state['year_column']].to_numpy( dtype=float, na_value=np.nan ),
+        'group': joined[state['groupby_column']].astype( 'category' ).values,
+    })
+    for i, count_column in enumerate( state['count_columns'] ):
+        values = joined[count_column]
+        rows['value_{}'.format( i )] = np.where( values.isna(), np.uint64( 0 ), pd.util.hash_pandas_object( values, index=False ).values )
+    for i, weight_column in enumerate( state['weight_columns'] ):
+        rows['weight_{}'.format( i )] = joined[weight_column].to_numpy( dtype=float, na_value=0. )
+
+    return rows
+
+################################################################################
+
+def apply_state_rows( state, rows, sign ):
+    '''Add (sign=1) or take out (sign=-1) what some articles contribute,
+    following the same rules as count_and_sum_all,
+    i.e. unique values and one weight per (id, group).
+
+    Args:
+        state (dict): As returned by build_aggregate_state. Updated in place.
+        rows (pd.DataFrame): All the rows of the articles, as returned by get_state_rows.
+        sign (int): 1 to add, -1 to take out.
+    '''
+
+    if len( rows ) == 0:
+        return
+    has_year = rows['year'].notna().values
+    has_group = rows['group'].notna().values
+    cell_columns = [ 'year', 'group' ]
+    groupby_kw = { 'observed': True, 'sort': False }
+
+    # Rows without a group still count towards the years
+    n_rows = rows.loc[has_year].groupby( cell_columns, dropna=False, **groupby_kw ).size()
+    update_counters( state['n_rows'], sign * n_rows )
+
+    # Weights are summed once per (id, group) and once per id
+    is_first = ~rows['id'].duplicated().values
+    is_first_for_group = ~rows.duplicated( [ 'id', 'group' ] ).values
+    for i, weight_column in enumerate( state['weight_columns'] ):
+        per_cell = rows.loc[is_first_for_group & has_year & has_group].groupby( cell_columns, **groupby_kw )['weight_{}'.format( i )].sum()
+        per_year = rows.loc[is_first & has_year].groupby( 'year', **groupby_kw )['weight_{}'.format( i )].sum()
+        update_counters( state['sums'][weight_column], sign * per_cell )
+        update_counters( state['sums'][weight_column], sign * per_year )
+
+    # The number of unique values per key only changes when a value appears or disappears
+    for i, count_column in enumerate( state['count_columns'] ):
+        value_column = 'value_{}'.format( i )
+        has_value = rows[value_column].values != 0
+        pairs = pd.concat( [
+            rows.loc[has_year & has_group & has_value, [ 'id', 'year', 'group', value_column ]],
+            rows.loc[has_year & has_value, [ 'id', 'year', value_column ]],
+        ], ignore_index=True ).drop_duplicates()
+        hashes = pd.util.hash_pandas_object( pairs[[ 'year', 'group', value_column ]], index=False ).values
+        hashes, first_pairs, n_articles = np.unique( hashes, return_index=True, return_counts=True )
+        changes = pairs.iloc[first_pairs][cell_columns]
+
+        before, after = update_value_counts( state['value_counts'][count_column], hashes, sign * n_articles )
+        changes['n_unique'] = ( ( before == 0 ) & ( after > 0 ) ).astype( int ) - ( ( before > 0 ) & ( after == 0 ) )
+        is_total = changes['group'].isna()
+        per_cell = changes.loc[~is_total].groupby( cell_columns, **groupby_kw )['n_unique'].sum()
+        per_year = changes.loc[is_total].groupby( 'year', **groupby_kw )['n_unique'].sum()
+        update_counters( state['n_unique'][count_column], per_cell )
+        update_counters( state['n_unique'][count_column], per_year )
+
+################################################################################
+
+def update_value_counts( value_counts, hashes, changes ):
+    '''Change how many articles have some ( key, value ) pairs. Lookups are binary
+    searches, so this scales with the number of changes. Pairs that no
+    articles have anymore are dropped.
+
+    Args:
+        value_counts (dict): Sorted 'hashes' of the pairs and their 'counts'. Updated in place.
+        hashes (np.ndarray of uint64s): The sorted, unique hashes of the pairs that change.
+        changes (np.ndarray of ints): How much the count of each pair changes.
+
+    Returns:
+        before (np.ndarray of ints): The counts before the change.
+        after (np.ndarray of ints): The counts after the change.
+    '''
+
+    positions = np.searchsorted( value_counts['hashes'], hashes )
+    is_known = positions < len( value_counts['hashes'] )
+    is_known[is_known] = value_counts['hashes'][positions[is_known]] == hashes[is_known]
+
+    before = np.zeros( len( hashes ), dtype=np.int64 )
+    before[is_known] = value_counts['counts'][positions[is_known]]
+    after = before + changes
+
+    value_counts['counts'][positions[is_known]] = after[is_known]
+    value_counts['hashes'] = np.insert( value_counts['hashes'], positions[~is_known], hashes[~is_known] )
+    value_counts['counts'] = np.insert( value_counts['counts'], positions[~is_known], after[~is_known] )
+
+    # Drop pairs that no articles have anymore, so deletions don't leave them behind
+    is_kept = value_counts['counts'] != 0
+    if not is_kept.all():
+        value_counts['hashes'] = value_counts['hashes'][is_kept]
+        value_counts['counts'] = value_counts['counts'][is_kept]
+
+    return before, after
+
+################################################################################
+
+def update_counters( counters, changes ):
+    '''Add changes to counters, dropping keys that reach zero.
+
+    Args:
+        counters (dict): The counters, keyed by (year, group) or (year,).
+            Missing groups are None. Updated in place.
+        changes (pd.Series): The changes, indexed by year or by (year, group).
+    '''
+
+    for key, change in changes.items():
+        if isinstance( key, tuple ):
+            key = tuple( None if pd.isna( _ ) else _ for _ in key )
+        else:
+            key = ( key, )
+        value = counters.get( key, 0 ) + change
+        if value == 0:
+            counters.pop( key, None )
+        else:
+            counters[key] = value
+
+################################################################################
+
+def get_aggregates_from_state( state ):
+    '''Read out the aggregates. This costs time proportional to the number of
+    (year, group) cells, not to the number of articles.
+
+    Args:
+        state (dict): As returned by build_aggregate_state.
+
+    Returns:
+        aggregated (dict): As returned by count_and_sum_all.
+    '''
+
+    year_column = state['year_column']
+    groupby_column = state['groupby_column']
+    dtypes = state['dtypes'] if state['dtypes'] is not None else {}
+
+    # The same years and groups as factorize_year_and_group would find
+    def sorted_index( values, column ):
+        values = pd.Series( list( values ), dtype=dtypes.get( column ) ).sort_values()
+        return pd.Index( values.array, name=column )
+    years = sorted_index( { key[0] for key in state['n_rows'] }, year_column )
+    groups = sorted_index( { key[1] for key in state['n_rows'] if key[1] is not None }, groupby_column )
+    year_positions = dict( zip( years, range( len( years ) ) ) )
+    group_positions = dict( zip( groups, range( len( groups ) ) ) )
+
+    def to_arrays( counter, dtype ):
+        per_cell = np.zeros( len( years ) * len( groups ), dtype=dtype )
+        per_year = np.zeros( len( years ), dtype=dtype )
+        for key, value in counter.items():
+            if len( key ) == 1:
+                per_year[year_positions[key[0]]] = value
+            elif key[1] is not None:
+                per_cell[year_positions[key[0]] * len( groups ) + group_positions[key[1]]] = value
+        return per_cell, per_year
+
+    n_rows_per_cell, _ = to_arrays( state['n_rows'], np.int64 )
+    codes = {
+        'years': years,
+        'groups': groups,
+        'n_rows_per_cell': n_rows_per_cell,
+    }
+
+    aggregated = {}
+    for count_column in state['count_columns']:
+        counts, total = to_arrays( state['n_unique'][count_column], np.int64 )
+        aggregated[( 'Count', count_column )] = format_aggregated( counts, total, codes, count_column )
+    for weight_column in state['weight_columns']:
+        summed, total = to_arrays( state['sums'][weight_column], float )
+        dtype = dtypes.get( weight_column, float )
+        aggregated[( 'Sum', weight_column )] = format_aggregated(
+            cast_sums( summed, dtype ), cast_sums( total, dtype ), codes, weight_column )
+
+    return aggregated
+
+################################################################################
+
+def get_tables_from_states( states ):
+    '''Flatten aggregate states into plain tables and JSON-compatible settings,
+    e.g. to save them as Parquet instead of pickling them.
+
+    Args:
+        states (dict): Aggregate states (see build_aggregate_state), keyed by tuples of strs.
+
+    Returns:
+        metadata (list of dicts): The key and settings of each state, in order.
+        tables (dict of pd.DataFrames): Contains
+            'rows': The rows of every state, with the position of its state.
+            'counters': One row per counter entry, with the position of its state,
+                which 'counter' it's in, e.g. 'n_rows' or ( 'sums', 0 ) as 'sums:0',
+                its year and group, whether it's a total, and its value.
+            'value_counts': One row per ( key, value ) hash, with the position
+                of its state and the position of its count column.
+    '''
+
+    metadata = []
+    rows = []
+    counters = []
+    value_counts = []
+    for i, ( key, state ) in enumerate( states.items() ):
+        metadata.append( {
+            'key': list( key ),
+            'year_column': state['year_column'],
+            'groupby_column': state['groupby_column'],
+            'count_columns': state['count_columns'],
+            'weight_columns': state['weight_columns'],
+            'has_rows': state['rows'] is not None,
+            'dtypes': None if state['dtypes'] is None else { column: str( dtype ) for column, dtype in state['dtypes'].items() },
+            'exclusive_categories': None if state['exclusive_categories'] is None else bool( state['exclusive_categories'] ),
+        } )
+
+        if state['rows'] is not None:
+            state_rows = state['rows'].copy()
+            state_rows['group'] = state_rows['group'].astype( object )
+            state_rows.insert( 0, 'state', i )
+            rows.append( state_rows )
+
+        named_counters = [ ( 'n_rows', state['n_rows'] ), ]
+        named_counters += [ ( 'n_unique:{}'.format( j ), state['n_unique'][_] ) for j, _ in enumerate( state['count_columns'] ) ]
+        named_counters += [ ( 'sums:{}'.format( j ), state['sums'][_] ) for j, _ in enumerate( state['weight_columns'] ) ]
+        for name, counter in named_counters:
+            counters.append( pd.DataFrame( {
+                'state': i,
+                'counter': name,
+                'year': [ float( _[0] ) for _ in counter ],
+                'group': pd.Series( [ _[1] if len( _ ) > 1 else None for _ in counter ], dtype=object ),
+                'is_total': [ len( _ ) == 1 for _ in counter ],
+                'value': np.array( list( counter.values() ), dtype=float ),
+            } ) )
+
+        for j, count_column in enumerate( state['count_columns'] ):
+            value_counts.append( pd.DataFrame( {
+                'state': i,
+                'count_column': j,
+                'hash': state['value_counts'][count_column]['hashes'],
+                'count': state['value_counts'][count_column]['counts'],
+            } ) )
+
+    def concat( pieces, columns ):
+        if len( pieces ) == 0:
+            return pd.DataFrame( columns=columns )
+        return pd.concat( pieces, ignore_index=True )
+
+    tables = {
+        'rows': concat( rows, [ 'state', 'id', 'year', 'group' ] ),
+        'counters': concat( counters, [ 'state', 'counter', 'year', 'group', 'is_total', 'value' ] ),
+        'value_counts': concat( value_counts, [ 'state', 'count_column', 'hash', 'count' ] ),
+    }
+    return metadata, tables
+
+################################################################################
+
+def get_states_from_tables( metadata, tables ):
+    '''Rebuild aggregate states from the output of get_tables_from_states.
+
+    Args:
+        metadata (list of dicts): The key and settings of each state.
+        tables (dict of pd.DataFrames): The rows, counters, and value counts.
+
+    Returns:
+        states (dict): The aggregate states, keyed by tuples of strs.
+    '''
+
+    rows_by_state = dict( list( tables['rows'].groupby( 'state', sort=False ) ) )
+    counters_by_state = dict( list( tables['counters'].groupby( [ 'state', 'counter' ], sort=False ) ) )
+    value_counts_by_state = dict( list( tables['value_counts'].groupby( [ 'state', 'count_column' ], sort=False ) ) )
+
+    def read_counter( i, name, dtype ):
+        if ( i, name ) not in counters_by_state:
+            return {}
+        entries = counters_by_state[( i, name )]
+        keys = [
+            ( year, ) if is_total else ( year, group )
+            for year, group, is_total in zip( entries['year'].tolist(), entries['group'].tolist(), entries['is_total'].tolist() )
+        ]
+        return dict( zip( keys, entries['value'].astype( dtype ).tolist() ) )
+
+    states = {}
+    for i, settings in enumerate( metadata ):
+        state = build_aggregate_state(
+            settings['year_column'],
+            settings['groupby_column'],
+            settings['count_columns'],
+            settings['weight_columns'],
+        )
+        if settings['has_rows']:
+            state_rows = rows_by_state[i] if i in rows_by_state else tables['rows'].iloc[:0]
+            state_rows = state_rows.drop( columns='state' ).reset_index( drop=True )
+            state_rows['group'] = state_rows['group'].astype( 'category' )
+            state['rows'] = state_rows
+        if settings['dtypes'] is not None:
+            state['dtypes'] = { column: pd.api.types.pandas_dtype( dtype ) for column, dtype in settings['dtypes'].items() }
+        state['exclusive_categories'] = settings['exclusive_categories']
+
+        state['n_rows'] = read_counter( i, 'n_rows', np.int64 )
+        for j, count_column in enumerate( state['count_columns'] ):
+            state['n_unique'][count_column] = read_counter( i, 'n_unique:{}'.format( j ), np.int64 )
+            if ( i, j ) in value_counts_by_state:
+                entries = value_counts_by_state[( i, j )]
+                state['value_counts'][count_column] = {
+                    'hashes': entries['hash'].to_numpy( dtype=np.uint64 ),
+                    'counts': entries['count'].to_numpy( dtype=np.int64 ),
+                }
+        for j, weight_column in enumerate( state['weight_columns'] ):
+            state['sums'][weight_column] = read_counter( i, 'sums:{}'.format( j ), float )
+
+        states[tuple( settings['key'] )] = state
+
+    return states
+
+################################################################################
+# Figures
+################################################################################
+
+def create_figure( figsize ):
+    '''Create a figure with one axes. It is not registered with pyplot,
+    so it is freed once nothing references it, instead of staying in pyplot's
+    list of open figures.
+
+    Args:
+        figsize (tuple of floats): The width and height in inches.
+
+    Returns:
+        fig (matplotlib.figure.Figure): The figure.
+    '''
+
+    fig = matplotlib.figure.Figure( figsize=figsize )
+    fig.add_subplot()
+
+    return fig
+
+################################################################################
+
+def close_figure( fig ):
+    '''Free a figure's artists now rather than whenever it's garbage collected.
+    Also closes it in pyplot, in case it was made there.
+
+    Args:
+        fig (matplotlib.figure.Figure): The figure.
+    '''
+
+    plt.close( fig )
+    fig.clear()
+
+################################################################################
+
+@st.cache_resource
+def get_figure_pool():
+    '''The figures reused by pooled_figure, shared between sessions.'''
+
+    return { 'entries': collections.OrderedDict(), 'lock': threading.Lock() }
+
+################################################################################
+
+@contextlib.contextmanager
+def pooled_figure( view, layout_key, max_entries=16 ):
+    '''Borrow the pooled figure for a view and layout. The plotting functions
+    create and draw it the first time, after setting the style, and afterwards
+    only update the data. Only one caller uses a pooled figure at a time, and
+    figures evicted from the pool are closed.
+
+    Args:
+        view (str): The view, e.g. 'lineplot'.
+        layout_key (str): Identifies the layout, e.g. the output of get_layout_key.
+        max_entries (int): Least-recently-used figures beyond this are evicted.
+
+    Yields:
+        pooled (dict): Contains
+            'fig': The figure, None until the plotting function has created it.
+            'artists': What the plotting function drew, None until it has drawn.
+    '''
+
+    pool = get_figure_pool()
+    key = ( view, layout_key )
+    evicted = []
+    with pool['lock']:
+        if key not in pool['entries']:
+            pool['entries'][key] = { 'fig': None, 'artists': None, 'lock': threading.Lock() }
+        pool['entries'].move_to_end( key )
+        pooled = pool['entries'][key]
+        while len( pool['entries'] ) > max_entries:
+            evicted.append( pool['entries'].popitem( last=False )[1] )
+
+    for entry in evicted:
+        with entry['lock']:
+            if entry['fig'] is not None:
+                close_figure( entry['fig'] )
+
+    with pooled['lock']:
+        try:
+            yield pooled
+        except BaseException:
+            # A partly-drawn figure can't be updated, so start it over
+            if pooled['fig'] is not None:
+                close_figure( pooled['fig'] )
+            pooled['fig'], pooled['artists'] = None, None
+            raise
+
+################################################################################
+
+def get_layout_key( aggregated_df, plot_kw, data_keys=[ 'y_lim', 'tick_spacing' ] ):
+    '''Identify the layout of a figure, i.e. everything but the data and the
+    settings that can be updated along with it, e.g. the limits.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+        plot_kw (dict): The plotting keywords.
+        data_keys (list of str): Plotting keywords that can be updated.
+
+    Returns:
+        layout_key (str): Hex digest.
+    '''
+
+    return get_content_hash(
+        list( aggregated_df.columns ),
+        str( aggregated_df.index.dtype ),
+        { key: value for key, value in plot_kw.items() if key not in data_keys },
+    )
+
+################################################################################
+
+def setup_lineplot_settings(
+        st_loc,
+        default_ymax,
+        default_x_label,
+        default_y_label,
+    ):
+    '''Get user input for the lineplot.
+
+    Args:
+        st_loc (streamlit): The streamlit object to use.
+        default_ymax (float): The default maximum y value.
+        default_x_label (str): The default x label.
+        default_y_label (str): The default y label.
+
+    Returns:
+        plot_kw (dict): The plotting keywords.
+    '''
+
+    # Settings specific to the counts
+    unrounded_tick_spacing = default_ymax/11.
+    default_tick_spacing = np.round( unrounded_tick_spacing, -np.floor(np.log10(unrounded_tick_spacing)).astype(int) )
+    max_tick_spacing = int( default_ymax )
+    plot_kw = {
+        'x_label': st_loc.text_input( 'lineplot x label', value=default_x_label ),
+        'y_label': st_loc.text_input( 'lineplot y label', value=default_y_label, ),
+        'log_yscale': st_loc.checkbox( 'use log yscale', value=False ),
+        'linewidth': st_loc.slider( 'linewidth', 0., 10., value=2. ),
+        'marker_size': st_loc.slider( 'marker size', 0., 100., value=30. ),
+        'y_lim': st_loc.slider( 'y limits', 0., default_ymax*2., value=[0., default_ymax ] ),
+        'tick_spacing': st_loc.number_input( 'y tick spacing', value=default_tick_spacing ),
+    }
+
+    return plot_kw
+
+################################################################################
+
+def lineplot(
+        aggregated_df,
+        total,
+        pooled=None,
+        **lineplot_kw
+    ):
+    '''Function to plot the counts.
+    Transforms, e.g. cumulative values, are applied beforehand (see transform_aggregated).
+
+    Args:
+        counts (pd.DataFrame): The dataframe containing the counts per year per category.
+        total (pd.Series): The series containing the counts per year, overall.
+        pooled (dict): A figure borrowed from the pool (see pooled_figure). If it already
+            holds a lineplot, only the data, limits, and ticks are updated.
+        plot_kw (dict): The plotting keywords. Typically set things like font size, figure dimensions, etc.
+
+    Returns:
+        fig (matplotlib.figure.Figure): The figure containing the plot.
+    '''
+
+    years = aggregated_df.index
+    categories = aggregated_df.columns
+
+    sns.set( font=lineplot_kw['font'], style=lineplot_kw['seaborn_style'] )
+    plot_context = sns.plotting_context("notebook")
+
+    if ( pooled is not None ) and ( pooled['artists'] is not None ):
+        update_lineplot( pooled['fig'], pooled['artists'], aggregated_df, total, **lineplot_kw )
+        return pooled['fig']
+
+    fig = create_figure( ( lineplot_kw['fig_width'], lineplot_kw['fig_height'] ) )
+    ax = fig.axes[0]
+    artists = { 'lines': [], 'scatters': [], 'annotations': [] }
+    for j, category_j in enumerate( categories ):
+
+        ys = aggregated_df[category_j]
+
+        line, = ax.plot(
+            years,
+            ys,
+            linewidth = lineplot_kw['linewidth'],
+            alpha = 0.5,
+            zorder = 2,
+            color = lineplot_kw['category_colors'][category_j],
+        )
+        scatter = ax.scatter(
+            years,
+            ys,
+            label = category_j,
+            zorder = 2,
+            color = lineplot_kw['category_colors'][category_j],
+            s = lineplot_kw['marker_size'],
+            )
+        artists['lines'].append( line )
+        artists['scatters'].append( scatter )
+
+        # Add labels
+        if lineplot_kw.get( 'include_annotations', False ):
+            label_y = ys.iloc[-1]
+
+            text = ax.annotate(
+                text = category_j,
+                xy = ( 1, label_y ),
+                xycoords = matplotlib.transforms.blended_transform_factory( ax.transAxes, ax.transData ),
+                xytext = ( -5 + 10 * ( lineplot_kw['annotations_horizontal_alignment'] == 'left' ), 0 ),
+                va = 'center',
+                ha = lineplot_kw['annotations_horizontal_alignment'],
+                textcoords = 'offset points',
+            )
+            text.set_path_effects([
+                path_effects.Stroke(linewidth=2.5, foreground='w'),
+                path_effects.Normal(),
+            ])
+            artists['annotations'].append( text )
+
+    if lineplot_kw['show_total']:
+        line, = ax.plot(
+            years,
+            total,
+            linewidth = lineplot_kw['linewidth'],
+            alpha = 0.5,
+            color = 'k',
+            zorder = 1,
+        )
+        scatter = ax.scatter(
+            years,
+            total,
+            label = 'Total',
+            color = 'k',
+            zorder = 1,
+            s = lineplot_kw['marker_size'],
+        )
+        artists['lines'].append( line )
+        artists['scatters'].append( scatter )
+
+    set_lineplot_limits( fig, years, **lineplot_kw )
+
+    if lineplot_kw.get( 'include_legend', False ):
+        l = ax.legend(
+            bbox_to_anchor = ( lineplot_kw['legend_x'], lineplot_kw['legend_y'] ),
+            loc = '{} {}'.format(
+                lineplot_kw['legend_vertical_alignment'],
+                lineplot_kw['legend_horizontal_alignment']
+            ), 
+            framealpha = 1.,
+            fontsize = plot_context['legend.fontsize'] * lineplot_kw['legend_scale'],
+            ncol = len( categories ) // 4 + 1
+        )
+
+    # Labels, inc. size
+    ax.set_xlabel( lineplot_kw['x_label'], fontsize=plot_context['axes.labelsize'] * lineplot_kw['font_scale'] )
+    ax.set_ylabel( lineplot_kw['y_label'], fontsize=plot_context['axes.labelsize'] * lineplot_kw['font_scale'] )
+    ax.tick_params( labelsize=plot_context['xtick.labelsize']*lineplot_kw['font_scale'] )
+
+    if pooled is not None:
+        pooled['fig'], pooled['artists'] = fig, artists
+
+    # return facet_grid
+    return fig
+
+################################################################################
+
+def update_lineplot( fig, artists, aggregated_df, total, **lineplot_kw ):
+    '''Update a lineplot drawn for the same layout, i.e. the same categories and
+    plotting keywords other than the limits, with new data.
+
+    Args:
+        fig (matplotlib.figure.Figure): The figure holding the lineplot.
+        artists (dict): The lines, scatters, and annotations of the lineplot.
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+        total (pd.DataFrame): The values per time bin, overall.
+        lineplot_kw (dict): The plotting keywords.
+    '''
+
+    years = aggregated_df.index
+    xs = np.asarray( fig.axes[0].convert_xunits( years ), dtype=float )
+
+    all_ys = [ aggregated_df[category_j] for category_j in aggregated_df.columns ]
+    if lineplot_kw['show_total']:
+        all_ys.append( total.iloc[:,0] )
+    for line, scatter, ys in zip( artists['lines'], artists['scatters'], all_ys ):
+        ys = ys.to_numpy( dtype=float, na_value=np.nan )
+        line.set_data( xs, ys )
+        scatter.set_offsets( np.column_stack( [ xs, ys ] ) )
+    for text, ys in zip( artists['annotations'], all_ys ):
+        text.xy = ( 1, ys.iloc[-1] )
+
+    set_lineplot_limits( fig, years, **lineplot_kw )
+
+################################################################################
+
+def set_lineplot_limits( fig, years, **lineplot_kw ):
+    '''Set the limits and ticks of a lineplot.
+
+    Args:
+        fig (matplotlib.figure.Figure): The figure holding the lineplot.
+        years (pd.Index): The time bins.
+        lineplot_kw (dict): The plotting keywords.
+    '''
+
+    ax = fig.axes[0]
+
+    # Sub-year time bins are dates, which matplotlib places the ticks for
+    if pd.api.types.is_datetime64_any_dtype( years ):
+        fig.autofmt_xdate()
+    else:
+        ax.set_xticks( years.astype( int ) )
+    ax.set_yticks( get_y_ticks( lineplot_kw['y_lim'], lineplot_kw['tick_spacing'] ) )
+
+    if lineplot_kw['log_yscale']:
+        ax.set_yscale( 'log' )
+
+    ax.set_xlim( years[0], years[-1] )
+    ax.set_ylim( lineplot_kw['y_lim'] )
+
+################################################################################
+
+def get_y_ticks( y_lim, tick_spacing ):
+    '''The y ticks of the lineplot, spaced evenly from zero.
+
+    Args:
+        y_lim (list of floats): The y limits.
+        tick_spacing (float): The spacing between ticks.
+
+    Returns:
+        ticks (np.ndarray of floats): The ticks.
+    '''
+
+    ymin, ymax = y_lim
+
+    return np.arange(
+        np.floor( min( ymin, 0. ) / tick_spacing ) * tick_spacing,
+        ymax,
+        tick_spacing,
+    )
+
+################################################################################
+
+def lineplot_spec(
+        aggregated_df,
+        total,
+        **lineplot_kw
+    ):
+    '''The lineplot as a Vega-Lite spec, which the browser renders,
+    instead of a matplotlib figure rendered on the server.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+        total (pd.DataFrame): The values per time bin, overall.
+        lineplot_kw (dict): The plotting keywords, as for lineplot.
+
+    Returns:
+        spec (dict): The Vega-Lite spec, with the data inline.
+    '''
+
+    values = get_spec_values( aggregated_df )
+    colors = get_spec_colors( aggregated_df.columns, lineplot_kw['category_colors'] )
+    if lineplot_kw['show_total']:
+        values += get_spec_values( total.set_axis( [ 'Total', ], axis='columns' ) )
+        colors['Total'] = '#000000'
+
+    if lineplot_kw['log_yscale']:
+        y_scale, y_axis = { 'type': 'log' }, {}
+    else:
+        y_scale = { 'domain': list( lineplot_kw['y_lim'] ) }
+        y_axis = { 'values': get_y_ticks( lineplot_kw['y_lim'], lineplot_kw['tick_spacing'] ).tolist() }
+
+    encoding = {
+        'x': get_spec_x( aggregated_df.index, lineplot_kw['x_label'] ),
+        'y': {
+            'field': 'value',
+            'type': 'quantitative',
+            'title': lineplot_kw['y_label'],
+            'scale': y_scale,
+            'axis': y_axis,
+        },
+        'color': get_spec_color( colors, lineplot_kw ),
+    }
+    layers = [
+        { 'mark': { 'type': 'line', 'strokeWidth': lineplot_kw['linewidth'], 'opacity': 0.5, 'clip': True } },
+        { 'mark': { 'type': 'circle', 'size': lineplot_kw['marker_size'], 'opacity': 1., 'clip': True } },
+    ]
+    if lineplot_kw.get( 'include_annotations', False ):
+        layers.append({
+            'transform': [ { 'filter': 'datum.is_last && datum.category != "Total"' }, ],
+            'mark': get_spec_annotation_mark( lineplot_kw ),
+            'encoding': { 'text': { 'field': 'category' } },
+        })
+
+    spec = {
+        'data': { 'values': values },
+        'encoding': encoding,
+        'layer': layers,
+    }
+    spec.update( get_spec_layout( lineplot_kw ) )
+
+    return spec
+
+################################################################################
+
+def get_spec_values( aggregated_df ):
+    '''The values as records for a Vega-Lite spec, one per time bin per category.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+
+    Returns:
+        values (list of dicts): Each with the time bin 'x', the 'category', its
+            'order' among the columns, the 'value', and whether it 'is_last' in time.
+    '''
+
+    xs = aggregated_df.index
+    if pd.api.types.is_datetime64_any_dtype( xs ):
+        xs = list( xs.strftime( '%Y-%m-%d' ) )
+    else:
+        xs = [ int( _ ) for _ in xs ]
+    categories = [ str( _ ) for _ in aggregated_df.columns ]
+    array = aggregated_df.to_numpy( dtype=float, na_value=np.nan )
+
+    values = [
+        {
+            'x': x,
+            'category': category,
+            'order': j,
+            'value': None if np.isnan( array[i,j] ) else float( array[i,j] ),
+            'is_last': i == len( xs ) - 1,
+        }
+        for i, x in enumerate( xs )
+        for j, category in enumerate( categories )
+    ]
+    return values
+
+################################################################################
+
+def get_spec_x( years, x_label ):
+    '''The x encoding for a Vega-Lite spec: dates for sub-year time bins,
+    otherwise whole years.
+
+    Args:
+        years (pd.Index): The time bins.
+        x_label (str): The x label.
+
+    Returns:
+        x (dict): The encoding.
+    '''
 
-    return plot_kw
+    if pd.api.types.is_datetime64_any_dtype( years ):
+        return { 'field': 'x', 'type': 'temporal', 'title': x_label }
+
+    years = [ int( _ ) for _ in years ]
+    x = {
+        'field': 'x',
+        'type': 'quantitative',
+        'title': x_label,
+        'scale': { 'domain': [ min( years ), max( years ) ] if len( years ) > 0 else [] },
+        'axis': { 'format': 'd', 'values': years },
+    }
+    return x
 
 ################################################################################
 
-def lineplot(
-        aggregated_df,
-        total,
-        **lineplot_kw
-    ):
-    '''Function to plot the counts.
+def get_spec_colors( categories, category_colors ):
+    '''The color of each category, as hex strings for a Vega-Lite spec.
 
     Args:
-        counts (pd.DataFrame): The dataframe containing the counts per year per category.
-        total (pd.Series): The series containing the counts per year, overall.
-        plot_kw (dict): The plotting keywords. Typically set things like font size, figure dimensions, etc.
+        categories (pd.Index): The categories.
+        category_colors (dict): The color of each category, in any matplotlib format.
 
     Returns:
-        fig (matplotlib.figure.Figure): The figure containing the plot.
+        colors (dict): The hex color of each category, by name.
     '''
 
-    if lineplot_kw['cumulative']:
-        aggregated_df = aggregated_df.cumsum( axis='rows' )
-        total = total.cumsum()
+    return {
+        str( category ): matplotlib.colors.to_hex( category_colors[category] )
+        for category in categories
+    }
 
-    years = aggregated_df.index
-    categories = aggregated_df.columns
+################################################################################
 
-    sns.set( font=lineplot_kw['font'], style=lineplot_kw['seaborn_style'] )
-    plot_context = sns.plotting_context("notebook")
+def get_spec_color( colors, plot_kw ):
+    '''The color encoding for a Vega-Lite spec, with a legend if requested.
 
-    fig = plt.figure( figsize=( lineplot_kw['fig_width'], lineplot_kw['fig_height'] ) )
-    ax = plt.gca()
-    for j, category_j in enumerate( categories ):
+    Args:
+        colors (dict): The output of get_spec_colors.
+        plot_kw (dict): The plotting keywords.
 
-        ys = aggregated_df[category_j]
+    Returns:
+        color (dict): The encoding.
+    '''
 
-        ax.plot(
-            years,
-            ys,
-            linewidth = lineplot_kw['linewidth'],
-            alpha = 0.5,
-            zorder = 2,
-            color = lineplot_kw['category_colors'][category_j],
-        )
-        ax.scatter(
-            years,
-            ys,
-            label = category_j,
-            zorder = 2,
-            color = lineplot_kw['category_colors'][category_j],
-            s = lineplot_kw['marker_size'],
-            )
+    if plot_kw.get( 'include_legend', False ):
+        plot_context = sns.plotting_context("notebook")
+        legend = {
+            'title': None,
+            'labelFontSize': plot_context['legend.fontsize'] * plot_kw['legend_scale'],
+        }
+    else:
+        legend = None
 
-        # Add labels
-        if lineplot_kw.get( 'include_annotations', False ):
-            label_y = ys.iloc[-1]
+    color = {
+        'field': 'category',
+        'type': 'nominal',
+        'scale': { 'domain': list( colors.keys() ), 'range': list( colors.values() ) },
+        'legend': legend,
+    }
+    return color
 
-            text = ax.annotate(
-                text = category_j,
-                xy = ( 1, label_y ),
-                xycoords = matplotlib.transforms.blended_transform_factory( ax.transAxes, ax.transData ),
-                xytext = ( -5 + 10 * ( lineplot_kw['annotations_horizontal_alignment'] == 'left' ), 0 ),
-                va = 'center',
-                ha = lineplot_kw['annotations_horizontal_alignment'],
-                textcoords = 'offset points',
-            )
-            text.set_path_effects([
-                path_effects.Stroke(linewidth=2.5, foreground='w'),
-                path_effects.Normal(),
-            ])
+################################################################################
 
-    if lineplot_kw['show_total']:
-        ax.plot(
-            years,
-            total,
-            linewidth = lineplot_kw['linewidth'],
-            alpha = 0.5,
-            color = 'k',
-            zorder = 1,
-        )
-        ax.scatter(
-            years,
-            total,
-            label = 'Total',
-            color = 'k',
-            zorder = 1,
-            s = lineplot_kw['marker_size'],
-        )
+def get_spec_annotation_mark( plot_kw ):
+    '''The mark for labelling the categories at the end of the plot.
 
-    ymax = lineplot_kw['y_lim'][1]
+    Args:
+        plot_kw (dict): The plotting keywords.
 
-    ax.set_xticks( years.astype( int ) )
-    count_ticks = np.arange( 0, ymax, lineplot_kw['tick_spacing'] )
-    ax.set_yticks( count_ticks )
+    Returns:
+        mark (dict): The mark.
+    '''
 
-    if lineplot_kw['log_yscale']:
-        ax.set_yscale( 'log' )
+    alignment = plot_kw['annotations_horizontal_alignment']
+    mark = {
+        'type': 'text',
+        'align': alignment,
+        'dx': -5 + 10 * ( alignment == 'left' ),
+        'stroke': 'white',
+        'strokeWidth': 2.5,
+        'strokeOpacity': 0.8,
+    }
+    return mark
 
-    ax.set_xlim( years[0], years[-1] )
-    ax.set_ylim( lineplot_kw['y_lim'] )
+################################################################################
 
+def get_spec_layout( plot_kw ):
+    '''The size and fonts of a Vega-Lite spec, matching the matplotlib figures.
 
-    if lineplot_kw.get( 'include_legend', False ):
-        l = ax.legend(
-            bbox_to_anchor = ( lineplot_kw['legend_x'], lineplot_kw['legend_y'] ),
-            loc = '{} {}'.format(
-                lineplot_kw['legend_vertical_alignment'],
-                lineplot_kw['legend_horizontal_alignment']
-            ), 
-            framealpha = 1.,
-            fontsize = plot_context['legend.fontsize'] * lineplot_kw['legend_scale'],
-            ncol = len( categories ) // 4 + 1
-        )
+    Args:
+        plot_kw (dict): The plotting keywords.
 
-    # Labels, inc. size
-    ax.set_xlabel( lineplot_kw['x_label'], fontsize=plot_context['axes.labelsize'] * lineplot_kw['font_scale'] )
-    ax.set_ylabel( lineplot_kw['y_label'], fontsize=plot_context['axes.labelsize'] * lineplot_kw['font_scale'] )
-    ax.tick_params( labelsize=plot_context['xtick.labelsize']*lineplot_kw['font_scale'] )
+    Returns:
+        layout (dict): The top-level properties of the spec.
+    '''
 
-    # return facet_grid
-    return fig
+    plot_context = sns.plotting_context("notebook")
+    layout = {
+        '$schema': 'https://vega.github.io/schema/vega-lite/v5.json',
+        'width': 'container',
+        'height': int( plot_kw['fig_height'] * matplotlib.rcParams['figure.dpi'] ),
+        'config': {
+            'font': plot_kw['font'],
+            'axis': {
+                'titleFontSize': plot_context['axes.labelsize'] * plot_kw['font_scale'],
+                'labelFontSize': plot_context['xtick.labelsize'] * plot_kw['font_scale'],
+            },
+        },
+    }
+    return layout
 
 ################################################################################
 
@@ -288,11 +2273,14 @@ def setup_stackplot_settings( st_loc, default_x_label, default_y_label ):
 
 ################################################################################
 
-def stackplot( aggregated_df, total, **stackplot_kw ):
+def stackplot( aggregated_df, total, pooled=None, **stackplot_kw ):
     '''Function to plot the relative contribution of the categories.
+    Transforms, e.g. cumulative values, are applied beforehand (see transform_aggregated).
 
     Args:
         counts (pd.DataFrame): The dataframe containing the counts per year per category.
+        pooled (dict): A figure borrowed from the pool (see pooled_figure). If it already
+            holds a stackplot, only the bands, labels, and limits are redrawn.
         stackplot_kw (dict): The plotting keywords. Typically set things like font size, figure dimensions, etc.
 
     Returns:
@@ -303,40 +2291,38 @@ def stackplot( aggregated_df, total, **stackplot_kw ):
     plot_context = sns.plotting_context("notebook")
 
 
-    if stackplot_kw['cumulative']:
-        aggregated_df = aggregated_df.cumsum( axis='rows' )
-
     years = aggregated_df.index
     categories = aggregated_df.columns
 
     # Get data
     sum_total = aggregated_df.sum( axis='columns' )
     fractions = aggregated_df.mul( 1./sum_total, axis='rows' ).fillna( value=0. )
-    
-    fig = plt.figure( figsize=( stackplot_kw['fig_width'], stackplot_kw['fig_height'] ) )
-    ax = plt.gca()
-    
-    stack = ax.stackplot(
-        years.astype( int ),
-        fractions.values.transpose(),
-        linewidth = 0.3,
-        colors = [ stackplot_kw['category_colors'][category_j] for category_j in categories ],
-        labels = categories,
-    )
-    ax.set_xlim( years[0], years[-1] )
+
+    # The axes, labels, and legend of a pooled stackplot are kept
+    if ( pooled is not None ) and ( pooled['artists'] is not None ):
+        fig = pooled['fig']
+        for poly_j in pooled['artists']['stack']:
+            poly_j.remove()
+        stack = draw_stack( fig, fractions, **stackplot_kw )
+        for text, poly_j in zip( pooled['artists']['annotations'], stack ):
+            text.xy = ( 1, get_stack_label_y( poly_j ) )
+        pooled['artists']['stack'] = stack
+        return fig
+
+    fig = create_figure( ( stackplot_kw['fig_width'], stackplot_kw['fig_height'] ) )
+    ax = fig.axes[0]
+
+    stack = draw_stack( fig, fractions, **stackplot_kw )
     ax.set_ylim( 0, 1. )
-    ax.set_xticks( years.astype( int ) )
     ax.set_ylabel( 'Fraction of Articles' )
 
     # Add labels
+    annotations = []
     if stackplot_kw.get( 'include_annotations', False ):
         for j, poly_j in enumerate( stack ):
 
             # The y labels are centered in the middle of the last band
-            vertices = poly_j.get_paths()[0].vertices
-            xs = vertices[:,0]
-            end_vertices = vertices[:,1][xs == xs.max()]
-            label_y = 0.5 * ( end_vertices.min() + end_vertices.max() )
+            label_y = get_stack_label_y( poly_j )
 
             text = ax.annotate(
                 text = fractions.columns[j],
@@ -351,6 +2337,7 @@ def stackplot( aggregated_df, total, **stackplot_kw ):
                 path_effects.Stroke(linewidth=2.5, foreground='w'),
                 path_effects.Normal(),
             ])
+            annotations.append( text )
 
     if stackplot_kw.get( 'include_legend', False ):
         l = ax.legend(
@@ -369,6 +2356,159 @@ def stackplot( aggregated_df, total, **stackplot_kw ):
     ax.set_ylabel( stackplot_kw['y_label'], fontsize=plot_context['axes.labelsize'] * stackplot_kw['font_scale'] )
     ax.tick_params( labelsize=plot_context['xtick.labelsize']*stackplot_kw['font_scale'] )
 
+    if pooled is not None:
+        pooled['fig'], pooled['artists'] = fig, { 'stack': stack, 'annotations': annotations }
+
+    return fig
+
+################################################################################
+
+def draw_stack( fig, fractions, **stackplot_kw ):
+    '''Draw the bands of a stackplot and set the x limits and ticks.
+
+    Args:
+        fig (matplotlib.figure.Figure): The figure to draw on.
+        fractions (pd.DataFrame): The fraction per time bin per category.
+        stackplot_kw (dict): The plotting keywords.
+
+    Returns:
+        stack (list of matplotlib.collections.PolyCollection): The bands.
+    '''
+
+    ax = fig.axes[0]
+    years = fractions.index
+
+    is_dates = pd.api.types.is_datetime64_any_dtype( years )
+    stack = ax.stackplot(
+        years if is_dates else years.astype( int ),
+        fractions.values.transpose(),
+        linewidth = 0.3,
+        colors = [ stackplot_kw['category_colors'][category_j] for category_j in fractions.columns ],
+        labels = fractions.columns,
+    )
+    ax.set_xlim( years[0], years[-1] )
+    if is_dates:
+        fig.autofmt_xdate()
+    else:
+        ax.set_xticks( years.astype( int ) )
+
+    return stack
+
+################################################################################
+
+def get_stack_label_y( poly ):
+    '''Where to label a band of a stackplot, the middle of its last edge.
+
+    Args:
+        poly (matplotlib.collections.PolyCollection): The band.
+
+    Returns:
+        label_y (float): The y position of the label.
+    '''
+
+    vertices = poly.get_paths()[0].vertices
+    xs = vertices[:,0]
+    end_vertices = vertices[:,1][xs == xs.max()]
+
+    return 0.5 * ( end_vertices.min() + end_vertices.max() )
+
+################################################################################
+
+def stackplot_spec( aggregated_df, total, **stackplot_kw ):
+    '''The stackplot as a Vega-Lite spec, which the browser renders,
+    instead of a matplotlib figure rendered on the server.
+
+    Args:
+        aggregated_df (pd.DataFrame): The values per time bin per category.
+        total (pd.DataFrame): The values per time bin, overall. Not used, included for symmetry.
+        stackplot_kw (dict): The plotting keywords, as for stackplot.
+
+    Returns:
+        spec (dict): The Vega-Lite spec, with the data inline.
+    '''
+
+    sum_total = aggregated_df.sum( axis='columns' )
+    fractions = aggregated_df.mul( 1./sum_total, axis='rows' ).fillna( value=0. )
+
+    encoding = {
+        'x': get_spec_x( aggregated_df.index, stackplot_kw['x_label'] ),
+        'y': {
+            'field': 'value',
+            'type': 'quantitative',
+            'title': stackplot_kw['y_label'],
+            'stack': 'zero',
+            'scale': { 'domain': [ 0., 1. ] },
+        },
+        'color': get_spec_color(
+            get_spec_colors( aggregated_df.columns, stackplot_kw['category_colors'] ),
+            stackplot_kw,
+        ),
+        # The first category is at the bottom, as for stackplot
+        'order': { 'field': 'order', 'type': 'quantitative' },
+    }
+    layers = [
+        {
+            'data': { 'values': get_spec_values( fractions ) },
+            'mark': { 'type': 'area', 'stroke': 'white', 'strokeWidth': 0.3 },
+            'encoding': encoding,
+        },
+    ]
+
+    # The labels are centered in the middle of the last band
+    if stackplot_kw.get( 'include_annotations', False ) and ( len( fractions ) > 0 ):
+        last = fractions.iloc[-1]
+        label_ys = last.cumsum() - 0.5 * last
+        labels = get_spec_values( pd.DataFrame( [ label_ys.values ], index=fractions.index[-1:], columns=fractions.columns ) )
+        layers.append({
+            'data': { 'values': labels },
+            'mark': get_spec_annotation_mark( stackplot_kw ),
+            'encoding': {
+                'x': encoding['x'],
+                'y': { 'field': 'value', 'type': 'quantitative' },
+                'text': { 'field': 'category' },
+            },
+        })
+
+    spec = { 'layer': layers }
+    spec.update( get_spec_layout( stackplot_kw ) )
+
+    return spec
+
+################################################################################
+
+def heatmap( matrix_df, **heatmap_kw ):
+    '''Function to plot a matrix of values, e.g. one grouping against another.
+
+    Args:
+        matrix_df (pd.DataFrame): The values, with a row per category of one grouping
+            and a column per category of the other (see get_cross_tab_matrix).
+        heatmap_kw (dict): The plotting keywords. Typically set things like font size, figure dimensions, etc.
+
+    Returns:
+        fig (matplotlib.figure.Figure): The figure containing the plot.
+    '''
+
+    sns.set( font=heatmap_kw['font'], style=heatmap_kw['seaborn_style'] )
+    plot_context = sns.plotting_context("notebook")
+
+    fig = create_figure( ( heatmap_kw['fig_width'], heatmap_kw['fig_height'] ) )
+    ax = fig.axes[0]
+
+    sns.heatmap(
+        matrix_df,
+        ax = ax,
+        cmap = heatmap_kw.get( 'cmap', 'viridis' ),
+        annot = heatmap_kw.get( 'include_annotations', False ),
+        fmt = '.3g',
+        linewidths = 0.5,
+        cbar_kws = { 'label': heatmap_kw.get( 'colorbar_label', '' ) },
+    )
+
+    # Labels, inc. size
+    ax.set_xlabel( heatmap_kw['x_label'], fontsize=plot_context['axes.labelsize'] * heatmap_kw['font_scale'] )
+    ax.set_ylabel( heatmap_kw['y_label'], fontsize=plot_context['axes.labelsize'] * heatmap_kw['font_scale'] )
+    ax.tick_params( labelsize=plot_context['xtick.labelsize']*heatmap_kw['font_scale'] )
+
     return fig
 
 ################################################################################
@@ -385,6 +2525,7 @@ def view_time_series(
         filetag = None,
         tag = '',
         df_tag = 'selected',
+        heatmap_kw = None,
     ):
 
     if tag != '':
@@ -403,21 +2544,19 @@ def view_time_series(
     if view == 'lineplot':
         # st.spinner provides a visual indicator that the data is loading
         with st.spinner():
-            fig = lineplot(
-                aggregated_df,
-                total,
-                **lineplot_kw
-            )
-
-            st.pyplot( fig )
+            # Vega-Lite specs are rendered by the browser, leaving little for the server to do
+            if lineplot_kw.get( 'renderer', 'matplotlib' ) == 'Vega-Lite':
+                st.vega_lite_chart( spec=lineplot_spec( aggregated_df, total, **lineplot_kw ), theme=None )
+            else:
+                # Rendered images are cached by content, so repeated views skip matplotlib
+                st.image( render_figure( view, aggregated_df, total, lineplot_kw ), width='stretch' )
         # Add a download button for the image
-        # The image is saved as PDF, enabling arbitrary resolution
+        # The image is saved as PDF, enabling arbitrary resolution.
+        # It's only rendered when the download is requested.
         fn = 'lineplot.{}.pdf'.format( filetag )
-        img = io.BytesIO()
-        fig.savefig( img, format='pdf', bbox_inches='tight' )
         download_kw = {
             'label': "Download Figure",
-            'data': img,
+            'data': functools.partial( export_figure, view, aggregated_df, total, lineplot_kw ),
             'file_name': fn,
             'mime': "text/pdf",
             'key': '{}lineplot'.format( tag ),
@@ -425,25 +2564,36 @@ def view_time_series(
 
     elif view == 'stackplot':
         with st.spinner():
-            fig = stackplot(
-                aggregated_df,
-                total,
-                **stackplot_kw
-            )
-            st.pyplot( fig )
+            if stackplot_kw.get( 'renderer', 'matplotlib' ) == 'Vega-Lite':
+                st.vega_lite_chart( spec=stackplot_spec( aggregated_df, total, **stackplot_kw ), theme=None )
+            else:
+                st.image( render_figure( view, aggregated_df, total, stackplot_kw ), width='stretch' )
 
         # Add a download button for the image
         fn = 'stackplot.{}.pdf'.format( filetag )
-        img = io.BytesIO()
-        fig.savefig( img, format='pdf', bbox_inches='tight' )
         download_kw = {
             'label': "Download Figure",
-            'data': img,
+            'data': functools.partial( export_figure, view, aggregated_df, total, stackplot_kw ),
             'file_name': fn,
             'mime': "text/pdf",
             'key': '{}stackplot'.format( tag ),
         }
 
+    elif view in [ 'heatmap', 'cooccurrence' ]:
+        # For heatmaps aggregated_df is the matrix, e.g. from get_cross_tab_matrix or get_cooccurrence
+        with st.spinner():
+            st.image( render_figure( view, aggregated_df, total, heatmap_kw ), width='stretch' )
+
+        # Add a download button for the image
+        fn = '{}.{}.pdf'.format( view, filetag )
+        download_kw = {
+            'label': "Download Figure",
+            'data': functools.partial( export_figure, view, aggregated_df, total, heatmap_kw ),
+            'file_name': fn,
+            'mime': "text/pdf",
+            'key': '{}{}'.format( tag, view ),
+        }
+
     elif view == 'data':
 
         @st.cache_data
@@ -467,13 +2617,11 @@ def view_time_series(
         with st.spinner():
             show_df = view_data( df_tag )
 
-        # Add a download button for the data
+        # Add a download button for the data, serialized only when requested
         fn = 'data.{}.csv'.format( filetag )
-        f = io.BytesIO()
-        selected_df.to_csv( f )
         download_kw = {
             'label': "Download Selected Data",
-            'data': f,
+            'data': functools.partial( export_data, selected_df ),
             'file_name': fn,
             'mime': "text/plain",
             'key': 'data.{}'.format( filetag ),
@@ -483,4 +2631,186 @@ def view_time_series(
         # Return here because we're also return the show_df
         return download_kw, show_df
 
-    return download_kw
\ No newline at end of file
+    return download_kw
+
+################################################################################
+# Rendering and exports
+################################################################################
+
+@st.cache_resource
+def get_render_cache():
+    '''The cache used by render_figure and export_data, shared between sessions.'''
+
+    cache = {
+        'entries': collections.OrderedDict(),
+        'n_bytes': 0,
+        'hits': 0,
+        'misses': 0,
+        'lock': threading.Lock(),
+    }
+    return cache
+
+################################################################################
+
+def get_render_cache_stats():
+    '''Summarize the render cache, e.g. for monitoring.
+
+    Returns:
+        stats (dict): The number of 'entries', their size in 'n_bytes',
+            the number of 'hits' and 'misses', and the 'hit_rate'.
+    '''
+
+    cache = get_render_cache()
+    with cache['lock']:
+        n_lookups = cache['hits'] + cache['misses']
+        stats = {
+            'entries': len( cache['entries'] ),
+            'n_bytes': cache['n_bytes'],
+            'hits': cache['hits'],
+            'misses': cache['misses'],
+            'hit_rate': cache['hits'] / n_lookups if n_lookups > 0 else np.nan,
+        }
+    return stats
+
+################################################################################
+
+def get_content_hash( *contents ):
+    '''Hash what is rendered, e.g. the plotted data and the plotting keywords,
+    so identical renders share a cache entry.
+
+    Args:
+        contents: Dataframes, which are hashed by value, and other objects,
+            which are hashed by their repr. Dicts are hashed by their sorted items.
+
+    Returns:
+        content_hash (str): Hex digest.
+    '''
+
+    content_hash = hashlib.sha1()
+    for content in contents:
+        if isinstance( content, ( pd.DataFrame, pd.Series ) ):
+            content_hash.update( pd.util.hash_pandas_object( content, index=True ).values.tobytes() )
+            content_hash.update( repr( content.columns if isinstance( content, pd.DataFrame ) else content.name ).encode() )
+        elif isinstance( content, dict ):
+            content_hash.update( repr( sorted( content.items(), key=lambda item: str( item[0] ) ) ).encode() )
+        else:
+            content_hash.update( repr( content ).encode() )
+
+    return content_hash.hexdigest()
+
+################################################################################
+
+def get_cached_render( key, render_fn, max_bytes=64 * 2**20 ):
+    '''Look up rendered bytes, rendering them if they aren't cached.
+    Least-recently-used entries are evicted to keep the cache under max_bytes.
+
+    Args:
+        key (tuple): The cache key, which identifies the content.
+        render_fn (callable): Produces the bytes.
+        max_bytes (int): The maximum total size of the entries.
+
+    Returns:
+        rendered (bytes): The rendered file.
+    '''
+
+    cache = get_render_cache()
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['hits'] += 1
+            cache['entries'].move_to_end( key )
+            return cache['entries'][key]
+        cache['misses'] += 1
+
+    # Rendering is slow, so other lookups aren't held up by it
+    rendered = render_fn()
+
+    with cache['lock']:
+        if key not in cache['entries']:
+            cache['entries'][key] = rendered
+            cache['n_bytes'] += len( rendered )
+        cache['entries'].move_to_end( key )
+        while ( cache['n_bytes'] > max_bytes ) and ( len( cache['entries'] ) > 1 ):
+            _, evicted = cache['entries'].popitem( last=False )
+            cache['n_bytes'] -= len( evicted )
+
+    return rendered
+
+################################################################################
+
+def render_figure( view, aggregated_df, total, plot_kw, file_format='png' ):
+    '''Render a figure to bytes, e.g. a PNG to show or a PDF to download.
+    Cached by the content hash of the data, the plotting keywords, and the
+    format, so repeated views skip matplotlib entirely. Otherwise lineplots and
+    stackplots are drawn on pooled figures (see pooled_figure).
+
+    Args:
+        view (str): 'lineplot', 'stackplot', 'heatmap', or 'cooccurrence'.
+        aggregated_df (pd.DataFrame): The plotted values. For heatmaps the matrix.
+        total (pd.DataFrame): The values per time bin, overall.
+        plot_kw (dict): The plotting keywords.
+        file_format (str): 'png', 'svg', or 'pdf'.
+
+    Returns:
+        rendered (bytes): The figure file.
+    '''
+
+    # The same resolution as st.pyplot
+    savefig_kw = { 'format': file_format, 'bbox_inches': 'tight' }
+    if file_format == 'png':
+        savefig_kw['dpi'] = 200
+
+    def render():
+        img = io.BytesIO()
+        if view in [ 'lineplot', 'stackplot' ]:
+            plot_fn = lineplot if view == 'lineplot' else stackplot
+            data_keys = [ 'y_lim', 'tick_spacing' ] if view == 'lineplot' else []
+            with pooled_figure( view, get_layout_key( aggregated_df, plot_kw, data_keys ) ) as pooled:
+                fig = plot_fn( aggregated_df, total, pooled=pooled, **plot_kw )
+                fig.savefig( img, **savefig_kw )
+        elif view in [ 'heatmap', 'cooccurrence' ]:
+            fig = heatmap( aggregated_df, **plot_kw )
+            fig.savefig( img, **savefig_kw )
+            close_figure( fig )
+        else:
+            raise KeyError( 'Unrecognized view, {}'.format( view ) )
+        return img.getvalue()
+
+    key = ( 'figure', view, file_format, get_content_hash( aggregated_df, total, plot_kw ) )
+
+    return get_cached_render( key, render )
+
+################################################################################
+
+def export_figure( view, aggregated_df, total, plot_kw, file_format='pdf' ):
+    '''Render a figure to a file. Used as the data of a download button,
+    so it only runs when the download is requested.
+
+    Args:
+        view (str): 'lineplot', 'stackplot', 'heatmap', or 'cooccurrence'.
+        aggregated_df (pd.DataFrame): The plotted values. For heatmaps the matrix.
+        total (pd.DataFrame): The values per time bin, overall.
+        plot_kw (dict): The plotting keywords.
+        file_format (str): The file format, e.g. 'pdf'.
+
+    Returns:
+        exported (bytes): The figure file.
+    '''
+
+    return render_figure( view, aggregated_df, total, plot_kw, file_format )
+
+################################################################################
+
+def export_data( df ):
+    '''Write data to CSV. Used as the data of a download button,
+    so it only runs when the download is requested. Cached by the content hash of the data.
+
+    Args:
+        df (pd.DataFrame): The data.
+
+    Returns:
+        exported (bytes): The CSV file.
+    '''
+
+    key = ( 'data', get_content_hash( df ) )
+
+    return get_cached_render( key, lambda: df.to_csv().encode() )
@@ -1,8 +1,11 @@
 import copy
 import glob
+import json
 import numpy as np
 import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
 import streamlit as st
 import yaml
@@ -12,7 +15,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patheffects as path_effects
 import seaborn as sns
 
-from press_dash_lib import data_utils
+from press_dash_lib import data_utils, time_series_utils
 
 ################################################################################
 
@@ -51,6 +54,126 @@ def load_data( config ):
 
 ################################################################################
 
+def get_processed_data_fp( config, tag=None, ext=None ):
+    '''Get the filepath for a processed-data file, e.g. press.articles.parquet.
+
+    Args:
+        config (dict): The config dictionary.
+        tag (str): Tag appended to the base filename, e.g. 'articles'.
+        ext (str): File extension. Defaults to that of config['combined_filename'].
+
+    Returns:
+        fp (str): The filepath.
+    '''
+
+    base, default_ext = os.path.splitext( config['combined_filename'] )
+    if tag is not None:
+        base = '{}.{}'.format( base, tag )
+    if ext is None:
+        ext = default_ext
+    output_dir = os.path.join( config['data_dir'], config['output_dirname'] )
+
+    return os.path.join( output_dir, base + ext )
+
+################################################################################
+
+def use_columnar_store( config ):
+    '''Check if the processed data should be read from/written to the columnar store.
+
+    Args:
+        config (dict): The config dictionary.
+
+    Returns:
+        use_store (bool): True if config['processed_data_format'] is 'parquet'.
+    '''
+
+    return config.get( 'processed_data_format', 'csv' ) == 'parquet'
+
+################################################################################
+
+def encode_processed_data( df, config ):
+    '''Give the processed data its final types, so that nothing needs to be
+    parsed, inferred, or filled when it's loaded.
+
+    Args:
+        df (pd.DataFrame): The processed data.
+        config (dict): The config dictionary.
+
+    Returns:
+        df (pd.DataFrame): The typed data. Grouping columns are categorical.
+    '''
+
+    df = df.copy()
+
+    # Numeric columns. Missing weights count as zero.
+    weight_columns = [ _ for _ in config['weight_columns'] if _ in df.columns ]
+    df[weight_columns] = df[weight_columns].fillna( value=0 ).astype( 'Int64' )
+    for year_column in config['year_columns']:
+        if year_column in df.columns:
+            df[year_column] = df[year_column].astype( 'Int64' )
+
+    # Everything else that's missing is marked as such
+    str_columns = df.columns[df.dtypes == object]
+    df[str_columns] = df[str_columns].fillna( value='N/A' )
+
+    # Grouping columns have few unique values, so we dictionary-encode them
+    for group_by_i in config['groupings']:
+        if group_by_i in df.columns:
+            df[group_by_i] = df[group_by_i].astype( 'category' )
+
+    return df
+
+################################################################################
+
+def save_processed_data( df, config, tag=None, metadata={}, encode=True ):
+    '''Save processed data to the typed columnar store (Parquet).
+
+    Args:
+        df (pd.DataFrame): The processed data.
+        config (dict): The config dictionary.
+        tag (str): Tag appended to the base filename, e.g. 'articles'.
+        metadata (dict of strs): Saved in the Parquet schema, e.g. the hash of
+            the definitions the data was computed with (see load_processed_data_metadata).
+        encode (bool): Whether to type and fill the data first (see encode_processed_data).
+            Data that is already typed, e.g. with meaningful missing values, is saved as is.
+
+    Returns:
+        fp (str): Where the data was saved.
+    '''
+
+    fp = get_processed_data_fp( config, tag=tag, ext='.parquet' )
+    os.makedirs( os.path.dirname( fp ), exist_ok=True )
+
+    # Unlike DataFrame.attrs, schema metadata round-trips on any version of pandas
+    if encode:
+        df = encode_processed_data( df, config )
+    table = pa.Table.from_pandas( df )
+    schema_metadata = dict( table.schema.metadata or {} )
+    schema_metadata.update( { key.encode(): value.encode() for key, value in metadata.items() } )
+    pq.write_table( table.replace_schema_metadata( schema_metadata ), fp )
+
+    return fp
+
+################################################################################
+
+def load_processed_data_metadata( config, tag=None ):
+    '''Load the metadata saved with processed data, without loading the data.
+
+    Args:
+        config (dict): The config dictionary.
+        tag (str): Tag appended to the base filename, e.g. 'articles'.
+
+    Returns:
+        metadata (dict of strs): The metadata passed to save_processed_data.
+    '''
+
+    fp = get_processed_data_fp( config, tag=tag, ext='.parquet' )
+    schema_metadata = pq.read_schema( fp ).metadata or {}
+
+    return { key.decode(): value.decode() for key, value in schema_metadata.items() }
+
+################################################################################
+
 def load_processed_data( config ):
     '''Load the merged-but-unprocessed data.
 
@@ -61,8 +184,12 @@ def load_processed_data( config ):
         original_df (pd.DataFrame): The dataframe containing the original data.
     '''
 
-    output_dir = os.path.join( config['data_dir'], config['output_dirname'] )
-    press_fp = os.path.join( output_dir, config['combined_filename'] )
+    # The columnar store is already typed and filled
+    parquet_fp = get_processed_data_fp( config, ext='.parquet' )
+    if use_columnar_store( config ) and os.path.isfile( parquet_fp ):
+        return pd.read_parquet( parquet_fp )
+
+    press_fp = get_processed_data_fp( config )
     original_df = pd.read_csv( press_fp, index_col=0 )
 
     original_df[['Press Mentions', 'People Reached']] = original_df[['Press Mentions','People Reached']].fillna( value=0 )
@@ -84,17 +211,52 @@ def load_exploded_processed_data( config ):
         df (pd.DataFrame): The dataframe containing the df data.
     '''
 
-    base, ext = os.path.splitext( config['combined_filename'] )
-    df_filename = '{}.exploded{}'.format( base, ext )
-    output_dir = os.path.join( config['data_dir'], config['output_dirname'] )
-    df_fp = os.path.join( output_dir, df_filename )
+    df_fp = get_processed_data_fp( config, tag='exploded' )
     df = pd.read_csv( df_fp )
 
     return df
 
 ################################################################################
 
-def preprocess_data( df, config ):
+def processed_data_is_current( config, tag='articles' ):
+    '''Check if the columnar store exists and is newer than the raw data,
+    in which case the dashboard can skip loading and preprocessing the raw data.
+
+    Args:
+        config (dict): The config dictionary.
+        tag (str): Which file in the store to check, e.g. 'articles' or 'cube'.
+
+    Returns:
+        is_current (bool): True if the store can be used.
+    '''
+
+    parquet_fp = get_processed_data_fp( config, tag=tag, ext='.parquet' )
+    if not use_columnar_store( config ) or not os.path.isfile( parquet_fp ):
+        return False
+
+    input_dir = os.path.join( config['data_dir'], config['input_dirname'] )
+    raw_fps = (
+        glob.glob( os.path.join( input_dir, config['website_data_file_pattern'] ) ) +
+        glob.glob( os.path.join( input_dir, config['press_office_data_file_pattern'] ) )
+    )
+    if len( raw_fps ) == 0:
+        return True
+
+    return os.path.getmtime( parquet_fp ) >= max([ os.path.getmtime( _ ) for _ in raw_fps ])
+
+################################################################################
+
+def clean_data( df, config ):
+    '''Cleaning shared by all the preprocessing, e.g. dropping drafts and
+    filling NaNs. One row per article.
+
+    Args:
+        df (pd.DataFrame): The combined data, as returned by load_data.
+        config (dict): The config dictionary.
+
+    Returns:
+        df (pd.DataFrame): The cleaned data, with the article ID as a column.
+    '''
 
     # Drop drafts
     df.drop( df.index[df['Date'].dt.year == 1970], axis='rows', inplace=True )
@@ -119,13 +281,431 @@ def preprocess_data( df, config ):
     for column in [ 'Press Mentions', 'People Reached' ]:
         df[column] = df[column].astype( 'Int64' )
 
+    df['id'] = df.index
+
+    return df
+
+################################################################################
+
+def preprocess_data( df, config ):
+
+    df = clean_data( df, config )
+
     # Now explode the data
     for group_by_i in config['groupings']:
         df[group_by_i] = df[group_by_i].str.split( '|' )
         df = df.explode( group_by_i )
 
     # Exploding the data results in duplicate IDs, so let's set up some new, unique IDs.
-    df['id'] = df.index
     df.set_index( np.arange( len(df) ), inplace=True )
 
+    # Same types as the columnar store
+    df = encode_processed_data( df, config )
+
     return df, config
+
+################################################################################
+
+def preprocess_normalized_data( df, config ):
+    '''Preprocess the data into one article table plus one bridge table per
+    grouping, instead of exploding it.
+
+    Args:
+        df (pd.DataFrame): The combined data, as returned by load_data.
+        config (dict): The config dictionary.
+
+    Returns:
+        articles_df (pd.DataFrame): One row per article, without the grouping columns.
+        bridges (dict of pd.DataFrames): For each grouping, one row per (id, category) pair.
+        config (dict): The config dictionary.
+    '''
+
+    df = clean_data( df, config )
+    df.set_index( np.arange( len(df) ), inplace=True )
+
+    articles_df, bridges = data_utils.normalize_data( df, config['groupings'] )
+    articles_df = encode_processed_data( articles_df, config )
+
+    return articles_df, bridges, config
+
+################################################################################
+
+def save_normalized_processed_data( articles_df, bridges, config ):
+    '''Save the article and bridge tables to the columnar store.
+
+    Args:
+        articles_df (pd.DataFrame): One row per article.
+        bridges (dict of pd.DataFrames): For each grouping, one row per (id, category) pair.
+        config (dict): The config dictionary.
+
+    Returns:
+        fps (list of str): Where the data was saved.
+    '''
+
+    fps = [ save_processed_data( articles_df, config, tag='articles' ), ]
+    for group_by_i, bridge in bridges.items():
+        fps.append( save_processed_data( bridge, config, tag=get_bridge_tag( group_by_i ) ) )
+
+    return fps
+
+################################################################################
+
+def load_normalized_processed_data( config ):
+    '''Load the article and bridge tables from the columnar store.
+
+    Args:
+        config (dict): The config dictionary.
+
+    Returns:
+        articles_df (pd.DataFrame): One row per article.
+        bridges (dict of pd.DataFrames): For each grouping, one row per (id, category) pair.
+    '''
+
+    articles_df = pd.read_parquet( get_processed_data_fp( config, tag='articles', ext='.parquet' ) )
+    bridges = {}
+    for group_by_i in config['groupings']:
+        bridge_fp = get_processed_data_fp( config, tag=get_bridge_tag( group_by_i ), ext='.parquet' )
+        bridges[group_by_i] = pd.read_parquet( bridge_fp )
+
+    return articles_df, bridges
+
+################################################################################
+
+def get_bridge_tag( group_by ):
+    '''Filename tag for a bridge table, e.g. 'bridge.research_topics'.'''
+
+    return 'bridge.{}'.format( group_by.lower().replace( ' ', '_' ) )
+
+################################################################################
+
+def get_recategorized_tag( combine_single_categories ):
+    '''Filename tag for precomputed recategorized data, e.g. 'recategorized.combined'.'''
+
+    if combine_single_categories:
+        return 'recategorized.combined'
+    return 'recategorized'
+
+################################################################################
+
+def save_recategorized_data( df, config, bridges=None ):
+    '''Precompute both recategorized variants (with and without combining single
+    categories) and save them to the columnar store, tagged with the hash of
+    config['new_categories'].
+
+    Args:
+        df (pd.DataFrame): The data to recategorize, as for data_utils.recategorize_data.
+        config (dict): The config dictionary.
+        bridges (dict of pd.DataFrames): Bridge tables, if df is normalized.
+
+    Returns:
+        fps (list of str): Where the data was saved.
+    '''
+
+    recategorized_columns = [
+        data_utils.parse_new_categories_key( _ )[0]
+        for _ in config['new_categories'].keys()
+    ]
+
+    fps = []
+    for combine_single_categories in [ False, True ]:
+        recategorized = data_utils.recategorize_data(
+            df,
+            config['new_categories'],
+            True,
+            combine_single_categories,
+            bridges=bridges,
+        )
+        recategorized = recategorized[['id'] + recategorized_columns]
+        fps.append( save_processed_data(
+            recategorized,
+            config,
+            tag=get_recategorized_tag( combine_single_categories ),
+            metadata={ 'new_categories_hash': data_utils.hash_new_categories( config['new_categories'] ) },
+        ) )
+
+    return fps
+
+################################################################################
+
+def load_recategorized_data( config, combine_single_categories=False ):
+    '''Load precomputed recategorized columns from the columnar store.
+
+    Args:
+        config (dict): The config dictionary.
+        combine_single_categories (bool): Which variant to load.
+
+    Returns:
+        recategorized (pd.DataFrame or None): The recategorized columns, indexed by id.
+            None if they're missing, older than the raw data, or were computed
+            with definitions different from config['new_categories'].
+    '''
+
+    tag = get_recategorized_tag( combine_single_categories )
+    if not processed_data_is_current( config, tag=tag ):
+        return None
+
+    metadata = load_processed_data_metadata( config, tag=tag )
+    if metadata.get( 'new_categories_hash' ) != data_utils.hash_new_categories( config['new_categories'] ):
+        return None
+
+    recategorized = pd.read_parquet( get_processed_data_fp( config, tag=tag, ext='.parquet' ) )
+
+    return recategorized.set_index( 'id' )
+
+################################################################################
+
+def get_recategorized_data(
+        df,
+        config,
+        recategorize=True,
+        combine_single_categories=False,
+        bridges=None,
+        data_versions=None,
+    ):
+    '''Recategorize the data, using the columns precomputed by the pipeline when
+    they match the active config and falling back to data_utils.recategorize_data otherwise.
+
+    Args:
+        df (pd.DataFrame): The data to recategorize, as for data_utils.recategorize_data.
+        config (dict): The config dictionary.
+        recategorize (bool): Whether to recategorize the data. Included for caching.
+        combine_single_categories (bool): Whether to put undefined categories in 'Other'.
+        bridges (dict of pd.DataFrames): Bridge tables, if df is normalized.
+        data_versions (dict of strs): Identifies the data per grouping (see data_utils.get_data_versions).
+
+    Returns:
+        recategorized (pd.DataFrame): The dataframe containing the recategorized data.
+            One entry per article.
+    '''
+
+    if not recategorize:
+        return df
+
+    precomputed = load_recategorized_data( config, combine_single_categories )
+    if ( precomputed is None ) or ( not df['id'].isin( precomputed.index ).all() ):
+        return data_utils.recategorize_data(
+            df,
+            config['new_categories'],
+            recategorize,
+            combine_single_categories,
+            bridges=bridges,
+            data_versions=data_versions,
+        )
+
+    recategorized = df.drop_duplicates( subset='id', keep='first' ).set_index( 'id' )
+    for column in precomputed.columns:
+        recategorized[column] = precomputed[column]
+    recategorized.reset_index( inplace=True )
+
+    return recategorized
+
+################################################################################
+
+def get_recategorization_tag( recategorize=True, combine_single_categories=False ):
+    '''Label for how the data was recategorized, e.g. 'original' or 'recategorized.combined'.'''
+
+    if not recategorize:
+        return 'original'
+    return get_recategorized_tag( combine_single_categories )
+
+################################################################################
+
+def update_aggregate_states( df, config, bridges=None ):
+    '''Bring the aggregates kept in the columnar store up to date with df,
+    applying only the articles that were added, changed, or removed since they
+    were last updated. They're rebuilt from scratch if the settings changed.
+
+    Args:
+        df (pd.DataFrame): One row per article, as for data_utils.recategorize_data.
+        config (dict): The config dictionary.
+        bridges (dict of pd.DataFrames): Bridge tables, if df is normalized.
+
+    Returns:
+        states (dict): For each ( recategorization, year_column, groupby_column ),
+            the aggregate state (see time_series_utils.build_aggregate_state).
+    '''
+
+    settings = {
+        'new_categories_hash': data_utils.hash_new_categories( config['new_categories'] ),
+        'year_columns': config['year_columns'],
+        'categorical_columns': config['categorical_columns'],
+        'id_columns': config['id_columns'],
+        'weight_columns': config['weight_columns'],
+    }
+    recategorizations = {
+        get_recategorization_tag( False ): ( False, False ),
+        get_recategorization_tag( True, False ): ( True, False ),
+        get_recategorization_tag( True, True ): ( True, True ),
+    }
+
+    state_dir = get_processed_data_fp( config, tag='aggregate_state', ext='' )
+    saved = load_aggregate_states( state_dir )
+    if ( saved is None ) or ( saved['settings'] != settings ):
+        saved = {
+            'settings': settings,
+            'hashes': pd.Series( dtype=np.uint64 ),
+            'states': {
+                ( recategorization, year_column, groupby_column ): time_series_utils.build_aggregate_state(
+                    year_column,
+                    groupby_column,
+                    config['id_columns'],
+                    config['weight_columns'],
+                )
+                for recategorization in recategorizations
+                for year_column in config['year_columns']
+                for groupby_column in config['categorical_columns']
+            },
+        }
+
+    # Only the articles that changed are recategorized and aggregated
+    hashes = data_utils.hash_articles( df, bridges )
+    changed_ids, removed_ids = data_utils.get_article_delta( saved['hashes'], hashes )
+    changed_df = df.loc[df['id'].isin( changed_ids )]
+    changed_bridges = None
+    if bridges is not None:
+        changed_bridges = { key: bridge.loc[bridge['id'].isin( changed_ids )] for key, bridge in bridges.items() }
+
+    changed_dfs = {}
+    for recategorization, ( recategorize, combine_single_categories ) in recategorizations.items():
+        if not recategorize or len( changed_df ) == 0:
+            changed_dfs[recategorization] = changed_df
+            continue
+        changed_dfs[recategorization] = data_utils.recategorize_data(
+            changed_df,
+            config['new_categories'],
+            True,
+            combine_single_categories,
+            bridges=changed_bridges,
+        )
+
+    for ( recategorization, year_column, groupby_column ), state in saved['states'].items():
+        time_series_utils.update_aggregate_state(
+            state,
+            changed_dfs[recategorization],
+            bridges=changed_bridges,
+            removed_ids=removed_ids,
+        )
+    saved['hashes'] = hashes
+
+    save_aggregate_states( saved, state_dir )
+
+    return saved['states']
+
+################################################################################
+
+def save_aggregate_states( saved, state_dir ):
+    '''Save the aggregate states as Parquet tables plus JSON settings,
+    so that loading them never executes code, unlike unpickling.
+
+    Args:
+        saved (dict): Contains the 'settings', the article 'hashes', and the 'states'
+            (see update_aggregate_states).
+        state_dir (str): The directory to save them in.
+    '''
+
+    os.makedirs( state_dir, exist_ok=True )
+    metadata, tables = time_series_utils.get_tables_from_states( saved['states'] )
+    with open( os.path.join( state_dir, 'settings.json' ), 'w' ) as f:
+        json.dump( { 'settings': saved['settings'], 'states': metadata }, f )
+    pd.DataFrame( {
+        'id': saved['hashes'].index,
+        'hash': saved['hashes'].values,
+    } ).to_parquet( os.path.join( state_dir, 'hashes.parquet' ) )
+    for name, table in tables.items():
+        table.to_parquet( os.path.join( state_dir, '{}.parquet'.format( name ) ) )
+
+################################################################################
+
+def load_aggregate_states( state_dir ):
+    '''Load the aggregate states saved by save_aggregate_states.
+
+    Args:
+        state_dir (str): The directory they were saved in.
+
+    Returns:
+        saved (dict or None): Contains the 'settings', the article 'hashes', and the 'states'.
+            None if they haven't been saved.
+    '''
+
+    settings_fp = os.path.join( state_dir, 'settings.json' )
+    if not os.path.isfile( settings_fp ):
+        return None
+
+    with open( settings_fp, 'r' ) as f:
+        settings = json.load( f )
+    hashes = pd.read_parquet( os.path.join( state_dir, 'hashes.parquet' ) )
+    tables = {
+        name: pd.read_parquet( os.path.join( state_dir, '{}.parquet'.format( name ) ) )
+        for name in [ 'rows', 'counters', 'value_counts' ]
+    }
+
+    saved = {
+        'settings': settings['settings'],
+        'hashes': pd.Series( hashes['hash'].to_numpy( dtype=np.uint64 ), index=pd.Index( hashes['id'] ) ),
+        'states': time_series_utils.get_states_from_tables( settings['states'], tables ),
+    }
+    return saved
+
+################################################################################
+
+def save_aggregate_cube( df, config, bridges=None ):
+    '''Aggregate every metric for every recategorization, year column, and
+    categorical column, and save the result to the columnar store,
+    tagged with the hash of config['new_categories'].
+    The aggregates are updated incrementally (see update_aggregate_states).
+
+    Args:
+        df (pd.DataFrame): The data, as for data_utils.recategorize_data.
+        config (dict): The config dictionary.
+        bridges (dict of pd.DataFrames): Bridge tables, if df is normalized.
+
+    Returns:
+        fp (str): Where the cube was saved.
+    '''
+
+    states = update_aggregate_states( df, config, bridges=bridges )
+    cube = pd.concat(
+        [
+            time_series_utils.stack_aggregated(
+                time_series_utils.get_aggregates_from_state( state ),
+                recategorization,
+                year_column,
+                groupby_column,
+                state['exclusive_categories'],
+            )
+            for ( recategorization, year_column, groupby_column ), state in states.items()
+        ],
+        ignore_index=True,
+    )
+
+    # Totals have a missing category, which mustn't be filled in with 'N/A', a category in its own right
+    return save_processed_data(
+        cube,
+        config,
+        tag='cube',
+        metadata={ 'new_categories_hash': data_utils.hash_new_categories( config['new_categories'] ) },
+        encode=False,
+    )
+
+################################################################################
+
+def load_aggregate_cube( config ):
+    '''Load the aggregate cube from the columnar store.
+
+    Args:
+        config (dict): The config dictionary.
+
+    Returns:
+        cube (pd.DataFrame or None): The cube, as returned by time_series_utils.build_aggregate_cube.
+            None if it's missing, older than the raw data, or was computed
+            with definitions different from config['new_categories'].
+    '''
+
+    if not processed_data_is_current( config, tag='cube' ):
+        return None
+
+    metadata = load_processed_data_metadata( config, tag='cube' )
+    if metadata.get( 'new_categories_hash' ) != data_utils.hash_new_categories( config['new_categories'] ):
+        return None
+
+    return pd.read_parquet( get_processed_data_fp( config, tag='cube', ext='.parquet' ) )
@@ -21,13 +21,15 @@ setuptools.setup(
         'numpy',
         'pandas',
         'openpyxl',
+        'pyarrow',
         'matplotlib',
         'seaborn',
+        'scipy',
         'sympy',
         'nbconvert',
         'nbformat',
         'PyYAML',
-        'streamlit',
+        'streamlit>=1.52',
         'pytest',
         'ipython',
         'jupyter',
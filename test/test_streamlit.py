@@ -1,16 +1,24 @@
 import unittest
 
+import altair as alt
+import copy
 import glob
 import fileinput
+import io
+import json
 import numpy as np
 import os
 import pandas as pd
+import re
+import seaborn as sns
 import shutil
 import streamlit as st
 import subprocess
 import yaml
 
-from press_dash_lib import dash_utils, data_utils, time_series_utils
+import matplotlib.pyplot as plt
+
+from press_dash_lib import dash_utils, data_utils, index_utils, time_series_utils, user_utils
 from .lib_for_tests import press_data_utils
 
 def copy_config( root_config_fp, config_fp ):
@@ -53,6 +61,28 @@ class TestDashboardSetupPressData( unittest.TestCase ):
 
     ###############################################################################
 
+    def test_font_catalog( self ):
+
+        catalog_fp = os.path.join( self.data_dir, 'font_catalog.json' )
+        try:
+            font_catalog = dash_utils.get_font_catalog( catalog_fp )
+            assert len( font_catalog['fonts'] ) == len( font_catalog['font_names'] ) > 0
+            assert font_catalog['font_names'][font_catalog['default_index']] == plt.rcParams['font.sans-serif'][0]
+
+            # The saved catalog is reused while the font directories are unchanged
+            with open( catalog_fp, 'r' ) as f:
+                saved_catalog = json.load( f )
+            assert saved_catalog == font_catalog
+            saved_catalog['fonts'] = [ 'Saved' for _ in saved_catalog['fonts'] ]
+            with open( catalog_fp, 'w' ) as f:
+                json.dump( saved_catalog, f )
+            assert dash_utils.get_font_catalog.__wrapped__( catalog_fp ) == saved_catalog
+        finally:
+            if os.path.isfile( catalog_fp ):
+                os.remove( catalog_fp )
+
+    ###############################################################################
+
     def test_load_original_data( self ):
 
         config = dash_utils.load_config( self.config_fp )
@@ -92,6 +122,91 @@ class TestDashboardSetupPressData( unittest.TestCase ):
                 original_df[groupby_column]
             )
 
+    ###############################################################################
+
+    def test_columnar_store( self ):
+
+        config = dash_utils.load_config( self.config_fp )
+        csv_df = user_utils.load_exploded_processed_data( config )
+
+        # Save to the store and load back
+        fp = user_utils.save_processed_data( csv_df, config, tag='exploded' )
+        try:
+            df = pd.read_parquet( fp )
+        finally:
+            os.remove( fp )
+
+        # Loaded data is typed and filled
+        for groupby_column in config['groupings']:
+            assert isinstance( df[groupby_column].dtype, pd.CategoricalDtype )
+            np.testing.assert_array_equal(
+                df[groupby_column].astype( str ),
+                csv_df[groupby_column].fillna( 'N/A' ),
+            )
+        assert df['Press Mentions'].dtype == 'Int64'
+        assert df['Press Mentions'].isna().sum() == 0
+        assert len( df ) == len( csv_df )
+
+    ###############################################################################
+
+    def test_precomputed_recategorized_data( self ):
+
+        config = dash_utils.load_config( self.config_fp )
+        df = user_utils.load_data( config )
+        articles_df, bridges, config = user_utils.preprocess_normalized_data( df, config )
+
+        fps = user_utils.save_recategorized_data( articles_df, config, bridges=bridges )
+        try:
+            # The definitions' hash is saved in the schema, not just in DataFrame.attrs
+            metadata = user_utils.load_processed_data_metadata( config, tag=user_utils.get_recategorized_tag( False ) )
+            assert metadata['new_categories_hash'] == data_utils.hash_new_categories( config['new_categories'] )
+
+            for combine_single_categories in [ False, True ]:
+                assert user_utils.load_recategorized_data( config, combine_single_categories ) is not None
+
+                recategorized = user_utils.get_recategorized_data(
+                    articles_df, config, True, combine_single_categories, bridges=bridges )
+                expected = data_utils.recategorize_data(
+                    articles_df, config['new_categories'], True, combine_single_categories, bridges=bridges )
+                for groupby_column in config['groupings']:
+                    np.testing.assert_array_equal(
+                        recategorized[groupby_column].astype( str ),
+                        expected[groupby_column],
+                    )
+
+            # Precomputed data for other definitions is not used
+            config['new_categories']['Press Types'] = {}
+            assert user_utils.load_recategorized_data( config ) is None
+        finally:
+            for fp in fps:
+                os.remove( fp )
+
+    ###############################################################################
+
+    def test_saved_aggregate_cube( self ):
+
+        config = dash_utils.load_config( self.config_fp )
+        df = user_utils.load_data( config )
+        articles_df, bridges, config = user_utils.preprocess_normalized_data( df, config )
+
+        fp = user_utils.save_aggregate_cube( articles_df, config, bridges=bridges )
+        try:
+            cube = user_utils.load_aggregate_cube( config )
+            assert cube is not None
+
+            # Totals keep their missing category, distinct from the 'N/A' category
+            assert cube.loc[cube['is_total'], 'category'].isna().all()
+            assert cube.loc[~cube['is_total'], 'category'].notna().all()
+
+            # Cubes for other definitions are not used
+            config['new_categories']['Press Types'] = {}
+            assert user_utils.load_aggregate_cube( config ) is None
+        finally:
+            os.remove( fp )
+            state_dir = user_utils.get_processed_data_fp( config, tag='aggregate_state', ext='' )
+            if os.path.isdir( state_dir ):
+                shutil.rmtree( state_dir )
+
 ###############################################################################
 ###############################################################################
 
@@ -159,6 +274,62 @@ class TestDataUtils( unittest.TestCase ):
 
     ###############################################################################
 
+    def test_compile_category_definition( self ):
+
+        base_categories = [ 'A', 'B', 'C' ]
+        bools = np.array([
+            [ True, False, False ],
+            [ True, True, False ],
+            [ True, False, True ],
+            [ False, True, True ],
+            [ False, False, False ],
+        ])
+
+        expected = {
+            "'A'": [ True, True, True, False, False ],
+            "'A' & ( not 'B' )": [ True, False, True, False, False ],
+            "'B' | 'C'": [ False, True, True, True, False ],
+            "only ( 'A' | 'B' )": [ True, True, False, False, False ],
+            "only 'A'": [ True, False, False, False, False ],
+            "( 'A' | 'B' ) & ( not ( 'C' ) )": [ True, True, False, False, False ],
+            "'A' & 'Not In The Data'": [ False, False, False, False, False ],
+        }
+        for category_definition, expected_bools in expected.items():
+            kernel = data_utils.compile_category_definition( category_definition, base_categories )
+            np.testing.assert_array_equal( kernel( bools ), expected_bools )
+
+        with self.assertRaises( ValueError ):
+            data_utils.compile_category_definition( "__import__( 'os' )", base_categories )
+
+    ###############################################################################
+
+    def test_category_bitmasks( self ):
+
+        # More than 64 categories, so the bitmasks take multiple words
+        categories = [ 'cat{:03d}'.format( i ) for i in range( 100 ) ]
+        df = pd.DataFrame({
+            'id': [ 3, 3, 1, 2, 2, 2, 4 ],
+            'Categories': [ 'cat000', 'cat099', 'cat070', 'cat000', 'cat099', 'cat000', 'cat070' ],
+        })
+        df['Categories'] = pd.Categorical( df['Categories'], categories=categories )
+
+        bitmasks, ids, base_categories = data_utils.encode_category_bitmasks( df['id'], df['Categories'] )
+        np.testing.assert_array_equal( ids, [ 1, 2, 3, 4 ] )
+        assert bitmasks.shape == ( 4, 2 )
+
+        bools = data_utils.decode_category_bitmasks( bitmasks, len( base_categories ) )
+        expected = np.zeros( ( 4, 100 ), dtype=bool )
+        expected[0,70] = expected[1,0] = expected[1,99] = expected[2,0] = expected[2,99] = expected[3,70] = True
+        np.testing.assert_array_equal( bools, expected )
+
+        # IDs 2 and 3 have the same categories, as do IDs 1 and 4
+        unique, inverse = data_utils.unique_bitmasks( bitmasks )
+        assert len( unique ) == 2
+        assert inverse[1] == inverse[2]
+        assert inverse[0] == inverse[3]
+
+    ###############################################################################
+
     def test_recategorize_data_per_grouping_realistic( self ):
 
         group_by = 'Research Topics'
@@ -277,6 +448,43 @@ class TestDataUtils( unittest.TestCase ):
 
     ###############################################################################
 
+    def test_recategorization_cache( self ):
+
+        cache = data_utils.get_recategorization_cache()['entries']
+        cache.clear()
+
+        new_categories = copy.deepcopy( self.config['new_categories'] )
+        expected = data_utils.recategorize_data( self.df, new_categories, True )
+        assert len( cache ) == len( new_categories )
+
+        # Editing one grouping only adds an entry for that grouping
+        new_categories['Press Types']['Northwestern Press (Inclusive)'] = "'Northwestern Press'"
+        recategorized = data_utils.recategorize_data( self.df, new_categories, True )
+        assert len( cache ) == len( new_categories ) + 1
+        for group_by in [ 'Research Topics', 'Categories' ]:
+            np.testing.assert_array_equal( recategorized[group_by], expected[group_by] )
+        assert (
+            ( recategorized['Press Types'] == 'Northwestern Press (Inclusive)' ).sum() >
+            ( expected['Press Types'] == 'Northwestern Press (Inclusive)' ).sum()
+        )
+
+        # Versions computed when the data is loaded key the same entries
+        data_versions = data_utils.get_data_versions( self.df, list( new_categories ) )
+        data_utils.recategorize_data( self.df, new_categories, True, data_versions=data_versions )
+        assert len( cache ) == len( new_categories ) + 1
+
+        # The order of definitions matters
+        reordered = dict( reversed( list( new_categories['Press Types'].items() ) ) )
+        assert data_utils.hash_new_categories( reordered ) != \
+            data_utils.hash_new_categories( new_categories['Press Types'] )
+
+        # Evicts least recently used entries
+        data_utils.cached_recategorize_data_per_grouping(
+            self.df, 'Categories', new_categories['Categories'], max_entries=2 )
+        assert len( cache ) == 2
+
+    ###############################################################################
+
     def test_filter_data( self ):
 
         search_str = ''
@@ -304,8 +512,235 @@ class TestDataUtils( unittest.TestCase ):
         assert np.invert( ( 2016 <= selected['Year'] ) & ( selected['Year'] <= 2023 ) ).sum() == 0
         assert np.invert( ( 0 <= selected['Press Mentions'] ) & ( selected['Press Mentions'] <= 10 ) ).sum() == 0
 
+    ###############################################################################
+
+    def test_normalize_data( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+
+        assert len( articles_df ) == len( self.original_df )
+        for groupby_column in self.config['groupings']:
+            assert groupby_column not in articles_df.columns
+            # One row per unique (id, category) pair in the exploded data
+            expected = self.df[['id', groupby_column]].fillna( 'N/A' ).drop_duplicates()
+            assert len( bridges[groupby_column] ) == len( expected )
+
+    ###############################################################################
+
+    def test_filter_normalized_data( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        df = self.df.fillna( 'N/A' )
+
+        categorical_filters = {
+            'Research Topics': [ 'Galaxies & Cosmology', 'Life & Death of Stars' ],
+            'Press Types': [ 'External Press', ],
+        }
+        range_filters = {
+            'Year': [ 2016, 2023 ],
+        }
+
+        selected = data_utils.filter_data( df, '', 'Title', categorical_filters, range_filters )
+        selected_articles, selected_bridges = data_utils.filter_normalized_data(
+            articles_df,
+            bridges,
+            '',
+            'Title',
+            categorical_filters,
+            range_filters
+        )
+
+        # Same articles, and the same aggregated values per grouping
+        assert set( selected_articles['id'] ) == set( selected['id'] )
+        for groupby_column in self.config['groupings']:
+            expected, expected_total = time_series_utils.count_or_sum(
+                selected, 'Year', 'id', groupby_column, 'Count' )
+            actual, actual_total = time_series_utils.count_or_sum(
+                selected_articles, 'Year', 'id', groupby_column, 'Count', bridges=selected_bridges )
+            np.testing.assert_allclose( actual.values, expected.values )
+            np.testing.assert_allclose( actual_total.values, expected_total.values )
+
 ###############################################################################
-    
+
+class TestIndexUtils( unittest.TestCase ):
+
+    def setUp( self ):
+
+        # Get filepath info
+        test_dir = os.path.abspath( os.path.dirname( __file__ ) )
+        self.root_dir = os.path.dirname( test_dir )
+        self.data_dir = os.path.join( self.root_dir, 'test_data', 'test_data_complete', )
+        root_config_fp = os.path.join( self.root_dir, 'test', 'config.yml' )
+        self.config_fp = os.path.join( self.data_dir, 'config.yml' )
+
+        copy_config( root_config_fp, self.config_fp )
+
+        self.config = dash_utils.load_config( self.config_fp )
+        self.original_df = press_data_utils.load_original_data( self.config )
+        self.articles_df, self.bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        self.indexes = index_utils.build_indexes( self.articles_df, self.config, self.bridges )
+
+    def tearDown( self ):
+        if os.path.isfile( self.config_fp ):
+            os.remove( self.config_fp )
+
+    ###############################################################################
+
+    def test_trigram_index( self ):
+
+        search_strs = [
+            'galax',
+            'BLACK HOLE',
+            'ciera.*star',
+            '^the',
+            'neutron[ -]star',
+            '(dark)+ matter',
+            'star|planet',
+            '.',
+        ]
+        for search_col in self.config['text_columns']:
+            for search_str in search_strs:
+                expected = data_utils.filter_data( self.articles_df, search_str, search_col, {}, {} )
+                actual = data_utils.filter_data(
+                    self.articles_df, search_str, search_col, {}, {}, indexes=self.indexes )
+                np.testing.assert_array_equal( actual['id'], expected['id'] )
+
+        # Case-insensitive matching beyond ASCII
+        values = pd.Series( [ 'KELVIN', 'ſtar', 'İstanbul', None, 3 ] )
+        trigram_index = index_utils.build_trigram_index( values )
+        for search_str in [ 'kelvin', 'STAR', 'istanbul', 'ıstan' ]:
+            expected = np.flatnonzero(
+                values.str.extract( '(' + search_str + ')', flags=re.IGNORECASE ).notna().values[:,0] )
+            actual = index_utils.search_trigram_index( trigram_index, search_str )
+            np.testing.assert_array_equal( actual, expected )
+
+        # Without the internals of the re module every value is checked
+        has_regex_internals = index_utils.HAS_REGEX_INTERNALS
+        try:
+            index_utils.HAS_REGEX_INTERNALS = False
+            trigram_index = index_utils.build_trigram_index( self.articles_df['Title'] )
+            assert len( trigram_index['trigrams'] ) == 0
+            for search_str in search_strs:
+                expected = data_utils.filter_data( self.articles_df, search_str, 'Title', {}, {} )
+                actual = index_utils.search_trigram_index( trigram_index, search_str )
+                np.testing.assert_array_equal( self.articles_df['id'].values[actual], expected['id'] )
+        finally:
+            index_utils.HAS_REGEX_INTERNALS = has_regex_internals
+
+    ###############################################################################
+
+    def test_bitmap_index( self ):
+
+        # Includes both original and recategorized categories
+        categorical_filters = {
+            'Research Topics': [ 'Galaxies & Cosmology', 'Compact Objects', 'Not a category' ],
+            'Press Types': [ 'External Press', 'External Press (Inclusive)' ],
+            'Categories': [ 'Science', 'Research', 'Outreach' ],
+        }
+        range_filters = {
+            'Year': [ 2016, 2023 ],
+        }
+
+        # Both for bridged groupings and for recategorized ones, which are article columns
+        recategorized_df = data_utils.recategorize_data(
+            self.articles_df, self.config['new_categories'], True, bridges=self.bridges )
+        for df in [ self.articles_df, recategorized_df ]:
+            indexes = dict( self.indexes )
+            indexes['categorical'] = index_utils.build_categorical_indexes( df, self.config, self.bridges )
+            expected, expected_bridges = data_utils.filter_normalized_data(
+                df, self.bridges, '', 'Title', categorical_filters, range_filters )
+            actual, actual_bridges = data_utils.filter_normalized_data(
+                df, self.bridges, '', 'Title', categorical_filters, range_filters, indexes=indexes )
+
+            assert len( actual ) > 0
+            np.testing.assert_array_equal( actual['id'], expected['id'] )
+            for groupby_column, bridge in expected_bridges.items():
+                np.testing.assert_array_equal( actual_bridges[groupby_column].index, bridge.index )
+
+        # Bridges for more articles than the data
+        df = pd.DataFrame( { 'id': [ 1, 2, 3 ] } )
+        bridges = { 'Research Topics': pd.DataFrame( {
+            'id': [ 1, 2, 3, 4 ],
+            'Research Topics': [ 'a', 'b', 'a', 'a' ],
+        } ) }
+        categorical_indexes = index_utils.build_categorical_indexes(
+            df, { 'categorical_columns': [ 'Research Topics' ] }, bridges )
+        bitmap = index_utils.query_bitmap_index( categorical_indexes['Research Topics'], [ 'a' ] )
+        np.testing.assert_array_equal( index_utils.bitmap_to_rows( bitmap, 3 ), [ 0, 2 ] )
+
+        # Bit layout
+        mask = np.random.default_rng( 0 ).random( 1000 ) < 0.3
+        rows = np.arange( 0, 1000, 7 )
+        np.testing.assert_array_equal( index_utils.check_bits( index_utils.pack_mask( mask ), rows ), mask[rows] )
+        bitmap = index_utils.pack_mask( mask )
+        np.testing.assert_array_equal( index_utils.bitmap_to_rows( bitmap, 1000 ), np.flatnonzero( mask ) )
+        np.testing.assert_array_equal( index_utils.rows_to_bitmap( np.flatnonzero( mask ), 1000 ), bitmap )
+
+    ###############################################################################
+
+    def test_sorted_index( self ):
+
+        range_filters_options = [
+            { 'Year': [ 2016, 2020 ] },
+            { 'Year': [ 2016.5, 2016.7 ] },
+            { 'Year': [ 2030, 2040 ] },
+            { 'Press Mentions': [ 1, 5 ], 'Year': [ 2014, 2022 ] },
+            { 'Press Mentions': [ 0, 0 ], 'People Reached': [ 0, 1e6 ] },
+        ]
+        for range_filters in range_filters_options:
+            for categorical_filters in [ {}, { 'Press Types': [ 'External Press' ] } ]:
+                expected, _ = data_utils.filter_normalized_data(
+                    self.articles_df, self.bridges, 'the', 'Title', categorical_filters, range_filters )
+                actual, _ = data_utils.filter_normalized_data(
+                    self.articles_df, self.bridges, 'the', 'Title', categorical_filters, range_filters,
+                    indexes=self.indexes )
+                np.testing.assert_array_equal( actual['id'], expected['id'] )
+
+    ###############################################################################
+
+    def test_cached_filter_bitmaps( self ):
+
+        categorical_filters = {
+            'Press Types': [ 'External Press', 'CIERA Stories' ],
+            'Categories': [ 'Science' ],
+        }
+        filter_args = [ self.articles_df, self.bridges, 'star', 'Title', categorical_filters, { 'Year': [ 2016, 2023 ] } ]
+        text_cache = self.indexes['text']['Title']['cache']
+        categorical_caches = {
+            column: bitmap_index['cache']
+            for column, bitmap_index in self.indexes['categorical'].items()
+        }
+
+        expected, _ = data_utils.filter_normalized_data( *filter_args )
+        actual, _ = data_utils.filter_normalized_data( *filter_args, indexes=self.indexes )
+        np.testing.assert_array_equal( actual['id'], expected['id'] )
+        assert len( text_cache ) == 1
+
+        # Changing one filter only adds a bitmap for that filter
+        categorical_filters['Press Types'] = [ 'External Press' ]
+        expected, _ = data_utils.filter_normalized_data( *filter_args )
+        actual, _ = data_utils.filter_normalized_data( *filter_args, indexes=self.indexes )
+        np.testing.assert_array_equal( actual['id'], expected['id'] )
+        assert len( text_cache ) == 1
+        assert len( categorical_caches['Press Types'] ) == 2
+        assert len( categorical_caches['Categories'] ) == 1
+
+        # Reordering or repeating the selection reuses the cached bitmap
+        categorical_filters['Categories'] = [ 'Science', 'Science', 'Not a category' ]
+        data_utils.filter_normalized_data( *filter_args, indexes=self.indexes )
+        assert len( categorical_caches['Categories'] ) == 1
+
+###############################################################################
+
 class TestTimeSeriesUtils( unittest.TestCase ):
 
     def setUp( self ):
@@ -432,6 +867,634 @@ class TestTimeSeriesUtils( unittest.TestCase ):
         expected = subselected['Press Mentions'].sum()
         assert total.loc[test_year][0] == expected
 
+    ###############################################################################
+
+    def test_count_or_sum_matches_pivot_table( self ):
+
+        for groupby_column in self.config['groupings']:
+            for count_or_sum, y_column, aggfunc in [
+                ( 'Count', 'id', 'nunique' ),
+                ( 'Sum', 'People Reached', 'sum' ),
+            ]:
+                aggregated_df, total = time_series_utils.count_or_sum(
+                    self.df, 'Year', y_column, groupby_column, count_or_sum )
+
+                if count_or_sum == 'Sum':
+                    selected = self.df.drop_duplicates( subset=[ 'id', groupby_column ] )
+                else:
+                    selected = self.df
+                expected = selected.pivot_table(
+                    index='Year', columns=groupby_column, values=y_column, aggfunc=aggfunc ).fillna( 0 )
+                pd.testing.assert_frame_equal( aggregated_df, expected, check_dtype=False )
+
+                if count_or_sum == 'Sum':
+                    selected = self.df.drop_duplicates( subset='id' )
+                expected_total = selected.pivot_table( index='Year', values=y_column, aggfunc=aggfunc )
+                pd.testing.assert_frame_equal( total, expected_total, check_dtype=False )
+
+    ###############################################################################
+
+    def test_count_and_sum_all( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+
+        for groupby_column in self.config['groupings']:
+            aggregated = time_series_utils.count_and_sum_all(
+                articles_df,
+                'Year',
+                groupby_column,
+                self.config['id_columns'],
+                self.config['weight_columns'],
+                bridges=bridges,
+            )
+            assert len( aggregated ) == len( self.config['id_columns'] ) + len( self.config['weight_columns'] )
+            for ( count_or_sum, y_column ), ( aggregated_df, total ) in aggregated.items():
+                expected, expected_total = time_series_utils.count_or_sum(
+                    articles_df, 'Year', y_column, groupby_column, count_or_sum, bridges=bridges )
+                pd.testing.assert_frame_equal( aggregated_df, expected )
+                pd.testing.assert_frame_equal( total, expected_total )
+
+    ###############################################################################
+
+    def test_approximate_count( self ):
+
+        aggregated = time_series_utils.count_and_sum_all(
+            self.df,
+            'Year',
+            self.group_by,
+            self.config['id_columns'],
+            self.config['weight_columns'],
+        )
+        approximated = time_series_utils.count_and_sum_all(
+            self.df,
+            'Year',
+            self.group_by,
+            self.config['id_columns'],
+            self.config['weight_columns'],
+            approximate=True,
+            relative_error=0.02,
+        )
+        for key, ( aggregated_df, total ) in aggregated.items():
+            approximated_df, approximated_total = approximated[key]
+            if key[0] == 'Sum':
+                pd.testing.assert_frame_equal( approximated_df, aggregated_df )
+                continue
+
+            # Small counts are estimated by linear counting, which is nearly exact
+            np.testing.assert_allclose( approximated_df.values, aggregated_df.values, rtol=0.1, atol=1 )
+            np.testing.assert_allclose( approximated_total.values, total.values, rtol=0.1, atol=1 )
+
+        # Cumulative counts merge the sketches, since values can repeat across years
+        for count_column in self.config['id_columns']:
+            approximated_df, approximated_total = time_series_utils.transform_aggregated(
+                *approximated[( 'Count', count_column )],
+                'Cumulative',
+                sketches=approximated[( 'Sketch', count_column )],
+            )
+            expected_total = [
+                self.df.loc[self.df['Year'] <= year, count_column].nunique()
+                for year in approximated_total.index
+            ]
+            np.testing.assert_allclose( approximated_total[count_column].values, expected_total, rtol=0.1, atol=1 )
+            expected_df = pd.DataFrame({
+                group: [
+                    self.df.loc[( self.df['Year'] <= year ) & ( self.df[self.group_by] == group ), count_column].nunique()
+                    for year in approximated_df.index
+                ]
+                for group in approximated_df.columns
+            }, index=approximated_df.index )
+            np.testing.assert_allclose( approximated_df.values, expected_df.values, rtol=0.1, atol=1 )
+
+    ###############################################################################
+
+    def test_hyperloglog( self ):
+
+        rng = np.random.default_rng( 0 )
+        values = pd.Series( rng.integers( 0, 10**12, 100000 ) )
+        codes = rng.integers( 0, 2, len( values ) )
+        hashes = time_series_utils.hash_values( values )
+        precision = time_series_utils.get_hyperloglog_precision( 0.02 )
+
+        registers = time_series_utils.build_hyperloglogs( codes, hashes, 2, precision )
+        estimates = time_series_utils.estimate_hyperloglogs( registers )
+        expected = [ values.loc[codes == i].nunique() for i in range( 2 ) ]
+        np.testing.assert_allclose( estimates, expected, rtol=4 * 0.02 )
+
+        # Merging the sketches is the same as sketching all the values
+        merged = time_series_utils.merge_hyperloglogs( registers )
+        np.testing.assert_array_equal(
+            merged,
+            time_series_utils.build_hyperloglogs( np.zeros_like( codes ), hashes, 1, precision )[0],
+        )
+        cumulative = time_series_utils.merge_hyperloglogs( registers, cumulative=True )
+        np.testing.assert_array_equal( cumulative[-1], merged )
+
+    ###############################################################################
+
+    def test_cross_tab( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        groupby_columns = self.config['groupings'][:2]
+        aggregated = time_series_utils.count_and_sum_all(
+            articles_df,
+            'Year',
+            groupby_columns,
+            self.config['id_columns'],
+            self.config['weight_columns'],
+            bridges=bridges,
+        )
+
+        # Compare against grouping the joined data, one row per combination of categories
+        joined = bridges[groupby_columns[0]].merge( bridges[groupby_columns[1]], on='id' ).merge( articles_df, on='id' )
+        for ( count_or_sum, y_column ), ( aggregated_df, total ) in aggregated.items():
+            grouped = joined if count_or_sum == 'Count' else joined.drop_duplicates( [ 'id', ] + groupby_columns )
+            grouped = grouped.groupby( [ 'Year', ] + groupby_columns, observed=True )[y_column]
+            expected = grouped.nunique() if count_or_sum == 'Count' else grouped.sum()
+            expected_df = expected.unstack( groupby_columns, fill_value=0 )
+
+            # Only combinations that occur are kept
+            assert len( aggregated_df.columns ) == len( expected_df.columns )
+            np.testing.assert_allclose(
+                aggregated_df[expected_df.columns].values.astype( float ),
+                expected_df.values.astype( float ),
+            )
+
+        # The same through count_or_sum, and summed into a matrix
+        aggregated_df, total = time_series_utils.count_or_sum(
+            articles_df,
+            'Year',
+            'id',
+            groupby_columns,
+            'Count',
+            bridges=bridges,
+        )
+        pd.testing.assert_frame_equal( aggregated_df, aggregated[( 'Count', 'id' )][0] )
+        matrix_df = time_series_utils.get_cross_tab_matrix( aggregated_df )
+        expected = joined.groupby( groupby_columns, observed=True )['id'].nunique().unstack( fill_value=0 )
+        pd.testing.assert_frame_equal(
+            matrix_df.loc[expected.index,expected.columns],
+            expected,
+            check_names=False,
+            check_index_type=False,
+            check_column_type=False,
+        )
+
+    ###############################################################################
+
+    def test_cooccurrence( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+
+        for year_range in [ None, [ 2015, 2017 ] ]:
+            cooccurrence_df = time_series_utils.get_cooccurrence(
+                articles_df,
+                self.group_by,
+                bridges=bridges,
+                year_column='Year',
+                year_range=year_range,
+            )
+
+            # Compare against joining the tags with themselves
+            ids = articles_df['id'] if year_range is None else articles_df.loc[articles_df['Year'].between( *year_range ),'id']
+            bridge = bridges[self.group_by].loc[bridges[self.group_by]['id'].isin( ids )]
+            joined = bridge.merge( bridge, on='id', suffixes=( '', ' (other)' ) )
+            expected = joined.groupby( [ self.group_by, self.group_by + ' (other)' ], observed=True )['id'].nunique()
+            expected = expected.unstack( fill_value=0 )
+            np.testing.assert_array_equal(
+                cooccurrence_df.values,
+                expected.loc[cooccurrence_df.index,cooccurrence_df.columns].values,
+            )
+
+            # The diagonal is the number of articles per category
+            np.testing.assert_array_equal(
+                np.diag( cooccurrence_df.values ),
+                bridge[self.group_by].value_counts()[cooccurrence_df.index].values,
+            )
+
+    ###############################################################################
+
+    def test_roll_up( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        # Same types as the columnar store
+        articles_df['Year'] = articles_df['Year'].astype( 'Int64' )
+        dates = pd.to_datetime( articles_df['Date'] )
+        articles_df['Month'] = dates.dt.to_period( 'M' ).dt.start_time
+        articles_df['Week'] = dates.dt.to_period( 'W' ).dt.start_time
+
+        for groupby_column in self.config['groupings']:
+            rollup = time_series_utils.aggregate_by_day(
+                articles_df,
+                'Date',
+                groupby_column,
+                self.config['id_columns'],
+                self.config['weight_columns'],
+                bridges=bridges,
+            )
+
+            # Rolling up the days gives the same as aggregating each time bin directly
+            for granularity in [ 'Year', 'Month', 'Week' ]:
+                aggregated = time_series_utils.roll_up( rollup, granularity, self.config['start_of_year'] )
+                expected = time_series_utils.count_and_sum_all(
+                    articles_df,
+                    granularity,
+                    groupby_column,
+                    self.config['id_columns'],
+                    self.config['weight_columns'],
+                    bridges=bridges,
+                )
+                for key, ( aggregated_df, total ) in aggregated.items():
+                    expected_df, expected_total = expected[key]
+                    pd.testing.assert_frame_equal( aggregated_df, expected_df )
+                    pd.testing.assert_frame_equal( total, expected_total )
+
+            # Fiscal quarters start at the start of the year
+            aggregated_df, total = time_series_utils.roll_up(
+                rollup, 'Quarter', self.config['start_of_year'] )[( 'Count', 'id' )]
+            assert ( total.index.month % 3 == 9 % 3 ).all()
+            assert total['id'].sum() == articles_df['id'].nunique()
+
+    ###############################################################################
+
+    def test_transform_aggregated( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        articles_df['Date'] = pd.to_datetime( articles_df['Date'] )
+        rollup = time_series_utils.aggregate_by_day(
+            articles_df,
+            'Date',
+            'Research Topics',
+            self.config['id_columns'],
+            self.config['weight_columns'],
+            bridges=bridges,
+        )
+        aggregated_df, total = time_series_utils.roll_up(
+            rollup, 'Month', self.config['start_of_year'] )[( 'Count', 'id' )]
+        prefix_sums = time_series_utils.get_prefix_sums( aggregated_df, total, 'Month' )
+
+        # Compare against pandas on the full range of months, missing months being zero
+        full_index = pd.date_range( total.index.min(), total.index.max(), freq='MS' )
+        full_df = aggregated_df.reindex( full_index, fill_value=0 )
+        expected = {
+            'Cumulative': full_df.cumsum(),
+            'Rolling mean': full_df.rolling( 3, min_periods=1 ).mean(),
+            'Year-over-year change': full_df.diff( 12 ),
+            'Year-over-year percent change': (
+                full_df.pct_change( 12, fill_method=None ) * 100. ).replace( [ np.inf, -np.inf ], np.nan ),
+        }
+        for transform, expected_df in expected.items():
+            transformed_df, transformed_total = time_series_utils.transform_aggregated(
+                aggregated_df,
+                total,
+                transform,
+                window=3,
+                prefix_sums=prefix_sums,
+                granularity='Month',
+            )
+            np.testing.assert_allclose(
+                transformed_df.values.astype( float ),
+                expected_df.loc[aggregated_df.index].values.astype( float ),
+            )
+
+        # No transform leaves the data as is
+        transformed_df, transformed_total = time_series_utils.transform_aggregated( aggregated_df, total )
+        pd.testing.assert_frame_equal( transformed_df, aggregated_df )
+
+    ###############################################################################
+
+    def test_aggregate_cube( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        dfs = {
+            'original': articles_df,
+            'recategorized': data_utils.recategorize_data(
+                articles_df, self.config['new_categories'], True, bridges=bridges ),
+        }
+        cube = time_series_utils.build_aggregate_cube(
+            dfs,
+            [ 'Year', ],
+            self.config['groupings'],
+            self.config['id_columns'],
+            self.config['weight_columns'],
+            bridges=bridges,
+        )
+
+        year_filters = { 'Year': [ 2017, 2020 ] }
+        for recategorization, df in dfs.items():
+            for groupby_column in self.config['groupings']:
+                categories = pd.unique( df[groupby_column] ) if groupby_column in df.columns else []
+                categorical_filters = { groupby_column: [ _ for _ in categories if _ != 'Other' ] }
+                views = [ ( {}, {} ), ( {}, year_filters ) ]
+                if groupby_column in df.columns:
+                    views.append( ( categorical_filters, year_filters ) )
+                for categorical_filters, numerical_filters in views:
+                    aggregated = time_series_utils.query_aggregate_cube(
+                        cube,
+                        recategorization,
+                        'Year',
+                        groupby_column,
+                        categorical_filters=categorical_filters,
+                        numerical_filters=numerical_filters,
+                    )
+                    assert len( aggregated ) > 0
+                    selected_df, selected_bridges = data_utils.filter_normalized_data(
+                        df, bridges, '', 'Title', categorical_filters, numerical_filters )
+                    expected = time_series_utils.count_and_sum_all(
+                        selected_df,
+                        'Year',
+                        groupby_column,
+                        self.config['id_columns'],
+                        self.config['weight_columns'],
+                        bridges=selected_bridges,
+                    )
+                    for key, ( aggregated_df, total ) in aggregated.items():
+                        expected_df, expected_total = expected[key]
+                        expected_df.columns = expected_df.columns.astype( str )
+                        pd.testing.assert_frame_equal( aggregated_df, expected_df, check_dtype=False )
+                        pd.testing.assert_frame_equal(
+                            total, expected_total, check_dtype=False )
+
+        # Views that filter on anything else need the data
+        assert time_series_utils.query_aggregate_cube(
+            cube, 'original', 'Year', 'Research Topics', search_str='galaxy' ) == {}
+        assert time_series_utils.query_aggregate_cube(
+            cube, 'original', 'Year', 'Research Topics', categorical_filters={ 'Press Types': [ 'Science' ] } ) == {}
+
+    ###############################################################################
+
+    def test_aggregate_state( self ):
+
+        articles_df, bridges = data_utils.normalize_data(
+            self.original_df.reset_index(),
+            self.config['groupings'],
+        )
+        hashes = data_utils.hash_articles( articles_df, bridges )
+
+        # The next snapshot changes the year of a few articles, the categories
+        # of a few others, and drops a few
+        new_df = articles_df.copy()
+        new_df.loc[new_df.index[:5], 'Year'] += 1
+        new_bridges = copy.deepcopy( bridges )
+        research_topics = new_bridges['Research Topics']
+        research_topics = research_topics.loc[~research_topics['id'].isin( new_df['id'].iloc[5:10] )]
+        new_bridges['Research Topics'] = research_topics
+        new_df = new_df.iloc[:-5]
+        changed_ids, removed_ids = data_utils.get_article_delta(
+            hashes, data_utils.hash_articles( new_df, new_bridges ) )
+        np.testing.assert_array_equal( changed_ids, new_df['id'].iloc[:10] )
+        np.testing.assert_array_equal( removed_ids, articles_df['id'].iloc[-5:] )
+
+        for groupby_column in self.config['groupings']:
+            state = time_series_utils.build_aggregate_state(
+                'Year',
+                groupby_column,
+                self.config['id_columns'],
+                self.config['weight_columns'],
+            )
+            time_series_utils.update_aggregate_state( state, articles_df, bridges )
+
+            # Saving and loading the state doesn't change it
+            state_dir = os.path.join( self.data_dir, 'aggregate_state' )
+            try:
+                user_utils.save_aggregate_states( { 'settings': {}, 'hashes': hashes, 'states': { ( groupby_column, ): state } }, state_dir )
+                saved = user_utils.load_aggregate_states( state_dir )
+            finally:
+                shutil.rmtree( state_dir )
+            pd.testing.assert_series_equal( saved['hashes'], hashes )
+            state = saved['states'][( groupby_column, )]
+
+            is_changed = new_df['id'].isin( changed_ids )
+            time_series_utils.update_aggregate_state(
+                state,
+                new_df.loc[is_changed],
+                { key: bridge.loc[bridge['id'].isin( changed_ids )] for key, bridge in new_bridges.items() },
+                removed_ids,
+            )
+
+            # Values that no article has anymore are dropped
+            for value_counts in state['value_counts'].values():
+                assert ( value_counts['counts'] > 0 ).all()
+
+            aggregated = time_series_utils.get_aggregates_from_state( state )
+            expected = time_series_utils.count_and_sum_all(
+                new_df,
+                'Year',
+                groupby_column,
+                self.config['id_columns'],
+                self.config['weight_columns'],
+                bridges=new_bridges,
+            )
+            for key, ( aggregated_df, total ) in aggregated.items():
+                expected_df, expected_total = expected[key]
+                expected_df.columns = expected_df.columns.astype( str )
+                pd.testing.assert_frame_equal( aggregated_df, expected_df )
+                pd.testing.assert_frame_equal( total, expected_total )
+
+    ###############################################################################
+
+    def test_chart_specs( self ):
+
+        aggregated_df, total = time_series_utils.count( self.df, 'Year', 'id', self.group_by )
+        color_palette = sns.color_palette( self.config['color_palette'] )
+        plot_kw = {
+            'category_colors': {
+                category: color_palette[i]
+                for i, category in enumerate( aggregated_df.columns )
+            },
+            'show_total': True,
+            'log_yscale': False,
+            'y_lim': [ 0., 60. ],
+            'tick_spacing': 10.,
+            'linewidth': 2.,
+            'marker_size': 30.,
+            'x_label': 'Year',
+            'y_label': 'id',
+            'fig_height': 4.8,
+            'font': 'DejaVu Sans',
+            'font_scale': 1.,
+            'include_legend': True,
+            'legend_scale': 1.,
+            'include_annotations': True,
+            'annotations_horizontal_alignment': 'left',
+        }
+
+        for spec_fn in [ time_series_utils.lineplot_spec, time_series_utils.stackplot_spec ]:
+            spec = spec_fn( aggregated_df, total, **plot_kw )
+
+            # Valid Vega-Lite, and plain JSON
+            alt.Chart.from_dict( spec )
+            json.dumps( spec )
+
+        # The lineplot holds every value, plus the total
+        spec = time_series_utils.lineplot_spec( aggregated_df, total, **plot_kw )
+        values = pd.DataFrame( spec['data']['values'] )
+        assert len( values ) == aggregated_df.size + len( total )
+        spec_df = values.loc[values['category'] != 'Total'].pivot( index='x', columns='category', values='value' )
+        np.testing.assert_allclose(
+            spec_df.loc[aggregated_df.index.astype( int ),aggregated_df.columns.astype( str )].values,
+            aggregated_df.values,
+        )
+
+        # The stackplot holds fractions
+        spec = time_series_utils.stackplot_spec( aggregated_df, total, **plot_kw )
+        values = pd.DataFrame( spec['layer'][0]['data']['values'] )
+        np.testing.assert_allclose( values.groupby( 'x' )['value'].sum(), 1. )
+
+    ###############################################################################
+
+    def test_export( self ):
+
+        aggregated_df, total = time_series_utils.count( self.df, 'Year', 'id', self.group_by )
+        color_palette = sns.color_palette( self.config['color_palette'] )
+        plot_kw = {
+            'category_colors': {
+                category: color_palette[i]
+                for i, category in enumerate( aggregated_df.columns )
+            },
+            'seaborn_style': 'whitegrid',
+            'font': 'DejaVu Sans',
+            'font_scale': 1.,
+            'fig_width': 12.8,
+            'fig_height': 4.8,
+            'x_label': 'Year',
+            'y_label': 'id',
+        }
+
+        # Figures are rendered once per content
+        exported = time_series_utils.export_figure( 'stackplot', aggregated_df, total, plot_kw )
+        assert exported[:4] == b'%PDF'
+        assert time_series_utils.export_figure( 'stackplot', aggregated_df.copy(), total, dict( plot_kw ) ) is exported
+        plot_kw['y_label'] = 'Number of articles'
+        assert time_series_utils.export_figure( 'stackplot', aggregated_df, total, plot_kw ) is not exported
+
+        exported = time_series_utils.export_data( self.df )
+        assert exported == self.df.to_csv().encode()
+        assert time_series_utils.export_data( self.df ) is exported
+
+    ###############################################################################
+
+    def test_render_cache( self ):
+
+        aggregated_df, total = time_series_utils.count( self.df, 'Year', 'id', self.group_by )
+        color_palette = sns.color_palette( self.config['color_palette'] )
+        plot_kw = {
+            'category_colors': {
+                category: color_palette[i]
+                for i, category in enumerate( aggregated_df.columns )
+            },
+            'seaborn_style': 'whitegrid',
+            'font': 'DejaVu Sans',
+            'font_scale': 1.,
+            'fig_width': 12.8,
+            'fig_height': 4.8,
+            'x_label': 'Year',
+            'y_label': 'id',
+            'show_total': True,
+            'log_yscale': False,
+            'linewidth': 2.,
+            'marker_size': 30.,
+            'include_annotations': True,
+            'annotations_horizontal_alignment': 'left',
+            'y_lim': [ 0., 60. ],
+            'tick_spacing': 10.,
+        }
+
+        # Repeated views are served from the cache
+        stats = time_series_utils.get_render_cache_stats()
+        rendered = time_series_utils.render_figure( 'lineplot', aggregated_df, total, plot_kw )
+        assert rendered[:8] == b'\x89PNG\r\n\x1a\n'
+        assert time_series_utils.render_figure( 'lineplot', aggregated_df.copy(), total, dict( plot_kw ) ) is rendered
+        new_stats = time_series_utils.get_render_cache_stats()
+        assert new_stats['misses'] == stats['misses'] + 1
+        assert new_stats['hits'] == stats['hits'] + 1
+
+        # The format is part of the key
+        exported = time_series_utils.render_figure( 'lineplot', aggregated_df, total, plot_kw, 'pdf' )
+        assert exported[:4] == b'%PDF'
+
+        # Least recently used entries are evicted to stay under the size bound
+        time_series_utils.get_cached_render( ( 'test', 0 ), lambda: b'0' * 100, max_bytes=0 )
+        cache = time_series_utils.get_render_cache()
+        assert list( cache['entries'] ) == [ ( 'test', 0 ), ]
+        assert cache['n_bytes'] == 100
+        time_series_utils.get_cached_render( ( 'test', 1 ), lambda: b'1' * 100, max_bytes=150 )
+        assert list( cache['entries'] ) == [ ( 'test', 1 ), ]
+        assert cache['n_bytes'] == 100
+
+    ###############################################################################
+
+    def test_pooled_figure( self ):
+
+        aggregated = time_series_utils.count_and_sum_all(
+            self.df,
+            'Year',
+            self.group_by,
+            [ 'id', ],
+            [ 'Press Mentions', ],
+        )
+        counts_df, counts_total = aggregated[( 'Count', 'id' )]
+        sums_df, sums_total = aggregated[( 'Sum', 'Press Mentions' )]
+        color_palette = sns.color_palette( self.config['color_palette'] )
+        plot_kw = {
+            'category_colors': {
+                category: color_palette[i]
+                for i, category in enumerate( counts_df.columns )
+            },
+            'seaborn_style': 'whitegrid',
+            'font': 'DejaVu Sans',
+            'font_scale': 1.,
+            'fig_width': 12.8,
+            'fig_height': 4.8,
+            'x_label': 'Year',
+            'y_label': 'id',
+            'show_total': True,
+            'log_yscale': False,
+            'linewidth': 2.,
+            'marker_size': 30.,
+            'include_annotations': True,
+            'annotations_horizontal_alignment': 'left',
+        }
+        counts_kw = dict( plot_kw, y_lim=[ 0., 60. ], tick_spacing=10. )
+        sums_kw = dict( plot_kw, y_lim=[ 0., 300. ], tick_spacing=50. )
+        assert time_series_utils.get_layout_key( counts_df, counts_kw ) == time_series_utils.get_layout_key( sums_df, sums_kw )
+
+        def render( fig ):
+            img = io.BytesIO()
+            fig.savefig( img, format='png' )
+            return img.getvalue()
+
+        # Updating a pooled figure gives the same image as drawing from scratch
+        for plot_fn, first_kw, second_kw in [
+            ( time_series_utils.lineplot, counts_kw, sums_kw ),
+            ( time_series_utils.stackplot, plot_kw, plot_kw ),
+        ]:
+            with time_series_utils.pooled_figure( plot_fn.__name__, 'test' ) as pooled:
+                fig = plot_fn( counts_df, counts_total, pooled=pooled, **first_kw )
+                render( fig )
+                assert plot_fn( sums_df, sums_total, pooled=pooled, **second_kw ) is fig
+                assert render( fig ) == render( plot_fn( sums_df, sums_total, **second_kw ) )
+
+        # None of the figures are left open in pyplot
+        assert len( plt.get_fignums() ) == 0
+
 ###############################################################################
 
 class TestStreamlit( unittest.TestCase ):